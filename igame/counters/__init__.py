@@ -0,0 +1,26 @@
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+
+_counters = None
+
+
+def get_counters():
+    """Returns the counter client configured in `settings.COUNTER_BACKEND`. It's created once per process."""
+    global _counters
+
+    if _counters is None:
+        backend = settings.COUNTER_BACKEND
+        _counters = import_string(backend['BACKEND'])(**backend.get('OPTIONS', {}))
+
+    return _counters
+
+
+@receiver(setting_changed)
+def reset_counters(setting, **kwargs):
+    global _counters
+
+    if setting == 'COUNTER_BACKEND':
+        _counters = None
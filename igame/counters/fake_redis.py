@@ -0,0 +1,37 @@
+import threading
+
+
+class FakeReadis:
+    """In-process stand-in for redis. Shared by every thread of the process, but not between processes."""
+
+    storage = {}
+    lock = threading.Lock()
+
+    def __init__(self, **options):
+        pass
+
+    def set(self, key, value):
+        with self.lock:
+            self.storage[key] = value
+
+    def set_many(self, mapping):
+        with self.lock:
+            self.storage.update(mapping)
+
+    def get(self, key):
+        return self.storage.get(key, None)
+
+    def incr(self, key, increment_by):
+        with self.lock:
+            self.storage[key] += increment_by
+
+    def decr(self, key, decrement_by):
+        with self.lock:
+            self.storage[key] -= decrement_by
+
+    def clear(self):
+        with self.lock:
+            FakeReadis.storage = dict()
+
+
+fake_redis = FakeReadis()
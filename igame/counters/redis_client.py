@@ -0,0 +1,42 @@
+import redis
+
+
+class RedisCounters:
+    """
+    Counters kept in a real redis server, so they're shared by all processes and survive restarts.
+
+    Values are whole numbers changed with INCRBY/DECRBY, which redis applies atomically. Connections come
+    from one pool per instance. `pool_options` go to redis-py's `ConnectionPool`, e.g. `max_connections`.
+    """
+
+    def __init__(self, url=None, key_prefix='igame:', **pool_options):
+        if url is None:
+            pool = redis.ConnectionPool(**pool_options)
+        else:
+            pool = redis.ConnectionPool.from_url(url, **pool_options)
+
+        self.key_prefix = key_prefix
+        self.client = redis.StrictRedis(connection_pool=pool)
+
+    def set(self, key, value):
+        self.client.set(self.key_prefix + key, int(value))
+
+    def set_many(self, mapping):
+        if mapping:
+            self.client.mset({self.key_prefix + key: int(value) for key, value in mapping.items()})
+
+    def get(self, key):
+        value = self.client.get(self.key_prefix + key)
+
+        return None if value is None else int(value)
+
+    def incr(self, key, increment_by):
+        self.client.incrby(self.key_prefix + key, int(increment_by))
+
+    def decr(self, key, decrement_by):
+        self.client.decrby(self.key_prefix + key, int(decrement_by))
+
+    def clear(self):
+        keys = list(self.client.scan_iter(match=self.key_prefix + '*'))
+        if keys:
+            self.client.delete(*keys)
@@ -0,0 +1,20 @@
+"""
+ASGI config for igame project.
+
+It exposes the ASGI callable as a module-level variable named ``application``, serve it with an ASGI server:
+
+    uvicorn igame.asgi:application
+
+See `spin.asgi` for what it serves.
+"""
+
+import os
+
+import django
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "igame.settings")
+django.setup(set_prefix=False)
+
+from spin.asgi import ASGIHandler  # noqa: E402, the apps have to be set up first
+
+application = ASGIHandler()
@@ -44,6 +44,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'spin.middleware.RequestMetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -79,12 +80,51 @@ WSGI_APPLICATION = 'igame.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/1.11/ref/settings/#databases
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+# SQLite by default. It only lets one connection write at a time, so concurrent spins wait for each other.
+# IGAME_DATABASE=postgresql uses PostgreSQL, configured with the libpq environment variables(PGHOST, PGPORT,
+# PGDATABASE, PGUSER, PGPASSWORD). Its connections are kept open for IGAME_CONN_MAX_AGE seconds instead of
+# connecting for every request, 0 closes them after every request.
+# To pool them with pgbouncer point PGHOST/PGPORT at pgbouncer and set IGAME_PGBOUNCER=1: in transaction pooling
+# mode every transaction can get a different server connection, which server-side cursors don't survive.
+
+if os.environ.get('IGAME_DATABASE', 'sqlite') == 'postgresql':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.environ.get('PGDATABASE', 'igame'),
+            'USER': os.environ.get('PGUSER', 'postgres'),
+            'PASSWORD': os.environ.get('PGPASSWORD', ''),
+            'HOST': os.environ.get('PGHOST', '127.0.0.1'),
+            'PORT': os.environ.get('PGPORT', '5432'),
+            'CONN_MAX_AGE': int(os.environ.get('IGAME_CONN_MAX_AGE', 60)),
+            'DISABLE_SERVER_SIDE_CURSORS': os.environ.get('IGAME_PGBOUNCER') == '1',
+        }
     }
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+        }
+    }
+
+
+# Pragmas run on every new SQLite connection, off by default. IGAME_SQLITE_TUNING=1 turns on these, for nodes
+# staying on SQLite:
+# - WAL journal, so readers don't wait for the writer and the writer doesn't wait for readers. It's kept in the
+#   database file, turning it off again takes 'journal_mode': 'delete'.
+# - synchronous NORMAL, with WAL only checkpoints wait for the disk. A power loss can lose the latest commits, but
+#   doesn't corrupt the database.
+# - busy_timeout, how long a write waits for the other writer before failing with "database is locked".
+# - mmap_size and cache_size(negative is KiB), so reads are served from memory.
+SQLITE_TUNED_PRAGMAS = {
+    'journal_mode': 'wal',
+    'synchronous': 'normal',
+    'busy_timeout': 5000,
+    'mmap_size': 256 * 1024 * 1024,
+    'cache_size': -64 * 1024,
 }
+SQLITE_PRAGMAS = SQLITE_TUNED_PRAGMAS if os.environ.get('IGAME_SQLITE_TUNING') == '1' else {}
 
 
 # Password validation
@@ -128,3 +168,85 @@ STATIC_URL = '/static/'
 
 # auth
 LOGIN_REDIRECT_URL = 'dashboard'
+
+
+# Counters, e.g. how much money each user has spent for wagering.
+# To share them between processes use redis:
+# COUNTER_BACKEND = {
+#     'BACKEND': 'counters.redis_client.RedisCounters',
+#     'OPTIONS': {'url': 'redis://localhost:6379/0', 'max_connections': 50},
+# }
+COUNTER_BACKEND = {
+    'BACKEND': 'counters.fake_redis.FakeReadis',
+}
+
+
+# How concurrent writes to the same wallets are kept apart. Debits are conditional UPDATEs, so wallets can't be
+# overdrawn with any of them.
+# None relies on that alone: a write that read a wallet which changed since fails with BalanceTooLowError.
+# 'select_for_update' locks a user's wallets for the length of every write, SQLite ignores it.
+# 'optimistic' only writes wallets whose version didn't change since they were read, and retries otherwise.
+WALLET_LOCKING = None
+
+
+# Bonus and wagering work triggered by spins and deposits is written to an outbox table and done by
+# `python manage.py drain_outbox`, so it isn't part of the request. With False it's done inside the request.
+OUTBOX_EVENTS = True
+
+
+# Bonus types are cached in every process and reloaded when one is saved or deleted in that process. The other
+# processes see the change after this many seconds, None keeps them until the process restarts.
+BONUS_TYPES_CACHE_SECONDS = 60
+
+
+# How spin outcomes are drawn, see spin.outcomes. A spin is won with `win_probability`, the return to player is
+# twice that.
+# 'spin.outcomes.SeededUserOutcomes' gives every user a seeded stream of outcomes, `python manage.py
+# replay_outcomes` recomputes and checks them.
+# 'spin.outcomes.SystemRandomOutcomes' draws every outcome from the operating system's CSPRNG.
+# 'spin.outcomes.BufferedOutcomes' draws OPTIONS['block_size'] outcomes from the CSPRNG at once and hands them out.
+OUTCOME_GENERATOR = {
+    'BACKEND': 'spin.outcomes.SeededUserOutcomes',
+    'OPTIONS': {'win_probability': 0.5},
+}
+
+
+# Publish/subscribe between the wallet write paths and the balance streams and long polls of the ASGI entry point.
+# In-process by default, so only writes made by the same process are heard. To share them between processes,
+# e.g. with the outbox worker and other servers, use redis:
+# PUBSUB_BACKEND = {
+#     'BACKEND': 'pubsub.redis_client.RedisBroker',
+#     'OPTIONS': {'url': 'redis://localhost:6379/0'},
+# }
+PUBSUB_BACKEND = {
+    'BACKEND': 'pubsub.in_process.InProcessBroker',
+}
+
+
+# The ASGI entry point(igame/asgi.py) runs the database work of requests on this many threads, each with its own
+# database connection. Requests waiting for a thread wait in the event loop.
+ASGI_DB_THREADS = 8
+
+# Long polls of /api/wallets/poll answer after this many seconds if the wallets didn't change, balance streams of
+# /api/wallets/stream send a comment to keep the connection open after ASGI_STREAM_KEEPALIVE_SECONDS.
+ASGI_LONG_POLL_SECONDS = 25
+ASGI_STREAM_KEEPALIVE_SECONDS = 15
+# Writes other processes made aren't heard with the in-process PUBSUB_BACKEND, so the wallets of users with a
+# long poll or stream are also checked every this many seconds. None doesn't check, enough with redis.
+ASGI_WALLETS_CHECK_INTERVAL = 1
+
+
+# Share of requests whose time, queries and signal handler time are logged to the `spin.metrics` logger. Off by
+# default, e.g. 0.01 logs one request in a hundred.
+REQUEST_METRICS_SAMPLE_RATE = 0
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+    },
+    'loggers': {
+        'spin.metrics': {'handlers': ['console'], 'level': 'INFO', 'propagate': False},
+    },
+}
@@ -17,7 +17,7 @@ from django.conf.urls import url
 from django.contrib import admin
 from django.contrib.auth import views as auth_views
 
-from spin import views as spin_views
+from spin import api as spin_api, views as spin_views
 
 urlpatterns = [
     url(r'^admin/', admin.site.urls),
@@ -26,4 +26,9 @@ urlpatterns = [
     url(r'^logout/$', auth_views.logout, {'next_page': 'login'}, name='logout'),
     url(r'^dashboard/', spin_views.dashboard, name='dashboard'),
     url(r'^play/', spin_views.play, name='play'),
+    url(r'^api/token$', spin_api.token, name='api-token'),
+    url(r'^api/wallets$', spin_api.wallets, name='api-wallets'),
+    url(r'^api/wallets/stream$', spin_api.wallets_stream, name='api-wallets-stream'),
+    url(r'^api/deposit$', spin_api.deposit, name='api-deposit'),
+    url(r'^api/spin$', spin_api.spin, name='api-spin'),
 ]
@@ -0,0 +1,26 @@
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+
+_broker = None
+
+
+def get_broker():
+    """Returns the publish/subscribe broker configured in `settings.PUBSUB_BACKEND`. It's created once per process."""
+    global _broker
+
+    if _broker is None:
+        backend = settings.PUBSUB_BACKEND
+        _broker = import_string(backend['BACKEND'])(**backend.get('OPTIONS', {}))
+
+    return _broker
+
+
+@receiver(setting_changed)
+def reset_broker(setting, **kwargs):
+    global _broker
+
+    if setting == 'PUBSUB_BACKEND':
+        _broker = None
@@ -0,0 +1,28 @@
+from collections import defaultdict
+import threading
+
+
+class InProcessBroker:
+    """
+    Publish/subscribe within one process. Subscribers are called from the publishing thread, and only hear about
+    messages published by the same process.
+    """
+
+    def __init__(self, **options):
+        self.callbacks = defaultdict(list)
+        self.lock = threading.Lock()
+
+    def publish(self, channel, message):
+        with self.lock:
+            callbacks = list(self.callbacks[channel])
+
+        for callback in callbacks:
+            callback(message)
+
+    def subscribe(self, channel, callback):
+        with self.lock:
+            self.callbacks[channel].append(callback)
+
+    def unsubscribe(self, channel, callback):
+        with self.lock:
+            self.callbacks[channel].remove(callback)
@@ -0,0 +1,52 @@
+from collections import defaultdict
+import threading
+
+import redis
+
+
+class RedisBroker:
+    """
+    Publish/subscribe through a real redis server, so subscribers hear about messages published by every process.
+
+    Each instance listens on one connection from a thread of its own, started by the first subscription, and calls
+    the subscribers from that thread. Messages are strings. `pool_options` go to redis-py's `ConnectionPool`.
+    """
+
+    def __init__(self, url=None, channel_prefix='igame:', **pool_options):
+        if url is None:
+            pool = redis.ConnectionPool(**pool_options)
+        else:
+            pool = redis.ConnectionPool.from_url(url, **pool_options)
+
+        self.channel_prefix = channel_prefix
+        self.client = redis.StrictRedis(connection_pool=pool)
+        self.callbacks = defaultdict(list)
+        self.lock = threading.Lock()
+        self.pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+        self.listener = None
+
+    def publish(self, channel, message):
+        self.client.publish(self.channel_prefix + channel, message)
+
+    def subscribe(self, channel, callback):
+        with self.lock:
+            if not self.callbacks[channel]:
+                self.pubsub.subscribe(**{self.channel_prefix + channel: self.dispatch})
+            self.callbacks[channel].append(callback)
+
+            if self.listener is None:
+                self.listener = self.pubsub.run_in_thread(sleep_time=1, daemon=True)
+
+    def unsubscribe(self, channel, callback):
+        with self.lock:
+            self.callbacks[channel].remove(callback)
+            if not self.callbacks[channel]:
+                self.pubsub.unsubscribe(self.channel_prefix + channel)
+
+    def dispatch(self, message):
+        channel = message['channel'].decode('utf-8')[len(self.channel_prefix):]
+        with self.lock:
+            callbacks = list(self.callbacks[channel])
+
+        for callback in callbacks:
+            callback(message['data'].decode('utf-8'))
@@ -0,0 +1,156 @@
+"""
+JSON API for mobile and bot clients.
+
+Clients get a token from `POST /api/token` and send it as `Authorization: Token <key>`. The views never touch
+`request.user` or `request.session`, so the session middleware doesn't load a session, and there are no
+messages, templates or redirects: a spin or deposit answers with the outcome and the new balances.
+
+The endpoints take the user and the request data and return the JSON payload and the status, so
+`spin.asgi.ASGIHandler` serves them too.
+"""
+import json
+import secrets
+
+from django.contrib.auth import authenticate
+from django.http import HttpResponse, JsonResponse, QueryDict
+from django.views.decorators.csrf import csrf_exempt
+
+from .deposit import deposit_real_money
+from .forms import DepositForm, PlayForm
+from .game import play_random_game, play_random_games
+from .models import ApiToken, BalanceTooLowError, WalletChangedError
+from .money import Money
+from .wallets import get_user_wallets
+
+
+def error(message, status):
+    return {'error': message}, status
+
+
+def form_error(form):
+    if not form.is_bound:
+        return error('Send a JSON object', 400)
+
+    return error({field: list(messages) for field, messages in form.errors.items()}, 400)
+
+
+def json_response(result):
+    payload, status = result
+    return JsonResponse(payload, status=status)
+
+
+def get_token_user(authorization):
+    """The active user whose token an `Authorization: Token <key>` header carries, `None` without one."""
+    scheme, _, key = authorization.partition(' ')
+    token = ApiToken.objects.select_related('user').filter(key=key).first() if scheme == 'Token' else None
+
+    return token.user if token is not None and token.user.is_active else None
+
+
+def check_request(method, request_method, authorization):
+    """The user of an API request, and the error to answer with when it has the wrong method or token."""
+    if request_method != method:
+        return None, error('Use {}'.format(method), 405)
+
+    user = get_token_user(authorization)
+    if user is None:
+        return None, error('Send a valid token as "Authorization: Token <key>"', 401)
+
+    return user, None
+
+
+def get_data(content_type, body):
+    """The JSON object of a request body, or its form data. `None` if it's JSON but not an object."""
+    if content_type.split(';')[0].strip() != 'application/json':
+        return QueryDict(body)
+
+    try:
+        data = json.loads(body.decode('utf-8') or '{}')
+    except ValueError:
+        return None
+    return data if isinstance(data, dict) else None
+
+
+def api_view(method, endpoint):
+    """
+    A view answering requests with `method` with what `endpoint` returns for the token's user. As the requests
+    carry no cookies, they don't need CSRF protection.
+    """
+
+    @csrf_exempt
+    def view(request):
+        user, refusal = check_request(method, request.method, request.META.get('HTTP_AUTHORIZATION', ''))
+        return json_response(refusal or endpoint(user, get_data(request.content_type or '', request.body)))
+
+    view.__name__ = endpoint.__name__
+    return view
+
+
+def serialize_wallets(user):
+    wallets = get_user_wallets(user)
+    bonus_wallet = wallets.bonus
+
+    return {
+        'real_money': str(wallets.real_money.current_balance),
+        'bonus': str(bonus_wallet.current_balance) if bonus_wallet else None,
+    }
+
+
+@csrf_exempt
+def token(request):
+    if request.method != 'POST':
+        return json_response(error('Use POST', 405))
+
+    data = get_data(request.content_type or '', request.body) or {}
+    user = authenticate(username=data.get('username'), password=data.get('password'))
+    if user is None:
+        return json_response(error('Wrong username or password', 401))
+
+    api_token, _ = ApiToken.objects.get_or_create(user=user, defaults={'key': secrets.token_hex(20)})
+    return JsonResponse({'token': api_token.key})
+
+
+def wallets_stream(request):
+    """
+    Balance streams are only served by `spin.asgi.ASGIHandler`, a WSGI worker would be held for as long as the
+    stream is open. Browsers' EventSource stops reconnecting on a 204.
+    """
+    return HttpResponse(status=204)
+
+
+def get_wallets(user, data):
+    return {'wallets': serialize_wallets(user)}, 200
+
+
+def deposit_money(user, data):
+    form = DepositForm(data)
+    if not form.is_valid():
+        return form_error(form)
+
+    try:
+        deposit_real_money(user, Money(form.cleaned_data['amount']))
+    except WalletChangedError:
+        return error('The wallets changed while depositing, try again', 409)
+
+    return {'wallets': serialize_wallets(user)}, 200
+
+
+def spin_games(user, data):
+    form = PlayForm(data)
+    if not form.is_valid():
+        return form_error(form)
+
+    games = form.cleaned_data['games'] or 1
+    try:
+        outcomes = [play_random_game(user)] if games == 1 else play_random_games(user, games)
+    except BalanceTooLowError:
+        return error('Not enough money in any wallet', 402)
+    except WalletChangedError:
+        return error('The wallets changed while playing, try again', 409)
+
+    return {'outcomes': outcomes, 'wallets': serialize_wallets(user)}, 200
+
+
+wallets = api_view('GET', get_wallets)
+deposit = api_view('POST', deposit_money)
+spin = api_view('POST', spin_games)
@@ -3,3 +3,8 @@ from django.apps import AppConfig
 
 class SpinConfig(AppConfig):
     name = 'spin'
+
+    def ready(self):
+        # registers the bonus rules, and the signal receivers keeping the bonus types registry fresh and tuning
+        # SQLite connections
+        from . import bonus, sqlite
@@ -0,0 +1,411 @@
+"""
+ASGI application serving the JSON API without a thread per connection.
+
+Django 1.11 and its ORM are synchronous, so the event loop only holds the connections: the database work of every
+request runs on a pool of `ASGI_DB_THREADS` threads, one database connection each. Requests wait for a thread in
+the event loop, behind a semaphore, rather than in the pool's queue. Spins, deposits and wallets are answered by
+`spin.api`'s endpoints, everything else, like the HTML views, by Django's WSGI handler on the same threads.
+
+`GET /api/wallets/poll?since=<state>` is a long poll: it answers with the wallets once their state differs from
+`since`, or after `ASGI_LONG_POLL_SECONDS`. `GET /api/wallets/stream` is a stream of server-sent events, one with
+the wallets whenever they change, for the dashboard. Both are woken by the writes published on
+`WALLETS_CHANGED_CHANNEL` and hold no thread while they wait, so one process can hold thousands.
+"""
+import asyncio
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from importlib import import_module
+from io import BytesIO
+import json
+import logging
+import sys
+import threading
+from urllib.parse import parse_qs
+
+from django.conf import settings
+from django.contrib.auth import get_user
+from django.core.handlers.wsgi import WSGIHandler, WSGIRequest
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import close_old_connections, connections
+
+from .api import (
+    check_request,
+    deposit_money,
+    error,
+    get_data,
+    get_token_user,
+    get_wallets,
+    serialize_wallets,
+    spin_games,
+)
+from .models import Wallet
+from .wallets import get_user_wallets, invalidate_user_wallets, WALLETS_CHANGED_CHANNEL
+from pubsub import get_broker
+
+
+logger = logging.getLogger('django.request')
+
+API_ENDPOINTS = {
+    '/api/wallets': ('GET', get_wallets),
+    '/api/deposit': ('POST', deposit_money),
+    '/api/spin': ('POST', spin_games),
+}
+LONG_POLL_PATH = '/api/wallets/poll'
+STREAM_PATH = '/api/wallets/stream'
+# SQLite allows 999 parameters per query
+WALLET_STATES_PER_QUERY = 500
+
+
+def run_database_job(func, args):
+    """Runs `func` the way Django runs a view: connections too old or broken to reuse are closed around it."""
+    close_old_connections()
+    try:
+        return func(*args)
+    finally:
+        close_old_connections()
+
+
+def close_thread_connections(barrier):
+    """
+    Closes the database connections of the thread. The barrier holds the thread until every thread of the pool runs
+    it, so each of them closes its own.
+    """
+    connections.close_all()
+    barrier.wait()
+
+
+def get_wallets_state(wallets):
+    """A string that changes whenever the balance of one of the (pk, version) wallets changes or one is added."""
+    return '.'.join('{}-{}'.format(pk, version) for pk, version in wallets)
+
+
+def read_wallets(user):
+    invalidate_user_wallets(user)
+    payload = {'wallets': serialize_wallets(user)}
+    payload['state'] = get_wallets_state((wallet.pk, wallet.version) for wallet in get_user_wallets(user).wallets)
+    return payload
+
+
+def read_wallets_states(user_ids):
+    wallets = defaultdict(list)
+    for start in range(0, len(user_ids), WALLET_STATES_PER_QUERY):
+        for user_id, pk, version in Wallet.objects.\
+                filter(user_id__in=user_ids[start:start + WALLET_STATES_PER_QUERY]).\
+                order_by('user_id', '-money_type', 'id').\
+                values_list('user_id', 'pk', 'version'):
+            wallets[user_id].append((pk, version))
+
+    return {user_id: get_wallets_state(wallets[user_id]) for user_id in user_ids}
+
+
+def get_stream_user(scope):
+    """The user of a token in the Authorization header, or else of the session cookie. `None` for anonymous users."""
+    headers = get_headers(scope)
+    if 'authorization' in headers:
+        return get_token_user(headers['authorization'])
+
+    request = WSGIRequest(get_wsgi_environ(scope, b''))
+    request.session = import_module(settings.SESSION_ENGINE).SessionStore(
+        request.COOKIES.get(settings.SESSION_COOKIE_NAME)
+    )
+    user = get_user(request)
+    return user if user.is_authenticated else None
+
+
+def call_api(method, endpoint, scope, body):
+    headers = get_headers(scope)
+    user, refusal = check_request(method, scope['method'], headers.get('authorization', ''))
+
+    return refusal or endpoint(user, get_data(headers.get('content-type', ''), body))
+
+
+def get_headers(scope):
+    return {name.decode('latin1'): value.decode('latin1') for name, value in scope['headers']}
+
+
+def get_wsgi_environ(scope, body):
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', ''),
+        'PATH_INFO': scope['path'],
+        'QUERY_STRING': scope['query_string'].decode('latin1'),
+        'SERVER_NAME': scope['server'][0] if scope.get('server') else 'localhost',
+        'SERVER_PORT': str(scope['server'][1]) if scope.get('server') else '80',
+        'SERVER_PROTOCOL': 'HTTP/{}'.format(scope.get('http_version', '1.1')),
+        'REMOTE_ADDR': scope['client'][0] if scope.get('client') else '',
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope['headers']:
+        name, value = name.decode('latin1'), value.decode('latin1')
+        key = name.upper().replace('-', '_')
+        if key not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            key = 'HTTP_' + key
+        environ[key] = '{},{}'.format(environ[key], value) if key in environ else value
+
+    return environ
+
+
+async def read_body(receive):
+    """The request body, `None` if the client disconnected."""
+    body = b''
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return None
+
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            return body
+
+
+async def send_response(send, status, headers, body):
+    await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def send_event(send, event, payload):
+    data = json.dumps(payload, cls=DjangoJSONEncoder)
+    await send({
+        'type': 'http.response.body', 'body': 'event: {}\ndata: {}\n\n'.format(event, data).encode('utf-8'),
+        'more_body': True,
+    })
+
+
+async def send_json(send, payload, status):
+    body = json.dumps(payload, cls=DjangoJSONEncoder).encode('utf-8')
+    await send_response(send, status, [
+        (b'content-type', b'application/json'), (b'content-length', str(len(body)).encode('latin1')),
+    ], body)
+
+
+class WalletWatcher:
+    """
+    The long polls and streams waiting for their user's wallets to change.
+
+    They are woken by the user ids published on `WALLETS_CHANGED_CHANNEL` after every write. With the in-process
+    broker only this process' writes are heard, so the states of all waiting users' wallets are also read every
+    `ASGI_WALLETS_CHECK_INTERVAL` seconds, with one query per `WALLET_STATES_PER_QUERY` users.
+    """
+
+    def __init__(self, handler):
+        self.handler = handler
+        # user id -> {future of a waiting poll or stream: the state it waits to change}
+        self.waiting = defaultdict(dict)
+        self.checking = None
+        self.subscription = None
+
+    async def wait(self, user_id, state, timeout):
+        """
+        Returns `True` when the user's wallets may no longer be in `state`, `False` after `timeout` seconds without
+        hearing of a change.
+        """
+        loop = asyncio.get_event_loop()
+        self.subscribe()
+
+        changed = loop.create_future()
+        self.waiting[user_id][changed] = state
+        if self.checking is None and getattr(settings, 'ASGI_WALLETS_CHECK_INTERVAL', 1) is not None:
+            self.checking = loop.create_task(self.check())
+
+        try:
+            await asyncio.wait_for(changed, timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            del self.waiting[user_id][changed]
+            if not self.waiting[user_id]:
+                del self.waiting[user_id]
+
+    def wake(self, user_id, changed=lambda state: True):
+        for waiter, state in self.waiting.get(user_id, {}).items():
+            if not waiter.done() and changed(state):
+                waiter.set_result(None)
+
+    def subscribe(self):
+        """
+        Subscribes to `WALLETS_CHANGED_CHANNEL` once per handler. Polls and streams call it before they first read
+        the wallets, so the writes published while they read them aren't missed for lack of a subscription.
+        """
+        if self.subscription is not None:
+            return
+
+        loop = asyncio.get_event_loop()
+
+        def wallets_changed(user_id):
+            # called from the thread that published
+            loop.call_soon_threadsafe(self.wake, int(user_id))
+
+        self.subscription = wallets_changed
+        get_broker().subscribe(WALLETS_CHANGED_CHANNEL, wallets_changed)
+
+    async def check(self):
+        try:
+            while self.waiting:
+                await asyncio.sleep(settings.ASGI_WALLETS_CHECK_INTERVAL)
+                states = await self.handler.run_in_thread(read_wallets_states, list(self.waiting))
+                for user_id, current_state in states.items():
+                    self.wake(user_id, lambda state: state != current_state)
+        finally:
+            self.checking = None
+
+    async def close(self):
+        if self.subscription is not None:
+            get_broker().unsubscribe(WALLETS_CHANGED_CHANNEL, self.subscription)
+            self.subscription = None
+        if self.checking is not None:
+            self.checking.cancel()
+            await asyncio.wait([self.checking])
+
+
+class ASGIHandler:
+    """An ASGI 3 application, `igame.asgi.application`."""
+
+    def __init__(self):
+        self.threads = getattr(settings, 'ASGI_DB_THREADS', 8)
+        self.executor = ThreadPoolExecutor(self.threads, thread_name_prefix='asgi-db')
+        # created in the event loop by the first request
+        self.thread_slots = None
+        self.wsgi_handler = WSGIHandler()
+        self.wallet_watcher = WalletWatcher(self)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self.http(scope, receive, send)
+        else:
+            raise ValueError('Unsupported ASGI scope type {}'.format(scope['type']))
+
+    async def run_in_thread(self, func, *args):
+        """Runs `func` on one of the database threads once one is free."""
+        if self.thread_slots is None:
+            self.thread_slots = asyncio.Semaphore(self.threads)
+
+        async with self.thread_slots:
+            return await asyncio.get_event_loop().run_in_executor(self.executor, run_database_job, func, args)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.shutdown()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def shutdown(self):
+        await self.wallet_watcher.close()
+        # connections are kept open for CONN_MAX_AGE and can only be closed by the thread they belong to
+        barrier = threading.Barrier(self.threads)
+        loop = asyncio.get_event_loop()
+        await asyncio.wait([
+            loop.run_in_executor(self.executor, close_thread_connections, barrier) for _ in range(self.threads)
+        ])
+        self.executor.shutdown()
+
+    async def http(self, scope, receive, send):
+        body = await read_body(receive)
+        if body is None:
+            return
+
+        if scope['path'] == STREAM_PATH:
+            await self.stream_wallets(scope, receive, send)
+            return
+
+        if scope['path'] in API_ENDPOINTS:
+            answer = self.run_in_thread(call_api, *API_ENDPOINTS[scope['path']], scope, body)
+        elif scope['path'] == LONG_POLL_PATH:
+            answer = self.poll_wallets(scope)
+        else:
+            await send_response(send, *await self.run_in_thread(self.call_wsgi, get_wsgi_environ(scope, body)))
+            return
+
+        try:
+            payload, status = await answer
+        except Exception:
+            logger.exception('Internal Server Error: %s', scope['path'])
+            payload, status = error('Internal server error', 500)
+        await send_json(send, payload, status)
+
+    async def poll_wallets(self, scope):
+        user, refusal = await self.run_in_thread(
+            check_request, 'GET', scope['method'], get_headers(scope).get('authorization', '')
+        )
+        if refusal:
+            return refusal
+
+        since = parse_qs(scope['query_string'].decode('latin1')).get('since', [None])[0]
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + getattr(settings, 'ASGI_LONG_POLL_SECONDS', 25)
+        self.wallet_watcher.subscribe()
+        payload = await self.run_in_thread(read_wallets, user)
+        while payload['state'] == since and loop.time() < deadline:
+            if not await self.wallet_watcher.wait(user.pk, since, deadline - loop.time()):
+                break
+            payload = await self.run_in_thread(read_wallets, user)
+
+        return payload, 200
+
+    async def stream_wallets(self, scope, receive, send):
+        """
+        Sends the wallets as a server-sent event when the stream starts and whenever they change, until the client
+        disconnects. Browsers authenticate with the session cookie, other clients with their token.
+        """
+        user = await self.run_in_thread(get_stream_user, scope)
+        if user is None:
+            await send_json(send, *error('Log in, or send a valid token as "Authorization: Token <key>"', 401))
+            return
+
+        await send({'type': 'http.response.start', 'status': 200, 'headers': [
+            (b'content-type', b'text/event-stream'), (b'cache-control', b'no-cache'),
+        ]})
+        loop = asyncio.get_event_loop()
+        self.wallet_watcher.subscribe()
+        disconnected = loop.create_task(receive())
+        keepalive = getattr(settings, 'ASGI_STREAM_KEEPALIVE_SECONDS', 15)
+        state = None
+        changed = True
+        try:
+            while True:
+                if changed:
+                    payload = await self.run_in_thread(read_wallets, user)
+                    if payload['state'] != state:
+                        state = payload['state']
+                        await send_event(send, 'wallets', payload)
+                else:
+                    await send({'type': 'http.response.body', 'body': b': keepalive\n\n', 'more_body': True})
+
+                waiting = loop.create_task(self.wallet_watcher.wait(user.pk, state, keepalive))
+                await asyncio.wait([waiting, disconnected], return_when=asyncio.FIRST_COMPLETED)
+                if disconnected.done():
+                    waiting.cancel()
+                    await asyncio.wait([waiting])
+                    return
+                changed = waiting.result()
+        finally:
+            disconnected.cancel()
+
+    def call_wsgi(self, environ):
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            response['status'] = int(status.split(' ', 1)[0])
+            # Django's Set-Cookie values start with a space
+            response['headers'] = [(name.encode('latin1'), value.strip().encode('latin1')) for name, value in headers]
+
+        chunks = self.wsgi_handler(environ, start_response)
+        try:
+            body = b''.join(chunks)
+        finally:
+            # sends `request_finished`
+            chunks.close()
+
+        return response['status'], response['headers'], body
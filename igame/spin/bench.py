@@ -0,0 +1,123 @@
+"""
+Helpers for the benchmark management commands: seeding synthetic data and timing queries.
+"""
+import time
+
+from django.contrib.auth.models import User
+from django.db import connection, transaction as db_transaction
+from django.utils import timezone
+
+from .bulk import bulk_create_with_ids
+from .models import BonusGrant, DepositTransaction, Transaction, Wallet
+from .money import Money
+
+
+def seed_users(count, bonuses_per_user=0, transactions_per_user=0, username_prefix='bench-user-', password='!',
+               batch_size=1000):
+    """
+    Creates `count` users with a real money wallet holding `transactions_per_user` deposits of 1 and a bonus
+    wallet holding `bonuses_per_user` grants, a third of them empty. Returns the ids of the new users.
+
+    Rows are bulk inserted; users get `password` as their hash, unusable by default, and don't go through
+    `user_setup`.
+    """
+    user_ids = []
+    bonus_balance = sum(number % 3 for number in range(bonuses_per_user))
+
+    for first in range(0, count, batch_size):
+        with db_transaction.atomic():
+            users = bulk_create_with_ids(User, [
+                User(username='{}{}'.format(username_prefix, number), password=password)
+                for number in range(first, min(first + batch_size, count))
+            ])
+
+            real_money_wallets = bulk_create_with_ids(Wallet, [
+                Wallet(user=user, money_type=Wallet.REAL_MONEY, current_balance=transactions_per_user)
+                for user in users
+            ])
+            bonus_wallets = bulk_create_with_ids(Wallet, [
+                Wallet(user=user, money_type=Wallet.BONUS, current_balance=bonus_balance)
+                for user in users if bonuses_per_user
+            ])
+            BonusGrant.objects.bulk_create([
+                BonusGrant(wallet=wallet, balance=number % 3)
+                for wallet in bonus_wallets for number in range(bonuses_per_user)
+            ])
+            if transactions_per_user:
+                insert_deposits([wallet.pk for wallet in real_money_wallets], transactions_per_user)
+
+        user_ids.extend(user.pk for user in users)
+
+    return user_ids
+
+
+def insert_deposits(wallet_ids, count, amount=Money(1)):
+    """
+    Records `count` deposits of `amount` in each of the given new wallets, without changing their balances.
+
+    The rows are generated by the database with INSERT ... SELECT, building millions of model instances for
+    `bulk_create` takes far longer than inserting them.
+    """
+    if connection.vendor == 'postgresql':
+        numbers = 'SELECT n FROM generate_series(1, %s) AS n'
+    else:
+        numbers = 'WITH RECURSIVE numbers(n) AS (SELECT 1 UNION ALL SELECT n + 1 FROM numbers WHERE n < %s) ' \
+                  'SELECT n FROM numbers'
+    created_at = Transaction._meta.get_field('created_at').get_db_prep_value(timezone.now(), connection)
+
+    with connection.cursor() as cursor:
+        # SQLite takes at most 999 parameters per statement
+        for first in range(0, len(wallet_ids), 500):
+            ids = wallet_ids[first:first + 500]
+            in_ids = ', '.join(['%s'] * len(ids))
+            cursor.execute(
+                'INSERT INTO {transaction} (created_at, amount, wallet_id) '
+                'SELECT %s, %s, wallet.id FROM {wallet} AS wallet, ({numbers}) AS numbers '
+                'WHERE wallet.id IN ({ids})'.format(
+                    transaction=Transaction._meta.db_table, wallet=Wallet._meta.db_table, numbers=numbers, ids=in_ids,
+                ),
+                [created_at, amount.cents, count] + ids,
+            )
+            cursor.execute(
+                'INSERT INTO {deposit} (transaction_id) SELECT id FROM {transaction} WHERE wallet_id IN ({ids})'.
+                format(deposit=DepositTransaction._meta.db_table, transaction=Transaction._meta.db_table, ids=in_ids),
+                ids,
+            )
+
+
+def time_calls(func, args_list):
+    """Calls `func` once per item of `args_list` and returns the latencies in milliseconds, sorted."""
+    latencies = []
+
+    for args in args_list:
+        start = time.perf_counter()
+        func(*args)
+        latencies.append((time.perf_counter() - start) * 1000)
+
+    return sorted(latencies)
+
+
+def percentile(sorted_values, percent):
+    if not sorted_values:
+        return 0.0
+
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * percent / 100))]
+
+
+def fetch_all(queryset):
+    """Runs the SQL of `queryset` without building model instances, to time the database alone."""
+    sql, params = queryset.query.sql_with_params()
+
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return cursor.fetchall()
+
+
+def explain(queryset):
+    """Returns the database's query plan for `queryset` as a list of lines."""
+    sql, params = queryset.query.sql_with_params()
+    prefix = 'EXPLAIN QUERY PLAN ' if connection.vendor == 'sqlite' else 'EXPLAIN '
+
+    with connection.cursor() as cursor:
+        cursor.execute(prefix + sql, params)
+        return [' '.join(str(column) for column in row) for row in cursor.fetchall()]
@@ -1,6 +1,33 @@
+from collections import namedtuple
+
 from django.db import transaction as db_transaction
 
-from .models import BonusTransaction, BonusType, Transaction, Wallet
+from .bonus_types import bonus_rule, get_bonus_rules
+from .bulk import bulk_create_with_ids
+from .constants import SPIN_APP_SETTINGS as app_settings
+from .models import BonusGrant, BonusTransaction, BonusType, Transaction, Wallet
+from .money import Money
+from .wallets import (
+    change_wallet_balance,
+    get_user_wallets,
+    invalidates_user_wallets,
+    lock_user_wallets,
+    publish_wallets_changed,
+    retries_wallet_changes,
+)
+
+
+Bonus = namedtuple('Bonus', 'bonus_type amount money_type')
+Bonus.__doc__ = 'A bonus a rule gives, `money_type` is the type of the wallet it is paid into.'
+
+
+class BonusContext:
+    """What the rules of an event are evaluated against, loaded once for all of them."""
+
+    def __init__(self, user, **event_data):
+        self.user = user
+        self.wallets = get_user_wallets(user)
+        self.event_data = event_data
 
 
 def create_default_bonus_types():
@@ -8,8 +35,87 @@ def create_default_bonus_types():
     BonusType.objects.create(active=True, event=BonusType.REAL_MONEY_DEPOSIT)
 
 
+def handle_bonus_event(event, user, **event_data):
+    """Evaluates the rules of the event's active bonus types and gives the user all the bonuses they grant at once."""
+    rules = get_bonus_rules(event)
+    if not rules:
+        return
+
+    context = BonusContext(user, **event_data)
+    bonuses = [bonus for bonus in (rule(context, bonus_type) for rule, bonus_type in rules) if bonus is not None]
+    if bonuses:
+        give_bonuses(user, bonuses)
+
+
+def rule_parameter(value, default_setting):
+    return app_settings[default_setting] if value is None else value
+
+
+@bonus_rule(BonusType.LOGIN)
+def login_bonus(context, bonus_type):
+    return Bonus(bonus_type, rule_parameter(bonus_type.amount, 'LOGIN_BONUS_AMOUNT'), Wallet.REAL_MONEY)
+
+
+@bonus_rule(BonusType.REAL_MONEY_DEPOSIT)
+def real_money_deposit_bonus(context, bonus_type):
+    min_deposit_amount = rule_parameter(bonus_type.min_deposit_amount, 'MIN_REAL_MONEY_DEPOSIT_TO_GET_BONUS')
+
+    if context.event_data['deposit_amount'] > min_deposit_amount:
+        return Bonus(
+            bonus_type, rule_parameter(bonus_type.amount, 'DEFAULT_MONEY_DEPOSIT_BONUS_AMOUNT'), Wallet.BONUS
+        )
+
+
 def give_user_a_bonus(user, bonus_type, amount):
+    """Adds a grant to the user's bonus wallet, which is created with the user's first bonus."""
+    give_bonuses(user, [Bonus(bonus_type, amount, Wallet.BONUS)])
+
+
+@invalidates_user_wallets
+@retries_wallet_changes
+def give_bonuses(user, bonuses):
+    """
+    Pays the bonuses in one database transaction, changing each wallet once and inserting the rows in bulk.
+
+    Bonus wallet bonuses become grants of the user's bonus wallet, which is created with the user's first bonus.
+    """
+    bonuses = [bonus._replace(amount=Money(bonus.amount)) for bonus in bonuses]
+    real_money_bonuses = [bonus for bonus in bonuses if bonus.money_type == Wallet.REAL_MONEY]
+    bonus_wallet_bonuses = [bonus for bonus in bonuses if bonus.money_type == Wallet.BONUS]
+
     with db_transaction.atomic():
-        new_wallet = Wallet.objects.create(money_type=Wallet.BONUS, user=user, current_balance=amount)
-        transaction = Transaction.objects.create(amount=amount, wallet=new_wallet)
-        bonus_transaction = BonusTransaction.objects.create(transaction=transaction, bonus_type=bonus_type)
+        lock_user_wallets(user)
+        wallets = get_user_wallets(user)
+        transactions = []
+
+        if real_money_bonuses:
+            real_money_wallet = wallets.real_money
+            change_wallet_balance(real_money_wallet, sum(bonus.amount for bonus in real_money_bonuses))
+            transactions.extend(
+                (bonus, Transaction(amount=bonus.amount, wallet=real_money_wallet)) for bonus in real_money_bonuses
+            )
+
+        if bonus_wallet_bonuses:
+            total = sum(bonus.amount for bonus in bonus_wallet_bonuses)
+            bonus_wallet = wallets.bonus
+            if bonus_wallet is None:
+                bonus_wallet = Wallet.objects.create(money_type=Wallet.BONUS, user=user, current_balance=total)
+                publish_wallets_changed(user.pk)
+            else:
+                change_wallet_balance(bonus_wallet, total)
+            BonusGrant.objects.bulk_create([
+                BonusGrant(
+                    wallet=bonus_wallet, bonus_type=bonus.bonus_type, balance=bonus.amount,
+                    wagering_requirement=app_settings['BONUS_WAGERING_REQUIREMENT'],
+                )
+                for bonus in bonus_wallet_bonuses
+            ])
+            transactions.extend(
+                (bonus, Transaction(amount=bonus.amount, wallet=bonus_wallet)) for bonus in bonus_wallet_bonuses
+            )
+
+        bulk_create_with_ids(Transaction, [transaction for _, transaction in transactions])
+        BonusTransaction.objects.bulk_create([
+            BonusTransaction(transaction=transaction, bonus_type=bonus.bonus_type)
+            for bonus, transaction in transactions
+        ])
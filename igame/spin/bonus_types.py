@@ -0,0 +1,86 @@
+"""
+In-process registry of the bonus types, and of the rules deciding which bonuses an event gives.
+
+The active bonus types are loaded with one query the first time they are needed and compiled into a table of
+the rules to evaluate for each event. It's kept until a bonus type is saved or deleted. Those signals only reach
+the process that made the change, so the other processes reload the bonus types `BONUS_TYPES_CACHE_SECONDS`
+after loading them.
+"""
+from collections import defaultdict
+import threading
+import time
+
+from django.conf import settings
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .models import BonusType
+
+
+_lock = threading.Lock()
+_registry = None
+_loaded_at = None
+# bumped by every invalidation, so a load that raced with one doesn't keep what it read
+_generation = 0
+_rules = defaultdict(list)
+
+
+def get_bonus_rules(event):
+    """The (rule, bonus type) pairs to evaluate for the event, one for each rule of each of its active bonus types."""
+    return get_registry().get(event, [])
+
+
+def get_registry():
+    registry = _registry
+    max_age = getattr(settings, 'BONUS_TYPES_CACHE_SECONDS', None)
+    if registry is None or max_age is not None and time.monotonic() - _loaded_at > max_age:
+        registry = load_registry()
+
+    return registry
+
+
+def load_registry():
+    global _registry, _loaded_at
+
+    generation = _generation
+    bonus_types = defaultdict(list)
+    for bonus_type in BonusType.objects.filter(active=True).order_by('pk'):
+        bonus_types[bonus_type.event].append(bonus_type)
+
+    registry = {
+        event: [(rule, bonus_type) for bonus_type in event_bonus_types for rule in _rules[event]]
+        for event, event_bonus_types in bonus_types.items()
+    }
+
+    with _lock:
+        if generation == _generation:
+            _registry, _loaded_at = registry, time.monotonic()
+
+    return registry
+
+
+@receiver(post_save, sender=BonusType)
+@receiver(post_delete, sender=BonusType)
+def invalidate_bonus_types(**kwargs):
+    global _registry, _generation
+
+    with _lock:
+        _registry = None
+        _generation += 1
+
+
+def bonus_rule(event):
+    """
+    Registers the decorated function as a rule of the event.
+
+    It's called as `rule(context, bonus_type)` for each active bonus type of the event, with the `BonusContext`
+    of the event, and returns the `Bonus` the user gets or `None`. Rules mustn't query the database, whatever they
+    need goes into the context.
+    """
+
+    def decorator(rule):
+        _rules[event].append(rule)
+        invalidate_bonus_types()
+        return rule
+
+    return decorator
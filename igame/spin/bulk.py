@@ -0,0 +1,18 @@
+from django.db import connection
+
+
+def bulk_create_with_ids(model, objs):
+    """
+    `bulk_create` that always sets the primary keys of the created objects.
+
+    PostgreSQL returns the new ids from the INSERT. SQLite doesn't, but it only allows one writer at a time, so
+    inside our write transaction the newest `len(objs)` rows of the table are the ones we just inserted.
+    """
+    objs = model.objects.bulk_create(objs)
+
+    if objs and not connection.features.can_return_ids_from_bulk_insert:
+        ids = model.objects.order_by('-pk').values_list('pk', flat=True)[:len(objs)]
+        for obj, pk in zip(objs, reversed(list(ids))):
+            obj.pk = pk
+
+    return objs
@@ -1,11 +1,21 @@
-from decimal import Decimal
+from .money import Money
 
 
 SPIN_APP_SETTINGS = {
-    'MIN_REAL_MONEY_DEPOSIT_TO_GET_BONUS': Decimal(100),
-    'DEFAULT_MONEY_DEPOSIT_BONUS_AMOUNT': Decimal(10),
-    'LOGIN_BONUS_AMOUNT': Decimal(100),
-    'DEFAULT_GAME_LOSE_OR_WIN_AMOUNT': Decimal(2),
-    'TEST_USER_BEGINNING_BALANCE': Decimal(100),
+    'MIN_REAL_MONEY_DEPOSIT_TO_GET_BONUS': Money(100),
+    'DEFAULT_MONEY_DEPOSIT_BONUS_AMOUNT': Money(10),
+    'LOGIN_BONUS_AMOUNT': Money(100),
+    'DEFAULT_GAME_LOSE_OR_WIN_AMOUNT': Money(2),
+    'TEST_USER_BEGINNING_BALANCE': Money(100),
+    'MAX_GAMES_PER_PLAY_REQUEST': 1000,
+    'MAX_DEPOSIT_AMOUNT': Money(1000000),
+    # how many times its amount a bonus has to be wagered before it's moved to the real money wallet
+    'BONUS_WAGERING_REQUIREMENT': 10,
+    # how many times a write is tried with optimistic wallet locking before `WalletChangedError` is raised
+    'WALLET_UPDATE_ATTEMPTS': 10,
+    # how many times a write is tried on SQLite before "database is locked" is raised
+    'DATABASE_LOCKED_ATTEMPTS': 10,
+    # how many times `drain_outbox` tries an event whose handler raises before leaving it in the outbox
+    'OUTBOX_EVENT_ATTEMPTS': 5,
 
 }
@@ -1,16 +1,26 @@
-from django.db.models import F, Sum
+from django.db import transaction as db_transaction
+from django.db.models import Sum
 
 from .models import BalanceTooLowError, DepositTransaction, Game, SpinGameTransaction, Transaction, Wallet
+from .money import Money
+from .wallets import (
+    change_grant_balance,
+    debit_wallet,
+    get_grant_for_game,
+    get_user_wallets,
+    invalidates_user_wallets,
+    retries_wallet_changes,
+)
 
 
-def deduct_real_money__user_lost_game(user, amount):
-    wallet = get_wallet_for_game(user, amount)
-    game = Game.objects.create(outcome=Game.LOST)
+@invalidates_user_wallets
+@retries_wallet_changes
+def deduct_real_money__user_lost_game(user, amount, outcome_position=None):
+    amount = Money(amount)
+    wallet = debit_wallet_for_game(user, amount)
+    game = Game.objects.create(outcome=Game.LOST, outcome_position=outcome_position)
     deduction_amount = negify(amount)
 
-    wallet.current_balance = F('current_balance') + deduction_amount
-    wallet.save()
-
     transaction = Transaction.objects.create(amount=deduction_amount, wallet=wallet)
     SpinGameTransaction.objects.create(game=game, transaction=transaction)
 
@@ -20,7 +30,39 @@ def negify(number):
 
 
 def get_wallet_for_game(user, bet_amount):
-    try:
-        return user.wallets.filter(current_balance__gte=bet_amount).order_by('-money_type')[0]
-    except IndexError:
+    return get_user_wallets(user).for_game(bet_amount)
+
+
+def debit_wallet_for_game(user, bet_amount):
+    """
+    Takes the bet out of the first wallet that can afford it, in the order of `get_wallet_for_game`, and returns it.
+
+    The wallets' cached balances are only used to skip wallets; each debit is checked by the database. A wallet
+    spent from since it was read is passed over for the next one. Bets on the bonus wallet are also taken out of
+    the grant `get_grant_for_game` picks.
+    """
+    for wallet in get_user_wallets(user).wallets:
+        if wallet.current_balance < bet_amount:
+            continue
+
+        try:
+            if wallet.money_type == Wallet.BONUS:
+                debit_bonus_wallet(wallet, bet_amount)
+            else:
+                debit_wallet(wallet, bet_amount)
+            return wallet
+        except BalanceTooLowError:
+            pass
+
+    raise BalanceTooLowError
+
+
+def debit_bonus_wallet(wallet, bet_amount):
+    grant = get_grant_for_game(wallet, bet_amount)
+    if grant is None:
         raise BalanceTooLowError
+
+    # the grant's debit is rolled back if the wallet's fails
+    with db_transaction.atomic():
+        change_grant_balance(grant, negify(bet_amount))
+        debit_wallet(wallet, bet_amount)
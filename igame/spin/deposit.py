@@ -1,14 +1,28 @@
 from django.db import transaction as db_transaction
-from django.db.models import F
 
-from .models import  DepositTransaction, Transaction, Wallet, user_made_deposit_signal
+from .models import  DepositTransaction, OutboxEvent, Transaction, Wallet
+from .money import Money
+from .outbox import publish_event
+from .wallets import (
+    change_wallet_balance,
+    get_user_wallets,
+    invalidates_user_wallets,
+    lock_user_wallets,
+    retries_wallet_changes,
+    retries_when_database_is_locked,
+)
 
 
+@invalidates_user_wallets
+@retries_when_database_is_locked
+@retries_wallet_changes
 def deposit_real_money(user, amount):
+    amount = Money(amount)
+
     with db_transaction.atomic():
-        real_money_wallet = Wallet.objects.get(user=user, money_type=Wallet.REAL_MONEY)
-        real_money_wallet.current_balance = F('current_balance') + amount
-        real_money_wallet.save()
+        lock_user_wallets(user)
+        real_money_wallet = get_user_wallets(user).real_money
+        change_wallet_balance(real_money_wallet, amount)
         transaction = Transaction.objects.create(amount=amount, wallet=real_money_wallet)
         DepositTransaction.objects.create(transaction=transaction)
-        user_made_deposit_signal.send(sender=None, user=user, deposit_amount=amount)
+        publish_event(OutboxEvent.USER_MADE_DEPOSIT, user, amount)
@@ -1,5 +1,18 @@
+from decimal import Decimal
+
 from django import forms
 
+from .constants import SPIN_APP_SETTINGS as app_settings
+
 
 class DepositForm(forms.Form):
-    amount = forms.DecimalField(label='The amount to deposit')
+    amount = forms.DecimalField(
+        label='The amount to deposit', decimal_places=2, min_value=Decimal('0.01'),
+        max_value=app_settings['MAX_DEPOSIT_AMOUNT'].decimal
+    )
+
+
+class PlayForm(forms.Form):
+    games = forms.IntegerField(
+        label='Number of games', required=False, min_value=1, max_value=app_settings['MAX_GAMES_PER_PLAY_REQUEST']
+    )
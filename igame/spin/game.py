@@ -1,34 +1,192 @@
-import random
-
 from django.db import transaction
-from django.db.models import F
 
+from .bulk import bulk_create_with_ids
 from .constants import SPIN_APP_SETTINGS as app_settings
-from .deduct import deduct_real_money__user_lost_game, get_wallet_for_game
-from .models import BalanceTooLowError, Game, SpinGameTransaction, Transaction, user_spendt_money_signal, Wallet
+from .deduct import deduct_real_money__user_lost_game, get_wallet_for_game, negify
+from .game_rules import is_a_bonus_transferable, NO_GRANT, pick_wallet_for_game, wagering_threshold
+from .models import BalanceTooLowError, BonusGrant, Game, OutboxEvent, SpinGameTransaction, Transaction, Wallet
+from .money import Money
+from .outbox import publish_event
+from .outcomes import draw_outcomes
+from .wagering import MoneySpentForWagering, transfer_eligible_bonuses_to_real_money_wallet
+from .wallets import (
+    change_grant_balance,
+    change_wallet_balance,
+    get_grant_for_game,
+    get_user_wallets,
+    invalidate_user_wallets,
+    invalidates_user_wallets,
+    lock_user_wallets,
+    retries_wallet_changes,
+    retries_when_database_is_locked,
+)
 
 
+@invalidates_user_wallets
+@retries_when_database_is_locked
 def play_random_game(user):
-    outcome = random.choice([Game.LOST, Game.WON])
-    play_game(user, outcome, app_settings['DEFAULT_GAME_LOSE_OR_WIN_AMOUNT'])
+    with transaction.atomic():
+        # the wallets are locked before the stream, in the order `play_games` locks them
+        lock_user_wallets(user)
+        [outcome], position = draw_outcomes(user, 1)
+        play_game(user, outcome, app_settings['DEFAULT_GAME_LOSE_OR_WIN_AMOUNT'], outcome_position=position)
 
     return outcome
 
 
-def play_game(user, outcome, bet_amount):
+def play_random_games(user, count):
+    return play_games(user, count, app_settings['DEFAULT_GAME_LOSE_OR_WIN_AMOUNT'])
+
+
+@invalidates_user_wallets
+@retries_when_database_is_locked
+def play_game(user, outcome, bet_amount, outcome_position=None):
+    bet_amount = Money(bet_amount)
+
     with transaction.atomic():
+        lock_user_wallets(user)
+        money_spent = MoneySpentForWagering(user.pk)
         if outcome == Game.LOST:
-            deduct_real_money__user_lost_game(user, bet_amount)
+            # read before the game is written, so a counter missing after a restart or in another process is
+            # rebuilt from the ledger without it, and the increase below doesn't count it twice
+            money_spent.total
+            deduct_real_money__user_lost_game(user, bet_amount, outcome_position=outcome_position)
         else:
-            reward_user(user, bet_amount)
+            reward_user(user, bet_amount, outcome_position=outcome_position)
+
+        if outcome == Game.LOST:
+            money_spent.increase(bet_amount)
+        publish_event(OutboxEvent.USER_SPENT_MONEY, user)
+
+
+@invalidates_user_wallets
+@retries_when_database_is_locked
+def play_games(user, outcomes_or_count, bet_amount):
+    """
+    Play several games in one database transaction.
+
+    `outcomes_or_count` is either a list of outcomes or the number of games to play with outcomes drawn by
+    `spin.outcomes.draw_outcomes`. The rows written are the same as calling `play_game` once per outcome: games are
+    played in order until the user can't afford the bet anymore. Returns the outcomes of the games that were played.
+
+    Wagering only runs when a game makes a bonus transferable, and once at the end.
+    """
+    bet_amount = Money(bet_amount)
+
+    played = []
+    with transaction.atomic():
+        lock_user_wallets(user)
+        if isinstance(outcomes_or_count, int):
+            outcomes, first_position = draw_outcomes(user, outcomes_or_count)
+        else:
+            outcomes, first_position = list(outcomes_or_count), None
+        positions = [None] * len(outcomes) if first_position is None else \
+            list(range(first_position, first_position + len(outcomes)))
+
+        while len(played) < len(outcomes):
+            games = play_games_until_a_bonus_is_transferable(
+                user, outcomes[len(played):], bet_amount, positions[len(played):]
+            )
+            if not games:
+                break
+
+            played.extend(games)
+            if len(played) < len(outcomes):
+                transfer_eligible_bonuses_to_real_money_wallet(user)
+
+        if played:
+            publish_event(OutboxEvent.USER_SPENT_MONEY, user)
+
+    if not played:
+        raise BalanceTooLowError
+
+    return played
+
+
+@retries_wallet_changes
+def play_games_until_a_bonus_is_transferable(user, outcomes, bet_amount, positions):
+    money_spent = MoneySpentForWagering(user.pk)
+    money_spent_total = money_spent.total.cents
+    user_wallets = get_user_wallets(user)
+    real_money_wallet = user_wallets.real_money
+    bonus_wallet = user_wallets.bonus
+    grants = get_grants_with_balance(bonus_wallet)
+    bet = bet_amount.cents
+    # the balances the games leave, in cents
+    real_money = real_money_wallet.current_balance.cents
+    bonus = bonus_wallet.current_balance.cents if bonus_wallet else 0
+    grant_balances = [grant.balance.cents for grant in grants]
+    requirements = [grant.wagering_requirement for grant in grants]
+    played = []
+
+    for outcome, position in zip(outcomes, positions):
+        with_real_money, grant = pick_wallet_for_game(real_money, bonus, grant_balances, bet)
+        if not with_real_money and grant == NO_GRANT:
+            break
+
+        amount = -bet if outcome == Game.LOST else bet
+        if with_real_money:
+            real_money += amount
+            wallet = real_money_wallet
+        else:
+            bonus += amount
+            grant_balances[grant] += amount
+            wallet = bonus_wallet
+        if outcome == Game.LOST:
+            money_spent_total += bet
+        played.append((outcome, wallet, Money.from_cents(amount), position))
+
+        if is_a_bonus_transferable(wagering_threshold(grant_balances, requirements), money_spent_total):
+            break
+
+    if not played:
+        return []
+
+    games = bulk_create_with_ids(
+        Game, [Game(outcome=outcome, outcome_position=position) for outcome, _, _, position in played]
+    )
+    transactions = bulk_create_with_ids(
+        Transaction, [Transaction(amount=amount, wallet=wallet) for _, wallet, amount, _ in played]
+    )
+    SpinGameTransaction.objects.bulk_create(
+        [SpinGameTransaction(game=game, transaction=t) for game, t in zip(games, transactions)]
+    )
+
+    for grant, balance in zip(grants, grant_balances):
+        if balance != grant.balance.cents:
+            change_grant_balance(grant, Money.from_cents(balance) - grant.balance)
+    if real_money != real_money_wallet.current_balance.cents:
+        change_wallet_balance(real_money_wallet, Money.from_cents(real_money) - real_money_wallet.current_balance)
+    if bonus_wallet is not None and bonus != bonus_wallet.current_balance.cents:
+        change_wallet_balance(bonus_wallet, Money.from_cents(bonus) - bonus_wallet.current_balance)
+
+    invalidate_user_wallets(user)
+    lost_amount = sum((negify(amount) for outcome, _, amount, _ in played if outcome == Game.LOST), Money(0))
+    if lost_amount:
+        money_spent.increase(lost_amount)
+
+    return [outcome for outcome, _, _, _ in played]
+
+
+def get_grants_with_balance(bonus_wallet):
+    """The grants games and wagering can use, empty ones never get money again."""
+    if bonus_wallet is None:
+        return []
 
-    user_spendt_money_signal.send(sender=None, user_id=user.pk)
+    return list(BonusGrant.objects.filter(wallet=bonus_wallet, balance__gt=0).order_by('pk'))
 
 
-def reward_user(user, bet_amount):
-    game = Game.objects.create(outcome=Game.WON)
+@invalidates_user_wallets
+@retries_wallet_changes
+def reward_user(user, bet_amount, outcome_position=None):
+    bet_amount = Money(bet_amount)
     wallet_to_be_rewarded = get_wallet_for_game(user, bet_amount)
-    wallet_to_be_rewarded.current_balance = F('current_balance') + bet_amount
-    wallet_to_be_rewarded.save()
+    if wallet_to_be_rewarded.money_type == Wallet.BONUS:
+        grant = get_grant_for_game(wallet_to_be_rewarded, bet_amount)
+        if grant is None:
+            raise BalanceTooLowError
+        change_grant_balance(grant, bet_amount)
+    change_wallet_balance(wallet_to_be_rewarded, bet_amount)
+    game = Game.objects.create(outcome=Game.WON, outcome_position=outcome_position)
     transaction = Transaction.objects.create(wallet=wallet_to_be_rewarded, amount=bet_amount)
     SpinGameTransaction.objects.create(game=game, transaction=transaction)
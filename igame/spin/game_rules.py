@@ -0,0 +1,78 @@
+"""
+The decisions games and wagering make about a user's wallets and bonus grants, apart from where they're kept.
+
+`spin.game` and `spin.wagering` call them with one user's balances as numbers, `spin.simulation` with the balances
+of many users as NumPy arrays, one element per user. Amounts are in cents. A user's grants are a sequence with an
+amount per grant, in the order they were given, like their primary keys: a list of numbers for one user, a list of
+arrays, one per grant, for many.
+
+Wagering walks the grants with a balance in wagering order: lowest balance first, oldest first among equal
+balances. It transfers them while the money spent covers their balance times their wagering requirement and stops at
+the first one it doesn't.
+"""
+
+
+# `pick_wallet_for_game` picks no grant
+NO_GRANT = -1
+# the wagering threshold of users without grants with a balance, more money than anyone spends
+NO_THRESHOLD = 2 ** 63 - 1
+
+
+def select(condition, if_true, if_false):
+    """`if_true` if `condition` holds, otherwise `if_false`. Elementwise for NumPy arrays."""
+    if isinstance(condition, bool):
+        return if_true if condition else if_false
+
+    # only the simulation passes arrays, the games don't need NumPy
+    import numpy as np
+    return np.where(condition, if_true, if_false)
+
+
+def pick_wallet_for_game(real_money, bonus, grants, bet):
+    """
+    Games are played with the real money wallet if it has the bet, otherwise with the bonus wallet and its oldest
+    grant that has it.
+
+    Returns whether the game is played with real money, and the index of the grant it's played with, `NO_GRANT` if
+    it isn't played with a grant. A game played with neither can't be afforded.
+    """
+    with_real_money = real_money >= bet
+
+    grant = NO_GRANT
+    for index in reversed(range(len(grants))):
+        grant = select(grants[index] >= bet, index, grant)
+
+    return with_real_money, select(with_real_money | (bonus < bet), NO_GRANT, grant)
+
+
+def wagering_threshold(grants, requirements):
+    """
+    The money a user has to have spent before any of their bonuses can be transferred: the balance times the
+    wagering requirement of the first grant in wagering order, `NO_THRESHOLD` without grants with a balance.
+    """
+    lowest, requirement = NO_THRESHOLD, 0
+    for balance, grant_requirement in zip(grants, requirements):
+        lower = (balance > 0) & (balance < lowest)
+        lowest = select(lower, balance, lowest)
+        requirement = select(lower, grant_requirement, requirement)
+
+    return select(lowest < NO_THRESHOLD, lowest * requirement, NO_THRESHOLD)
+
+
+def is_a_bonus_transferable(threshold, money_spent):
+    """Whether wagering transfers anything with the `wagering_threshold` of the user's grants."""
+    return money_spent >= threshold
+
+
+def wager_grant(balance, requirement, money_spent, wagering=True):
+    """
+    A step of the wagering walk, for the next grant in wagering order. `money_spent` is what the grants before it
+    left, `wagering` whether they were all transferred.
+
+    Returns whether the grant is transferred and the money spent left after it. A grant that isn't transferred ends
+    the walk, the grants after it are passed `wagering=False`.
+    """
+    cost = balance * requirement
+    transferred = wagering & (balance > 0) & (cost <= money_spent)
+
+    return transferred, money_spent - select(transferred, cost, 0)
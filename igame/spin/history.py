@@ -0,0 +1,159 @@
+"""
+Archiving of old spins.
+
+Spins are most of the rows of `Game`, `SpinGameTransaction` and `Transaction`. Once the wallets were reconciled past
+a month, its spins can be moved into `ArchivedSpin`, one row each, so the live tables only hold recent history. On
+PostgreSQL `ArchivedSpin` has a partition per month: a range of archived spins is read from the partitions it
+covers, and a month is dropped with one statement.
+"""
+import datetime
+
+from django.db import connection, transaction as db_transaction
+from django.db.models import F, Min, OuterRef, Subquery, Sum
+from django.utils import timezone
+
+from .models import ArchivedSpin, DroppedSpinsTotal, Game, SpinGameTransaction, Transaction, WalletSnapshot
+
+
+def month_start(moment):
+    return moment.astimezone(timezone.utc).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def next_month(start):
+    return (start + datetime.timedelta(days=32)).replace(day=1)
+
+
+def partition_name(month):
+    return '{}_y{:04}m{:02}'.format(ArchivedSpin._meta.db_table, month.year, month.month)
+
+
+def create_archive_partitions(months):
+    """Creates the `ArchivedSpin` partitions of the months starting at `months` that don't exist yet."""
+    if connection.vendor != 'postgresql':
+        return
+
+    with connection.cursor() as cursor:
+        for month in sorted(months):
+            cursor.execute(
+                'CREATE TABLE IF NOT EXISTS {} PARTITION OF {} FOR VALUES FROM (%s) TO (%s)'.format(
+                    partition_name(month), ArchivedSpin._meta.db_table
+                ),
+                [month, next_month(month)],
+            )
+
+
+def archivable_spins(before):
+    """
+    The spins whose transactions were created before `before` and are covered by their wallet's latest snapshot.
+
+    Reconciliation only sums the transactions after a snapshot, so those can leave the ledger.
+    """
+    latest_snapshot = WalletSnapshot.objects.\
+        filter(wallet_id=OuterRef('transaction__wallet_id')).\
+        order_by('-pk').\
+        values('last_transaction_id')[:1]
+
+    return SpinGameTransaction.objects.\
+        filter(transaction__created_at__lt=before).\
+        annotate(reconciled_up_to=Subquery(latest_snapshot)).\
+        filter(transaction_id__lte=F('reconciled_up_to')).\
+        order_by('transaction_id')
+
+
+def archive_spins(before, batch_size=500):
+    """
+    Moves the spins created before `before` that `archivable_spins` allows into `ArchivedSpin`, `batch_size` per
+    database transaction, and returns how many it moved. Run `reconcile_wallets` first.
+    """
+    archived = 0
+
+    while True:
+        with db_transaction.atomic():
+            spins = list(archivable_spins(before).values_list(
+                'pk', 'game_id', 'game__outcome', 'game__outcome_position', 'transaction_id', 'transaction__wallet_id',
+                'transaction__amount', 'transaction__created_at',
+            )[:batch_size])
+            if not spins:
+                return archived
+
+            create_archive_partitions({month_start(created_at) for *_, created_at in spins})
+            ArchivedSpin.objects.bulk_create([
+                ArchivedSpin(
+                    game_id=game_id, outcome=outcome, outcome_position=outcome_position, transaction_id=transaction_id,
+                    wallet_id=wallet_id, amount=amount, created_at=created_at,
+                )
+                for _, game_id, outcome, outcome_position, transaction_id, wallet_id, amount, created_at in spins
+            ])
+            SpinGameTransaction.objects.filter(pk__in=[spin[0] for spin in spins]).delete()
+            Transaction.objects.filter(pk__in=[spin[4] for spin in spins]).delete()
+            Game.objects.filter(pk__in=[spin[1] for spin in spins]).delete()
+
+        archived += len(spins)
+
+
+def drop_archived_month(month):
+    """
+    Deletes the archived spins of the month starting at `month`, on PostgreSQL by dropping its partition. The money
+    each user lost in them is added to their `DroppedSpinsTotal` first.
+    """
+    spins = ArchivedSpin.objects.filter(created_at__gte=month, created_at__lt=next_month(month))
+    lost = spins.\
+        filter(outcome=Game.LOST).\
+        values_list('wallet__user_id').\
+        annotate(total=Sum('amount'))
+
+    with db_transaction.atomic():
+        lost = dict(lost)
+        dropped_before = set(DroppedSpinsTotal.objects.filter(user_id__in=list(lost)).values_list('user_id', flat=True))
+        for user_id in dropped_before:
+            DroppedSpinsTotal.objects.filter(user_id=user_id).update(lost=F('lost') - lost[user_id].cents)
+        DroppedSpinsTotal.objects.bulk_create([
+            DroppedSpinsTotal(user_id=user_id, lost=-total) for user_id, total in lost.items()
+            if user_id not in dropped_before
+        ])
+
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute('DROP TABLE IF EXISTS {}'.format(partition_name(month)))
+        else:
+            spins.delete()
+
+
+def drop_archived_months(before):
+    """Drops the archived months before the month starting at `before`."""
+    oldest = ArchivedSpin.objects.aggregate(oldest=Min('created_at'))['oldest']
+    month = before if oldest is None else month_start(oldest)
+
+    while month < before:
+        drop_archived_month(month)
+        month = next_month(month)
+
+
+def get_user_spins(user, start, end):
+    """
+    The (created at, outcome, amount) of the user's spins between `start` and `end`, archived or not, oldest first.
+
+    Both halves are ranges of a (wallet, created_at) index, and on PostgreSQL only read the archive partitions of
+    the months between `start` and `end`.
+    """
+    live = SpinGameTransaction.objects.\
+        filter(transaction__wallet__user_id=user.pk).\
+        filter(transaction__created_at__gte=start, transaction__created_at__lt=end).\
+        values_list('transaction__created_at', 'game__outcome', 'transaction__amount')
+    archived = ArchivedSpin.objects.\
+        filter(wallet__user_id=user.pk, created_at__gte=start, created_at__lt=end).\
+        values_list('created_at', 'outcome', 'amount')
+
+    return sorted(list(archived) + list(live), key=lambda spin: spin[0])
+
+
+def get_user_drawn_outcomes(user):
+    """The outcomes of the user's spins, archived or not, by their position in the user's `OutcomeStream`."""
+    live = SpinGameTransaction.objects.\
+        filter(transaction__wallet__user_id=user.pk, game__outcome_position__isnull=False).\
+        values_list('game__outcome_position', 'game__outcome')
+    archived = ArchivedSpin.objects.\
+        filter(wallet__user_id=user.pk, outcome_position__isnull=False).\
+        values_list('outcome_position', 'outcome')
+
+    return dict(list(archived) + list(live))
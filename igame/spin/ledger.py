@@ -0,0 +1,93 @@
+from collections import defaultdict, namedtuple
+from functools import reduce
+from operator import or_
+
+from django.db import connection, transaction as db_transaction
+from django.db.models import Max, Q, Sum
+
+from .models import Transaction, Wallet, WalletSnapshot
+from .money import Money
+
+
+Drift = namedtuple('Drift', ['wallet_id', 'cached_balance', 'ledger_balance'])
+
+
+def reconcile_wallets(wallet_ids):
+    """
+    Checks the cached balances of the given wallets against their transactions and returns a `Drift` for every
+    wallet that doesn't match.
+
+    Only the transactions after a wallet's latest snapshot are summed, and a new snapshot is recorded for every
+    wallet that has any. Snapshots hold the ledger's balance, not the cached one, so drift is flagged again on
+    the next run until it's fixed.
+
+    On PostgreSQL a transaction that commits after the run started but got its id before the run's last one is
+    left out of the snapshots, and shows up as drift from then on.
+    """
+    starts_transaction = not connection.in_atomic_block
+
+    with db_transaction.atomic():
+        if starts_transaction and connection.vendor == 'postgresql':
+            # wallets and transactions are written together, so they have to be read from the same snapshot
+            with connection.cursor() as cursor:
+                cursor.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ')
+
+        cached_balances = Wallet.objects.filter(pk__in=wallet_ids).values_list('pk', 'current_balance')
+        last_transaction_id = Transaction.objects.aggregate(last_id=Max('pk'))['last_id'] or 0
+        snapshots = {snapshot.wallet_id: snapshot for snapshot in get_latest_snapshots(wallet_ids)}
+        new_totals = sum_transactions_after_snapshots(wallet_ids, snapshots, last_transaction_id)
+
+        drifts = []
+        new_snapshots = []
+        for wallet_id, cached_balance in cached_balances:
+            snapshot = snapshots.get(wallet_id)
+            ledger_balance = snapshot.balance if snapshot else Money(0)
+
+            if wallet_id in new_totals:
+                ledger_balance += new_totals[wallet_id]
+                new_snapshots.append(WalletSnapshot(
+                    wallet_id=wallet_id,
+                    balance=ledger_balance,
+                    last_transaction_id=last_transaction_id,
+                    drift=cached_balance - ledger_balance,
+                ))
+
+            if cached_balance != ledger_balance:
+                drifts.append(Drift(wallet_id, cached_balance, ledger_balance))
+
+        WalletSnapshot.objects.bulk_create(new_snapshots)
+
+    return drifts
+
+
+def get_latest_snapshots(wallet_ids):
+    latest_ids = WalletSnapshot.objects.\
+        filter(wallet_id__in=wallet_ids).\
+        values('wallet_id').\
+        annotate(latest_id=Max('pk')).\
+        values('latest_id')
+
+    return WalletSnapshot.objects.filter(pk__in=latest_ids)
+
+
+def sum_transactions_after_snapshots(wallet_ids, snapshots, last_transaction_id):
+    """Sums the transactions of each wallet after its latest snapshot, up to `last_transaction_id`."""
+    wallet_ids_by_snapshot = defaultdict(list)
+    for wallet_id in wallet_ids:
+        snapshot = snapshots.get(wallet_id)
+        wallet_ids_by_snapshot[snapshot.last_transaction_id if snapshot else 0].append(wallet_id)
+
+    if not wallet_ids_by_snapshot:
+        return {}
+
+    # all snapshots of a run share the run's last transaction id, so there's a condition per run, not per wallet
+    after_snapshots = reduce(or_, (
+        Q(wallet_id__in=ids, pk__gt=snapshot_transaction_id)
+        for snapshot_transaction_id, ids in wallet_ids_by_snapshot.items()
+    ))
+    totals = Transaction.objects.\
+        filter(after_snapshots, pk__lte=last_transaction_id).\
+        values_list('wallet_id').\
+        annotate(total=Sum('amount'))
+
+    return dict(totals)
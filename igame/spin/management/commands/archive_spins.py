@@ -0,0 +1,33 @@
+import datetime
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from spin.history import archive_spins, drop_archived_months, month_start
+
+
+def month(value):
+    return datetime.datetime.strptime(value, '%Y-%m').replace(tzinfo=timezone.utc)
+
+
+class Command(BaseCommand):
+    help = 'Moves the spins of past months into the archive, optionally dropping old archived months. Only spins ' \
+           'reconciled by `reconcile_wallets` are moved, run it first.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--keep-months', type=int, default=3, help='Months of spins kept, this one included')
+        parser.add_argument('--drop-before', type=month, metavar='YYYY-MM',
+                            help='Also drops the archived months before this one')
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        before = month_start(timezone.now())
+        for _ in range(options['keep_months'] - 1):
+            before = month_start(before - datetime.timedelta(days=1))
+
+        archived = archive_spins(before, options['batch_size'])
+        self.stdout.write('Archived {} spins from before {:%Y-%m}'.format(archived, before))
+
+        if options['drop_before']:
+            drop_archived_months(options['drop_before'])
+            self.stdout.write('Dropped the archived spins from before {:%Y-%m}'.format(options['drop_before']))
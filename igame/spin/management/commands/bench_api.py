@@ -0,0 +1,59 @@
+import json
+import secrets
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext
+
+from spin.bench import percentile
+from spin.deposit import deposit_real_money
+from spin.models import ApiToken
+
+
+class Command(BaseCommand):
+    help = 'Compares spins and deposits through the HTML views, a redirect to and render of the dashboard each, ' \
+           'with the JSON API'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--samples', type=int, default=200)
+
+    def handle(self, *args, **options):
+        user = User.objects.create(username='bench-api-{}'.format(int(time.time())))
+        deposit_real_money(user, 10 * options['samples'])
+        api_token = ApiToken.objects.create(user=user, key=secrets.token_hex(20))
+
+        html_client = Client()
+        html_client.force_login(user)
+        api_client = Client(HTTP_AUTHORIZATION='Token {}'.format(api_token.key))
+
+        def api_post(url, data):
+            return lambda: api_client.post(url, json.dumps(data), content_type='application/json')
+
+        with override_settings(ALLOWED_HOSTS=['testserver'], REQUEST_METRICS_SAMPLE_RATE=0):
+            self.report('html spin', lambda: html_client.get('/play/', follow=True), options['samples'])
+            self.report('api spin', api_post('/api/spin', {}), options['samples'])
+            self.report('html deposit', lambda: html_client.post('/dashboard/', {'amount': '1'}), options['samples'])
+            self.report('api deposit', api_post('/api/deposit', {'amount': '1'}), options['samples'])
+            self.report('html wallets', lambda: html_client.get('/dashboard/'), options['samples'])
+            self.report('api wallets', lambda: api_client.get('/api/wallets'), options['samples'])
+
+    def report(self, name, send, samples):
+        latencies = []
+        queries = 0
+
+        for _ in range(samples):
+            with CaptureQueriesContext(connection) as captured:
+                start = time.perf_counter()
+                response = send()
+                latencies.append((time.perf_counter() - start) * 1000)
+            if response.status_code != 200:
+                raise CommandError('{} failed with {}: {}'.format(name, response.status_code, response.content))
+            queries += len(captured)
+
+        latencies.sort()
+        self.stdout.write('{}: p50 {:.2f} ms, p95 {:.2f} ms, {:.1f} queries'.format(
+            name, percentile(latencies, 50), percentile(latencies, 95), queries / samples
+        ))
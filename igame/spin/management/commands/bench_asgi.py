@@ -0,0 +1,223 @@
+import asyncio
+from collections import Counter
+from contextlib import contextmanager
+import os
+import re
+import secrets
+import socket
+import subprocess
+import sys
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from spin.bench import percentile, seed_users
+from spin.deposit import deposit_real_money
+from spin.models import ApiToken
+
+
+CONTENT_LENGTH = re.compile(rb'^content-length:\s*(\d+)', re.IGNORECASE | re.MULTILINE)
+
+
+def get_server_command(server, port, processes):
+    if server == 'wsgi':
+        return [
+            sys.executable, '-m', 'gunicorn', 'igame.wsgi:application', '--bind', '127.0.0.1:{}'.format(port),
+            '--worker-class', 'gthread', '--workers', str(processes), '--threads', str(settings.ASGI_DB_THREADS),
+            '--log-level', 'warning',
+        ]
+
+    return [
+        sys.executable, '-m', 'uvicorn', 'igame.asgi:application', '--port', str(port),
+        '--workers', str(processes), '--log-level', 'warning', '--no-access-log',
+    ]
+
+
+class Connection:
+    """A keep-alive HTTP/1.1 connection to the benchmarked server, for JSON requests with a token."""
+
+    def __init__(self, reader, writer, key):
+        self.reader = reader
+        self.writer = writer
+        self.key = key
+
+    @classmethod
+    async def open(cls, port, key):
+        return cls(*await asyncio.open_connection('127.0.0.1', port), key)
+
+    async def send(self, method, path, body=b''):
+        self.writer.write(
+            '{} {} HTTP/1.1\r\nHost: 127.0.0.1\r\nAuthorization: Token {}\r\nContent-Type: application/json\r\n'
+            'Content-Length: {}\r\n\r\n'.format(method, path, self.key, len(body)).encode('latin1') + body
+        )
+        return await self.reader.readuntil(b'\r\n\r\n')
+
+    async def request(self, method, path, body=b''):
+        head = await self.send(method, path, body)
+        content_length = CONTENT_LENGTH.search(head)
+        if content_length is None:
+            raise CommandError('Got a response without Content-Length: {}'.format(head.decode('latin1')))
+
+        body = await self.reader.readexactly(int(content_length.group(1)))
+        return int(head.split(b' ', 2)[1]), body
+
+    async def events(self, path):
+        """Yields the data of the server-sent events of the stream at `path`, its body is chunked."""
+        head = await self.send('GET', path)
+        if not head.startswith(b'HTTP/1.1 200'):
+            raise CommandError('Could not open the stream: {}'.format(head.decode('latin1')))
+
+        received = b''
+        while True:
+            size = int((await self.reader.readline()).strip(), 16)
+            received += (await self.reader.readexactly(size + 2))[:-2]
+            while b'\n\n' in received:
+                event, received = received.split(b'\n\n', 1)
+                if event.startswith(b'event:'):
+                    yield event.split(b'data: ', 1)[1]
+
+    def close(self):
+        self.writer.close()
+
+
+class Command(BaseCommand):
+    help = 'Serves the app with gunicorn(WSGI, ASGI_DB_THREADS threads per process) and uvicorn(ASGI, ' \
+           'ASGI_DB_THREADS database threads per process) with the same number of processes, and has --spinners ' \
+           'clients spin as fast as they can while --watchers clients follow their balances. On WSGI watchers ' \
+           'get /api/wallets every --poll-seconds, on ASGI they stream /api/wallets/stream or long poll ' \
+           '/api/wallets/poll. ' \
+           'The first watchers follow the spinners, the others idle users. Reports spins per second, spin ' \
+           'latencies and the balance changes watchers saw.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=1, help='Worker processes, use one per core')
+        parser.add_argument('--spinners', type=int, default=20)
+        parser.add_argument('--watchers', default='0,1000', help='Number of watchers, or a comma separated list')
+        parser.add_argument('--seconds', type=float, default=10)
+        parser.add_argument('--poll-seconds', type=float, default=1, help='How often WSGI watchers get the wallets')
+        parser.add_argument('--asgi-watchers', choices=('stream', 'long-poll'), default='stream')
+        parser.add_argument('--port', type=int, default=8700)
+
+    def handle(self, *args, **options):
+        watcher_counts = [int(watchers) for watchers in options['watchers'].split(',')]
+        prefix = 'bench-asgi-{}-'.format(int(time.time()))
+        spinner_ids = seed_users(options['spinners'], username_prefix=prefix + 'spinner-')
+        idle_ids = seed_users(max(watcher_counts), username_prefix=prefix + 'idle-')
+        for user in User.objects.filter(pk__in=spinner_ids):
+            deposit_real_money(user, 1000000)
+
+        keys = {user_id: secrets.token_hex(20) for user_id in spinner_ids + idle_ids}
+        ApiToken.objects.bulk_create([ApiToken(user_id=user_id, key=key) for user_id, key in keys.items()])
+        spinner_keys = [keys[user_id] for user_id in spinner_ids]
+        watched_keys = spinner_keys + [keys[user_id] for user_id in idle_ids]
+
+        for server, watching in (('wsgi', 'poll'), ('asgi', options['asgi_watchers'])):
+            for watchers in watcher_counts:
+                with self.serve(server, options['port'], options['processes']):
+                    latencies, counts = asyncio.get_event_loop().run_until_complete(self.run(
+                        options['port'], spinner_keys, watched_keys[:watchers], options['seconds'], watching,
+                        options['poll_seconds'],
+                    ))
+
+                latencies.sort()
+                self.stdout.write(
+                    '{} with {} watchers({}): {:.1f} spins/s, p50 {:.1f} ms, p95 {:.1f} ms, {} failed; '
+                    'watchers got {} answers or events with {} balance changes'.format(
+                        server, watchers, watching, len(latencies) / options['seconds'], percentile(latencies, 50),
+                        percentile(latencies, 95), counts['failed'], counts['watcher answers'],
+                        counts['changes seen'],
+                    )
+                )
+
+    @contextmanager
+    def serve(self, server, port, processes):
+        # click, which uvicorn uses, refuses to start with an ASCII locale on Python 3.6
+        environment = dict({'LC_ALL': 'C.UTF-8', 'LANG': 'C.UTF-8'}, **os.environ)
+        process = subprocess.Popen(
+            get_server_command(server, port, processes), cwd=settings.BASE_DIR, env=environment,
+        )
+        try:
+            self.wait_for_port(process, port)
+            yield
+        finally:
+            process.terminate()
+            process.wait()
+
+    def wait_for_port(self, process, port):
+        deadline = time.perf_counter() + 30
+        while time.perf_counter() < deadline:
+            if process.poll() is not None:
+                raise CommandError('The server exited with {}'.format(process.returncode))
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=1).close()
+                return
+            except OSError:
+                time.sleep(0.1)
+
+        raise CommandError('The server did not start listening on port {}'.format(port))
+
+    async def run(self, port, spinner_keys, watched_keys, seconds, watching, poll_seconds):
+        """Starts the watchers, and once each got its first answer has the spinners spin for `seconds`."""
+        loop = asyncio.get_event_loop()
+        latencies = []
+        counts = Counter()
+
+        async def spin(key, deadline):
+            connection = await Connection.open(port, key)
+            try:
+                while loop.time() < deadline:
+                    start = time.perf_counter()
+                    status, _ = await connection.request('POST', '/api/spin', b'{}')
+                    if status == 200:
+                        latencies.append((time.perf_counter() - start) * 1000)
+                    else:
+                        counts['failed'] += 1
+            finally:
+                connection.close()
+
+        async def get_wallets(connection):
+            state = None
+            while True:
+                if watching == 'long-poll':
+                    _, body = await connection.request('GET', '/api/wallets/poll?since={}'.format(state or ''))
+                    state = re.search(rb'"state": "([^"]*)"', body).group(1).decode('latin1')
+                    yield body
+                else:
+                    yield (await connection.request('GET', '/api/wallets'))[1]
+                    await asyncio.sleep(poll_seconds)
+
+        async def watch(key, started):
+            connection = await Connection.open(port, key)
+            previous = None
+            answers = connection.events('/api/wallets/stream') if watching == 'stream' else get_wallets(connection)
+            try:
+                async for body in answers:
+                    if not started.done():
+                        started.set_result(None)
+                    else:
+                        counts['watcher answers'] += 1
+                        counts['changes seen'] += body != previous
+                    previous = body
+            finally:
+                connection.close()
+
+        # several games load the users' money spent for wagering into the server's counters, single games expect it
+        # there and the in-process counters start empty
+        for key in spinner_keys:
+            connection = await Connection.open(port, key)
+            await connection.request('POST', '/api/spin', b'{"games": 2}')
+            connection.close()
+
+        started = [loop.create_future() for _ in watched_keys]
+        watchers = [loop.create_task(watch(key, first)) for key, first in zip(watched_keys, started)]
+        await asyncio.gather(*started)
+
+        deadline = loop.time() + seconds
+        await asyncio.gather(*[spin(key, deadline) for key in spinner_keys])
+        for watcher in watchers:
+            watcher.cancel()
+        await asyncio.gather(*watchers, return_exceptions=True)
+
+        return latencies, counts
@@ -0,0 +1,46 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+
+from spin.bench import percentile, seed_users, time_calls
+from spin.game import play_game
+from spin.models import BonusGrant, Game
+from spin.money import Money
+from spin.wagering import MoneySpentForWagering, transfer_eligible_bonuses_to_real_money_wallet
+from spin.wallets import get_user_wallets, invalidate_user_wallets
+
+
+class Command(BaseCommand):
+    help = 'Times loading the wallets, spinning and wagering for a user holding many bonuses'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--bonuses', type=int, default=10000)
+        parser.add_argument('--samples', type=int, default=200)
+
+    def handle(self, *args, **options):
+        user_id, = seed_users(1, bonuses_per_user=options['bonuses'], username_prefix='bench-bonuses-{}-'.format(
+            User.objects.order_by('-pk').values_list('pk', flat=True).first() or 0
+        ))
+        user = User.objects.get(pk=user_id)
+        # nothing can be wagered, so every transfer walks the grants without writing
+        MoneySpentForWagering(user_id).set(0)
+        samples = [(user,)] * options['samples']
+
+        self.report('load wallets', self.load_wallets, samples)
+        self.report('wagering', transfer_eligible_bonuses_to_real_money_wallet, samples)
+        # games are won and lost in turns, so the bonuses don't run out
+        self.report('spin', play_game, [(user, [Game.WON, Game.LOST][number % 2], Money(1)) for number in range(
+            options['samples']
+        )])
+        self.stdout.write('{} bonuses, {} with a balance'.format(
+            options['bonuses'], BonusGrant.objects.filter(wallet__user_id=user_id, balance__gt=0).count()
+        ))
+
+    def load_wallets(self, user):
+        invalidate_user_wallets(user)
+        return get_user_wallets(user).bonus
+
+    def report(self, name, func, samples):
+        latencies = time_calls(func, samples)
+        self.stdout.write('{}: p50 {:.3f} ms, p95 {:.3f} ms, p99 {:.3f} ms'.format(
+            name, percentile(latencies, 50), percentile(latencies, 95), percentile(latencies, 99)
+        ))
@@ -0,0 +1,64 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from spin.bench import percentile, seed_users, time_calls
+from spin.bonus import BonusContext, give_bonuses, handle_bonus_event
+from spin.bonus_types import get_bonus_rules, invalidate_bonus_types
+from spin.bulk import bulk_create_with_ids
+from spin.models import BonusType
+from spin.money import Money
+
+
+class Command(BaseCommand):
+    help = 'Times the bonuses of a deposit with many active deposit bonus rules, given at once and one rule at a time'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rules', type=int, default=50)
+        parser.add_argument('--samples', type=int, default=200)
+
+    def handle(self, *args, **options):
+        bonus_types = bulk_create_with_ids(BonusType, [
+            BonusType(event=BonusType.REAL_MONEY_DEPOSIT, amount=Money(1), min_deposit_amount=Money(number))
+            for number in range(options['rules'])
+        ])
+        # bulk_create doesn't send post_save, which reloads the bonus types
+        invalidate_bonus_types()
+        user_id, = seed_users(1, username_prefix='bench-rules-{}-'.format(
+            User.objects.order_by('-pk').values_list('pk', flat=True).first() or 0
+        ))
+        user = User.objects.get(pk=user_id)
+        deposit_amount = Money(options['rules'])
+        context = BonusContext(user, deposit_amount=deposit_amount)
+        rules = get_bonus_rules(BonusType.REAL_MONEY_DEPOSIT)
+        samples = [(user, deposit_amount)] * options['samples']
+
+        try:
+            self.report('one pass', self.one_pass, samples)
+            self.report('rule by rule', self.rule_by_rule, samples)
+            self.stdout.write('{} active rules, {} give a bonus for a deposit of {}'.format(
+                len(rules), sum(1 for rule, bonus_type in rules if rule(context, bonus_type)), deposit_amount,
+            ))
+        finally:
+            # deleting them would delete the bonuses given with them too
+            BonusType.objects.filter(pk__in=[bonus_type.pk for bonus_type in bonus_types]).update(active=False)
+            invalidate_bonus_types()
+
+    def one_pass(self, user, deposit_amount):
+        handle_bonus_event(BonusType.REAL_MONEY_DEPOSIT, user, deposit_amount=deposit_amount)
+
+    def rule_by_rule(self, user, deposit_amount):
+        """The way bonuses used to be given, every rule with its own context and database transaction."""
+        for rule, bonus_type in get_bonus_rules(BonusType.REAL_MONEY_DEPOSIT):
+            bonus = rule(BonusContext(user, deposit_amount=deposit_amount), bonus_type)
+            if bonus is not None:
+                give_bonuses(user, [bonus])
+
+    def report(self, name, func, samples):
+        with CaptureQueriesContext(connection) as queries:
+            func(*samples[0])
+        latencies = time_calls(func, samples)
+        self.stdout.write('{}: p50 {:.3f} ms, p95 {:.3f} ms, p99 {:.3f} ms, {} queries'.format(
+            name, percentile(latencies, 50), percentile(latencies, 95), percentile(latencies, 99), len(queries)
+        ))
@@ -0,0 +1,63 @@
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction as db_transaction
+
+from spin.bench import percentile, time_calls
+
+
+# the column types money had before and after it was moved to cents
+TABLES = {
+    'decimal': ('bench_money_decimal', 'NUMERIC(12, 2)', '(n %% 100000) / 100.0'),
+    'cents': ('bench_money_cents', 'BIGINT', 'n %% 100000'),
+}
+
+
+class Command(BaseCommand):
+    help = 'Compares SUMs over a decimal money column with SUMs over a column of cents'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=10000000)
+        parser.add_argument('--samples', type=int, default=10)
+        parser.add_argument('--keep', action='store_true', help="Don't drop the scratch tables afterwards")
+
+    def handle(self, *args, **options):
+        with connection.cursor() as cursor:
+            for name, (table, column_type, value) in TABLES.items():
+                self.create_table(cursor, table, column_type, value, options['rows'])
+
+            try:
+                for name, (table, _, _) in TABLES.items():
+                    latencies = time_calls(self.sum, [(cursor, table)] * options['samples'])
+                    self.stdout.write('{}: SUM of {} rows p50 {:.1f} ms, p95 {:.1f} ms{}'.format(
+                        name, options['rows'], percentile(latencies, 50), percentile(latencies, 95),
+                        self.table_size(cursor, table),
+                    ))
+            finally:
+                if not options['keep']:
+                    for table, _, _ in TABLES.values():
+                        cursor.execute('DROP TABLE {}'.format(table))
+
+    def create_table(self, cursor, table, column_type, value, rows):
+        if connection.vendor == 'postgresql':
+            numbers = 'SELECT n FROM generate_series(1, %s) AS n'
+        else:
+            numbers = 'WITH RECURSIVE numbers(n) AS (SELECT 1 UNION ALL SELECT n + 1 FROM numbers WHERE n < %s) ' \
+                      'SELECT n FROM numbers'
+
+        with db_transaction.atomic():
+            cursor.execute('DROP TABLE IF EXISTS {}'.format(table))
+            cursor.execute('CREATE TABLE {} (amount {} NOT NULL)'.format(table, column_type))
+            cursor.execute('INSERT INTO {} (amount) SELECT {} FROM ({}) AS numbers'.format(table, value, numbers), [rows])
+
+        if connection.vendor == 'postgresql':
+            cursor.execute('VACUUM ANALYZE {}'.format(table))
+
+    def sum(self, cursor, table):
+        cursor.execute('SELECT SUM(amount) FROM {}'.format(table))
+        return cursor.fetchone()
+
+    def table_size(self, cursor, table):
+        if connection.vendor != 'postgresql':
+            return ''
+
+        cursor.execute('SELECT pg_size_pretty(pg_total_relation_size(%s))', [table])
+        return ', table size {}'.format(cursor.fetchone()[0])
@@ -0,0 +1,56 @@
+import random
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import transaction as db_transaction
+
+from spin.models import Game
+from spin.outcomes import BufferedOutcomes, SeededUserOutcomes, SystemRandomOutcomes, replay_outcomes
+
+
+class MersenneTwisterOutcomes:
+    """How outcomes were drawn before `spin.outcomes`, for comparison."""
+
+    def draw(self, user, count):
+        return [random.choice([Game.LOST, Game.WON]) for _ in range(count)], None
+
+
+class Command(BaseCommand):
+    help = 'Reports how many outcomes per second each generator of spin.outcomes draws, --draws at a time. The ' \
+           'seeded streams move their position in a database transaction per draw, like a spin does. Also reports ' \
+           'how fast a seeded stream is replayed.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--outcomes', type=int, default=100000, help='Outcomes drawn per generator and size')
+        parser.add_argument('--draws', default='1,100', help='Outcomes drawn at a time, a comma separated list')
+        parser.add_argument('--block-size', type=int, default=4096)
+
+    def handle(self, *args, **options):
+        user = User.objects.create(username='bench-outcomes-{}'.format(int(time.time())))
+        generators = {
+            'mersenne twister': MersenneTwisterOutcomes(),
+            'system random': SystemRandomOutcomes(),
+            'buffered': BufferedOutcomes(block_size=options['block_size']),
+            'seeded per user': SeededUserOutcomes(),
+        }
+
+        for size in [int(size) for size in options['draws'].split(',')]:
+            draws = max(options['outcomes'] // size, 1)
+            for name, generator in generators.items():
+                # the seeded stream is created by the first draw
+                generator.draw(user, size)
+
+                start = time.perf_counter()
+                for _ in range(draws):
+                    with db_transaction.atomic():
+                        generator.draw(user, size)
+                seconds = time.perf_counter() - start
+
+                self.stdout.write('{}, {} at a time: {:.0f} outcomes/s'.format(name, size, draws * size / seconds))
+
+        start = time.perf_counter()
+        replayed = replay_outcomes(user)
+        self.stdout.write('replaying a seeded stream: {:.0f} outcomes/s'.format(
+            len(replayed) / (time.perf_counter() - start)
+        ))
@@ -0,0 +1,140 @@
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import json
+import time
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from spin.bench import percentile
+from spin.bonus import create_default_bonus_types
+from spin.models import BonusType
+
+
+PASSWORD = 'bench-password'
+OPERATIONS = ('login', 'deposit', 'play', 'dashboard')
+
+
+class Command(BaseCommand):
+    help = 'Has users log in, deposit, play and load the dashboard through the test client from a pool of threads ' \
+           'and reports latencies, spins per second and queries per operation. With several thread counts, ' \
+           'e.g. --threads 1,2,4,8, it runs once per count with new users, to show how throughput scales. ' \
+           'SQLite fails requests with "database is locked" under concurrency, they are counted as errors.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=50)
+        parser.add_argument('--threads', default='8', help='Number of threads, or a comma separated list of them')
+        parser.add_argument('--rounds', type=int, default=20, help='Deposits, spins and dashboards per user')
+        parser.add_argument('--deposit', default='10')
+        parser.add_argument('--json', metavar='PATH', help='Also write the results as JSON to PATH, - for stdout. '
+                                                           'It is a list of the runs with several thread counts')
+
+    def handle(self, *args, **options):
+        if not BonusType.objects.exists():
+            create_default_bonus_types()
+
+        runs = [self.run(int(threads), options) for threads in options['threads'].split(',')]
+        if len(runs) > 1:
+            self.stdout.write('spins/s by threads: ' + ', '.join(
+                '{}: {:.1f}'.format(results['threads'], results['spins_per_second']) for results in runs
+            ))
+
+        results = runs[0] if len(runs) == 1 else runs
+        if options['json'] == '-':
+            self.stdout.write(json.dumps(results, indent=2, sort_keys=True))
+        elif options['json']:
+            with open(options['json'], 'w') as json_file:
+                json.dump(results, json_file, indent=2, sort_keys=True)
+
+    def run(self, threads, options):
+        # users go through `user_setup` like signed up ones, but share one hash so setup isn't spent on PBKDF2
+        password = make_password(PASSWORD)
+        prefix = 'bench-spin-{}-{}-'.format(int(time.time()), threads)
+        usernames = ['{}{}'.format(prefix, number) for number in range(options['users'])]
+        for username in usernames:
+            User.objects.create(username=username, password=password)
+
+        with override_settings(ALLOWED_HOSTS=['testserver']):
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=threads) as pool:
+                user_samples = list(pool.map(
+                    lambda username: self.run_user(username, options['rounds'], options['deposit']), usernames
+                ))
+            elapsed = time.perf_counter() - start
+
+        results = self.summarize([sample for samples in user_samples for sample in samples], elapsed, threads, options)
+        self.stdout.write('{} threads:'.format(threads))
+        for name, operation in results['operations'].items():
+            self.stdout.write(
+                '{}: {} requests, {} errors, p50 {:.1f} ms, p95 {:.1f} ms, p99 {:.1f} ms, {:.1f} queries'.format(
+                    name, operation['requests'], operation['errors'], operation['p50_ms'], operation['p95_ms'],
+                    operation['p99_ms'], operation['queries_per_request'],
+                )
+            )
+        self.stdout.write('{:.1f} spins/s over {:.1f} s'.format(results['spins_per_second'], elapsed))
+        return results
+
+    def run_user(self, username, rounds, deposit):
+        """Runs one user's requests and returns (operation, milliseconds, queries, succeeded) for each."""
+        client = Client()
+        samples = []
+
+        def request(operation, send):
+            with CaptureQueriesContext(connection) as queries:
+                start = time.perf_counter()
+                try:
+                    succeeded = send().status_code < 400
+                # the test client re-raises the view's exception, which can also be another thread's
+                except Exception:
+                    succeeded = False
+                milliseconds = (time.perf_counter() - start) * 1000
+            samples.append((operation, milliseconds, len(queries), succeeded))
+            return succeeded
+
+        try:
+            # the spin views don't require a login, a user who isn't logged in would only measure failures
+            if not request('login', lambda: client.post(reverse('login'), {'username': username, 'password': PASSWORD})):
+                return samples
+
+            for _ in range(rounds):
+                request('deposit', lambda: client.post(reverse('dashboard'), {'amount': deposit}))
+                request('play', lambda: client.get(reverse('play')))
+                request('dashboard', lambda: client.get(reverse('dashboard')))
+        finally:
+            connection.close()
+
+        return samples
+
+    def summarize(self, samples, elapsed, threads, options):
+        by_operation = defaultdict(list)
+        for operation, milliseconds, queries, succeeded in samples:
+            by_operation[operation].append((milliseconds, queries, succeeded))
+
+        operations = {}
+        for name in OPERATIONS:
+            operation_samples = by_operation[name]
+            latencies = sorted(milliseconds for milliseconds, _, _ in operation_samples)
+            operations[name] = {
+                'requests': len(operation_samples),
+                'errors': sum(1 for _, _, succeeded in operation_samples if not succeeded),
+                'p50_ms': percentile(latencies, 50),
+                'p95_ms': percentile(latencies, 95),
+                'p99_ms': percentile(latencies, 99),
+                'queries_per_request': sum(queries for _, queries, _ in operation_samples) / max(len(latencies), 1),
+            }
+
+        spins = operations['play']['requests'] - operations['play']['errors']
+        return {
+            'database': connection.vendor,
+            'users': options['users'],
+            'threads': threads,
+            'rounds': options['rounds'],
+            'elapsed_seconds': elapsed,
+            'spins_per_second': spins / elapsed,
+            'operations': operations,
+        }
@@ -0,0 +1,108 @@
+from collections import Counter
+import threading
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, DatabaseError
+from django.test import override_settings
+
+from spin.bench import seed_users
+from spin.constants import SPIN_APP_SETTINGS as app_settings
+from spin.deposit import deposit_real_money
+from spin.game import play_game
+from spin.models import Game
+from spin.money import Money
+from spin.wagering import set_money_spent_totals
+from spin.wallets import get_user_wallets, invalidate_user_wallets
+
+
+ROLLBACK_JOURNAL = {'journal_mode': 'delete'}
+PHASES = (
+    ('rollback journal', ROLLBACK_JOURNAL, 1),
+    ('rollback journal, retries', ROLLBACK_JOURNAL, app_settings['DATABASE_LOCKED_ATTEMPTS']),
+    ('tuned pragmas, retries', settings.SQLITE_TUNED_PRAGMAS, app_settings['DATABASE_LOCKED_ATTEMPTS']),
+)
+
+
+class Command(BaseCommand):
+    help = 'Has writer threads deposit and play while reader threads load wallets like the dashboard, with the ' \
+           'default rollback journal, with retries of locked writes and with SQLITE_TUNED_PRAGMAS, and reports ' \
+           'reads and writes per second. It leaves the database in WAL mode.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--writers', type=int, default=4)
+        parser.add_argument('--readers', type=int, default=4)
+        parser.add_argument('--seconds', type=float, default=5)
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'sqlite':
+            raise CommandError('bench_sqlite only runs on SQLite')
+
+        user_ids = seed_users(
+            options['writers'] + options['readers'], transactions_per_user=0,
+            username_prefix='bench-sqlite-{}-'.format(int(time.time())),
+        )
+        writer_ids, reader_ids = user_ids[:options['writers']], user_ids[options['writers']:]
+        set_money_spent_totals({user_id: Money(0) for user_id in writer_ids})
+        for user in User.objects.filter(pk__in=reader_ids):
+            deposit_real_money(user, 10)
+
+        for name, pragmas, attempts in PHASES:
+            with override_settings(SQLITE_PRAGMAS=pragmas):
+                # the journal mode is switched by the first connection, while no other one is open
+                connection.close()
+                connection.ensure_connection()
+                app_settings['DATABASE_LOCKED_ATTEMPTS'], default_attempts = \
+                    attempts, app_settings['DATABASE_LOCKED_ATTEMPTS']
+                try:
+                    results = self.run(writer_ids, reader_ids, options['seconds'])
+                finally:
+                    app_settings['DATABASE_LOCKED_ATTEMPTS'] = default_attempts
+                connection.close()
+
+            self.stdout.write('{}: {:.0f} deposits and spins/s, {} locked; {:.0f} reads/s, {} locked'.format(
+                name, results['writes'] / options['seconds'], results['locked writes'],
+                results['reads'] / options['seconds'], results['locked reads'],
+            ))
+
+    def run(self, writer_ids, reader_ids, seconds):
+        results = Counter()
+        lock = threading.Lock()
+        deadline = time.perf_counter() + seconds
+
+        def worker(user_id, operation, kind):
+            user = User.objects.get(pk=user_id)
+            counts = Counter()
+
+            try:
+                while time.perf_counter() < deadline:
+                    try:
+                        operation(user)
+                        counts[kind] += 1
+                    except DatabaseError:
+                        counts['locked ' + kind] += 1
+            finally:
+                connection.close()
+
+            with lock:
+                results.update(counts)
+
+        threads = [threading.Thread(target=worker, args=(user_id, self.write, 'writes')) for user_id in writer_ids] + \
+                  [threading.Thread(target=worker, args=(user_id, self.read, 'reads')) for user_id in reader_ids]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        return results
+
+    def write(self, user):
+        deposit_real_money(user, 1)
+        play_game(user, Game.LOST, 1)
+
+    def read(self, user):
+        invalidate_user_wallets(user)
+        wallets = get_user_wallets(user)
+        wallets.real_money.transactions.count()
@@ -0,0 +1,69 @@
+import random
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+
+from spin.bench import explain, fetch_all, percentile, seed_users, time_calls
+from spin.models import BonusGrant, Transaction, Wallet
+from spin.wagering import calculate_money_spent_totals
+
+
+USERNAME_PREFIX = 'bench-user-'
+
+QUERIES = {
+    'user wallets': lambda user_id: Wallet.objects.filter(user_id=user_id).order_by('-money_type', 'id'),
+    'wallet for game': lambda user_id: Wallet.objects.
+        filter(user_id=user_id, current_balance__gte=2).order_by('-money_type', 'id')[:1],
+    'positive bonus grants': lambda user_id: BonusGrant.objects.
+        filter(wallet__user_id=user_id, wallet__money_type=Wallet.BONUS, balance__gt=0).order_by('balance', 'id'),
+    'latest transactions': lambda user_id: Transaction.objects.
+        filter(wallet__user_id=user_id, wallet__money_type=Wallet.REAL_MONEY).order_by('-created_at')[:20],
+}
+
+
+class Command(BaseCommand):
+    help = 'Shows query plans and latencies of the hot wallet and transaction queries'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--seed', action='store_true', help='Create the benchmark users first')
+        parser.add_argument('--users', type=int, default=100000)
+        parser.add_argument('--bonuses-per-user', type=int, default=5)
+        parser.add_argument('--transactions-per-user', type=int, default=100)
+        parser.add_argument('--samples', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        if options['seed']:
+            seed_users(
+                options['users'],
+                bonuses_per_user=options['bonuses_per_user'],
+                transactions_per_user=options['transactions_per_user'],
+                username_prefix=USERNAME_PREFIX,
+            )
+
+        user_ids = list(User.objects.filter(username__startswith=USERNAME_PREFIX).values_list('pk', flat=True))
+        if not user_ids:
+            self.stderr.write('There are no benchmark users, run with --seed first')
+            return
+
+        sample = [(random.choice(user_ids),) for _ in range(options['samples'])]
+        self.stdout.write('{} users, {} wallets, {} transactions'.format(
+            len(user_ids), Wallet.objects.count(), Transaction.objects.count()
+        ))
+
+        for name, query in QUERIES.items():
+            self.report(name, lambda user_id: fetch_all(query(user_id)), sample, explain(query(user_ids[0])))
+
+        self.report(
+            'money spent for wagering',
+            lambda user_id: calculate_money_spent_totals([user_id]),
+            sample,
+            [],
+        )
+
+    def report(self, name, func, sample, plan):
+        latencies = time_calls(func, sample)
+        self.stdout.write('\n{}: p50 {:.3f} ms, p95 {:.3f} ms, p99 {:.3f} ms'.format(
+            name, percentile(latencies, 50), percentile(latencies, 95), percentile(latencies, 99)
+        ))
+        for line in plan:
+            self.stdout.write('    ' + line)
@@ -0,0 +1,28 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from spin.outbox import drain_outbox
+
+
+class Command(BaseCommand):
+    help = 'Does the bonus and wagering work that spins and deposits left in the outbox'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--interval', type=float, default=1.0, help='Seconds to wait when the outbox is empty')
+        parser.add_argument('--once', action='store_true', help='Stop once the outbox is empty')
+
+    def handle(self, *args, **options):
+        drained = 0
+
+        while True:
+            batch = drain_outbox(options['batch_size'])
+            drained += batch
+
+            if batch < options['batch_size']:
+                if options['once']:
+                    break
+                time.sleep(options['interval'])
+
+        self.stdout.write('Drained {} events'.format(drained))
@@ -1,19 +1,53 @@
-from decimal import Decimal
+import time
 
+from django.contrib.auth.hashers import make_password
 from django.contrib.auth.models import User
 from django.core.management.base import BaseCommand
 
+from spin.bench import seed_users
 from spin.bonus import create_default_bonus_types
 from spin.constants import SPIN_APP_SETTINGS as app_settings
 from spin.deposit import deposit_real_money
-from spin.models import Wallet
+from spin.models import BonusType
+from spin.money import Money
+from spin.wagering import set_money_spent_totals
 
 
 class Command(BaseCommand):
+    help = 'Creates the bonus types and the test user, or with --users that many users for capacity testing'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=0)
+        parser.add_argument('--transactions-per-user', type=int, default=0)
+        parser.add_argument('--username-prefix', default='user-')
+        parser.add_argument('--password', default='PassworD', help='The password of every user')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Users inserted per database transaction')
 
     def handle(self, *args, **options):
-        user = User.objects.create(username='test-user')
-        user.set_password('PassworD')
-        user.save()
-        deposit_real_money(user, app_settings['TEST_USER_BEGINNING_BALANCE'])
-        create_default_bonus_types()
+        if not options['users']:
+            user = User.objects.create(username='test-user')
+            user.set_password('PassworD')
+            user.save()
+            deposit_real_money(user, app_settings['TEST_USER_BEGINNING_BALANCE'])
+            create_default_bonus_types()
+            return
+
+        if not BonusType.objects.exists():
+            create_default_bonus_types()
+
+        start = time.perf_counter()
+        # hashing is the slowest part of creating a user, and every user has the same password
+        user_ids = seed_users(
+            options['users'],
+            transactions_per_user=options['transactions_per_user'],
+            username_prefix=options['username_prefix'],
+            password=make_password(options['password']),
+            batch_size=options['batch_size'],
+        )
+        # the new users haven't lost any games yet
+        for first in range(0, len(user_ids), options['batch_size']):
+            set_money_spent_totals({user_id: Money(0) for user_id in user_ids[first:first + options['batch_size']]})
+
+        self.stdout.write('Created {} users with {} transactions each in {:.1f} s'.format(
+            len(user_ids), options['transactions_per_user'], time.perf_counter() - start
+        ))
@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand
+
+from spin.ledger import reconcile_wallets
+from spin.models import Wallet
+
+
+class Command(BaseCommand):
+    help = 'Checks the cached balance of every wallet against the transactions since its latest snapshot'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        wallets = Wallet.objects.order_by('pk')
+        last_wallet_id = 0
+        checked = 0
+        drifted = 0
+
+        while True:
+            wallet_ids = list(wallets.filter(pk__gt=last_wallet_id).values_list('pk', flat=True)[:options['batch_size']])
+            if not wallet_ids:
+                break
+
+            for drift in reconcile_wallets(wallet_ids):
+                self.stdout.write('Wallet {}: cached balance {}, ledger balance {}'.format(*drift))
+                drifted += 1
+
+            last_wallet_id = wallet_ids[-1]
+            checked += len(wallet_ids)
+
+        self.stdout.write('Checked {} wallets, {} drifted'.format(checked, drifted))
@@ -0,0 +1,41 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from spin.history import get_user_drawn_outcomes
+from spin.models import OutcomeStream
+from spin.outcomes import replay_outcomes
+
+
+class Command(BaseCommand):
+    help = "Recomputes a user's outcomes from the seed of their stream and checks them against the user's spins, " \
+           "archived ones included. Positions without a spin were drawn for games the user couldn't afford."
+
+    def add_arguments(self, parser):
+        parser.add_argument('username')
+        parser.add_argument('--start', type=int, default=0, help='Position of the first outcome')
+        parser.add_argument('--count', type=int, help='Number of outcomes, all drawn so far by default')
+        parser.add_argument('--win-probability', type=float,
+                            help="The generator's at the time of the spins, the configured one by default")
+        parser.add_argument('--quiet', action='store_true', help='Only lists the mismatches')
+
+    def handle(self, *args, **options):
+        try:
+            user = User.objects.get(username=options['username'])
+            replayed = replay_outcomes(user, options['start'], options['count'], options['win_probability'])
+        except (User.DoesNotExist, OutcomeStream.DoesNotExist):
+            raise CommandError('{} has no outcome stream'.format(options['username']))
+
+        played = get_user_drawn_outcomes(user)
+        mismatches = 0
+
+        for position, number, outcome in replayed:
+            spin = played.get(position)
+            if spin is not None and spin != outcome:
+                mismatches += 1
+                self.stdout.write('{}: {} is {}, the spin was {}'.format(position, number, outcome, spin))
+            elif not options['quiet']:
+                self.stdout.write('{}: {} is {}{}'.format(position, number, outcome, '' if spin else ', not played'))
+
+        self.stdout.write('Replayed {} outcomes, {} played, {} mismatched'.format(
+            len(replayed), sum(position in played for position, _, _ in replayed), mismatches
+        ))
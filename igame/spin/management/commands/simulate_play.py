@@ -0,0 +1,113 @@
+from contextlib import contextmanager
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from spin.constants import SPIN_APP_SETTINGS as app_settings
+from spin.money import Money
+from spin.simulation import check_against_orm, get_plan, simulate
+
+
+# the options that override `SPIN_APP_SETTINGS` for the simulation and the cross-check
+SETTING_OPTIONS = {
+    'bet': 'DEFAULT_GAME_LOSE_OR_WIN_AMOUNT',
+    'login_bonus': 'LOGIN_BONUS_AMOUNT',
+    'deposit_bonus': 'DEFAULT_MONEY_DEPOSIT_BONUS_AMOUNT',
+    'min_deposit_for_bonus': 'MIN_REAL_MONEY_DEPOSIT_TO_GET_BONUS',
+    'wagering_requirement': 'BONUS_WAGERING_REQUIREMENT',
+}
+
+
+def cents(amount):
+    return '{:.2f}'.format(Money.from_cents(amount).decimal)
+
+
+@contextmanager
+def overridden_app_settings(overrides):
+    previous = dict(app_settings)
+    app_settings.update(overrides)
+    try:
+        yield
+    finally:
+        app_settings.clear()
+        app_settings.update(previous)
+
+
+class Command(BaseCommand):
+    help = 'Simulates months of logins, deposits and spins of many users in memory with the bonus types, ' \
+           'SPIN_APP_SETTINGS and odds, or the values of the options, and reports where the money went. ' \
+           '--check users are also played through the database, in a transaction that is rolled back, and have ' \
+           'to end with the same balances.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=10000)
+        parser.add_argument('--days', type=int, default=90)
+        parser.add_argument('--spins-per-day', type=int, default=20)
+        parser.add_argument('--login-probability', type=float, default=0.5, help='Chance a user logs in on a day')
+        parser.add_argument('--deposit-probability', type=float, default=0.2, help='Chance a user deposits on a day')
+        parser.add_argument('--deposit-amounts', default='20,50,100,200',
+                            help='Comma separated amounts users pick their deposits from')
+        parser.add_argument('--win-probability', type=float, help="The outcome generator's by default")
+        parser.add_argument('--bet', type=Money)
+        parser.add_argument('--login-bonus', type=Money)
+        parser.add_argument('--deposit-bonus', type=Money)
+        parser.add_argument('--min-deposit-for-bonus', type=Money)
+        parser.add_argument('--wagering-requirement', type=int)
+        parser.add_argument('--processes', type=int, default=1)
+        parser.add_argument('--chunk-size', type=int, default=10000, help='Users simulated together in one process')
+        parser.add_argument('--seed', type=int)
+        parser.add_argument('--check', type=int, default=20, help='Users cross-checked against the database')
+
+    def handle(self, *args, **options):
+        overrides = {
+            setting: options[option] for option, setting in SETTING_OPTIONS.items() if options[option] is not None
+        }
+
+        with overridden_app_settings(overrides):
+            plan = get_plan(
+                options['days'], options['spins_per_day'], options['login_probability'],
+                options['deposit_probability'], options['deposit_amounts'].split(','), options['win_probability'],
+            )
+
+            start = time.perf_counter()
+            simulation = simulate(
+                plan, options['users'], options['seed'], options['processes'], options['chunk_size'],
+                options['check'],
+            )
+            seconds = time.perf_counter() - start
+            self.report(simulation.totals, seconds)
+
+            if options['check']:
+                start = time.perf_counter()
+                mismatches = check_against_orm(plan, simulation)
+                seconds = time.perf_counter() - start
+                for user, state, orm_state in mismatches:
+                    self.stdout.write('User {}: simulated {}, database {} (real money, bonus, money spent)'.format(
+                        user, state, orm_state
+                    ))
+                self.stdout.write('Cross-checked {} users through the database in {:.1f} s, {} mismatched'.format(
+                    len(simulation.logs), seconds, len(mismatches)
+                ))
+                if mismatches:
+                    raise CommandError('The simulation disagrees with the database')
+
+    def report(self, totals, seconds):
+        bets = totals['lost'] + totals['won']
+        self.stdout.write('Simulated {} spins of {} users in {:.1f} s, {:.0f} spins/s'.format(
+            totals['spins'], totals['users'], seconds, totals['spins'] / seconds
+        ))
+        self.stdout.write('{} spins were played with bonus money, {} couldn\'t be afforded'.format(
+            totals['bonus spins'], totals['unaffordable spins']
+        ))
+        self.stdout.write('Deposited {}, bet {}, return to player {:.2%}, the house kept {}'.format(
+            cents(totals['deposited']), cents(bets), 2 * totals['won'] / bets if bets else 0,
+            cents(totals['lost'] - totals['won']),
+        ))
+        self.stdout.write('Bonuses: {} to real money wallets, {} granted, {} of grants wagered into real money '
+                          'for {} spent'.format(
+                              cents(totals['real money bonuses']), cents(totals['bonus grants']),
+                              cents(totals['transferred']), cents(totals['wagered']),
+                          ))
+        self.stdout.write('Left in wallets: {} real money, {} bonus'.format(
+            cents(totals['real money balance']), cents(totals['bonus balance'])
+        ))
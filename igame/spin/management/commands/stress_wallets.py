@@ -0,0 +1,94 @@
+from collections import Counter
+import threading
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection, DatabaseError
+from django.test import override_settings
+
+from spin.bench import seed_users
+from spin.game import play_game
+from spin.ledger import reconcile_wallets
+from spin.models import BalanceTooLowError, Game, Transaction, Wallet, WalletChangedError
+from spin.money import Money
+from spin.wagering import MoneySpentForWagering
+from spin.wallets import OPTIMISTIC, SELECT_FOR_UPDATE
+
+
+STRATEGIES = {'none': None, SELECT_FOR_UPDATE: SELECT_FOR_UPDATE, OPTIMISTIC: OPTIMISTIC}
+
+
+class Command(BaseCommand):
+    help = 'Has many threads lose games on the same few wallets with each locking strategy and checks the balances. ' \
+           "Meant for PostgreSQL, whose max_connections has to be higher than the number of threads."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=200)
+        parser.add_argument('--spins-per-thread', type=int, default=10)
+        parser.add_argument('--users', type=int, default=5, help='The threads are spread over this many users')
+        parser.add_argument('--strategy', choices=list(STRATEGIES), action='append')
+
+    def handle(self, *args, **options):
+        bet_amount = Money(1)
+        spins = options['threads'] * options['spins_per_thread']
+        # the wallets can only pay for half of the spins, so the last spins race for the last coins
+        balance = bet_amount * (spins // options['users'] // 2)
+
+        for name in options['strategy'] or list(STRATEGIES):
+            user_ids = seed_users(options['users'], username_prefix='stress-{}-{}-'.format(name, int(time.time())))
+            wallets = Wallet.objects.filter(user_id__in=user_ids)
+            wallets.update(current_balance=balance)
+            Transaction.objects.bulk_create([Transaction(wallet=wallet, amount=balance) for wallet in wallets])
+            for user_id in user_ids:
+                MoneySpentForWagering(user_id).set(0)
+
+            with override_settings(WALLET_LOCKING=STRATEGIES[name]):
+                results, elapsed = self.spin(user_ids, options['threads'], options['spins_per_thread'], bet_amount)
+
+            spent = sum(balance - wallet.current_balance for wallet in wallets.all())
+            self.stdout.write(
+                '{}: {:.0f} spins/s, {} played, {} too low, {} conflicts, {} errors; '
+                '{} overdrawn wallets, {} drifted wallets, {} charged for {} games'.format(
+                    name, spins / elapsed, results['played'], results['too low'], results['conflicts'],
+                    results['errors'], wallets.filter(current_balance__lt=0).count(),
+                    len(reconcile_wallets(list(wallets.values_list('pk', flat=True)))),
+                    spent, bet_amount * results['played'],
+                )
+            )
+
+    def spin(self, user_ids, thread_count, spins_per_thread, bet_amount):
+        results = Counter()
+        lock = threading.Lock()
+
+        def spinner(user_id):
+            user = User.objects.get(pk=user_id)
+            outcomes = Counter()
+
+            try:
+                for _ in range(spins_per_thread):
+                    try:
+                        play_game(user, Game.LOST, bet_amount)
+                        outcomes['played'] += 1
+                    except BalanceTooLowError:
+                        outcomes['too low'] += 1
+                    except WalletChangedError:
+                        outcomes['conflicts'] += 1
+                    except DatabaseError:
+                        outcomes['errors'] += 1
+            finally:
+                connection.close()
+
+            with lock:
+                results.update(outcomes)
+
+        threads = [
+            threading.Thread(target=spinner, args=(user_ids[number % len(user_ids)],)) for number in range(thread_count)
+        ]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        return results, time.perf_counter() - start
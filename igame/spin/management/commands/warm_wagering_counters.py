@@ -0,0 +1,30 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+
+from spin.money import Money
+from spin.wagering import calculate_money_spent_totals, set_money_spent_totals
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the money spent for wagering counters of all active users from the ledger'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        users = User.objects.filter(is_active=True).order_by('pk')
+        last_user_id = 0
+        warmed = 0
+
+        while True:
+            user_ids = list(users.filter(pk__gt=last_user_id).values_list('pk', flat=True)[:options['batch_size']])
+            if not user_ids:
+                break
+
+            totals = calculate_money_spent_totals(user_ids)
+            set_money_spent_totals({user_id: totals.get(user_id, Money(0)) for user_id in user_ids})
+
+            last_user_id = user_ids[-1]
+            warmed += len(user_ids)
+
+        self.stdout.write('Warmed wagering counters of {} users'.format(warmed))
@@ -0,0 +1,52 @@
+"""
+Timings of the requests sampled by `spin.middleware.RequestMetricsMiddleware`.
+
+Only sampled requests have a `RequestMetrics`, everything else skips the bookkeeping.
+"""
+from functools import wraps
+import threading
+import time
+
+
+_current = threading.local()
+
+
+class RequestMetrics:
+
+    def __init__(self):
+        self.signal_handlers_ms = 0.0
+        self.in_signal_handler = False
+
+
+def start_request_metrics():
+    _current.metrics = RequestMetrics()
+    return _current.metrics
+
+
+def stop_request_metrics():
+    _current.metrics = None
+
+
+def get_request_metrics():
+    return getattr(_current, 'metrics', None)
+
+
+def times_signal_handler(func):
+    """For signal receivers, adds the time they take to the sampled request they run in."""
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        metrics = get_request_metrics()
+        # handlers that send signals themselves are only counted once
+        if metrics is None or metrics.in_signal_handler:
+            return func(*args, **kwargs)
+
+        metrics.in_signal_handler = True
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            metrics.signal_handlers_ms += (time.perf_counter() - start) * 1000
+            metrics.in_signal_handler = False
+
+    return wrapper
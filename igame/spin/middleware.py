@@ -0,0 +1,44 @@
+import logging
+import random
+import time
+
+from django.conf import settings
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from .metrics import start_request_metrics, stop_request_metrics
+
+
+logger = logging.getLogger('spin.metrics')
+
+
+class RequestMetricsMiddleware:
+    """
+    Logs the time, database queries and signal handler time of a sample of requests to the `spin.metrics` logger.
+
+    `REQUEST_METRICS_SAMPLE_RATE` is the share of requests that are sampled, 0 turns it off. Queries are only
+    recorded during sampled requests, the others just draw a random number.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if random.random() >= getattr(settings, 'REQUEST_METRICS_SAMPLE_RATE', 0):
+            return self.get_response(request)
+
+        metrics = start_request_metrics()
+        start = time.perf_counter()
+        try:
+            with CaptureQueriesContext(connection) as queries:
+                response = self.get_response(request)
+        finally:
+            stop_request_metrics()
+        total_ms = (time.perf_counter() - start) * 1000
+
+        logger.info(
+            '%s %s %s: %.1f ms, %d queries in %.1f ms, signal handlers %.1f ms',
+            request.method, request.path, response.status_code, total_ms,
+            len(queries), sum(float(query['time']) for query in queries) * 1000, metrics.signal_handlers_ms,
+        )
+        return response
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.7 on 2026-10-18 11:26
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('spin', '0005_bonuswageredtransaction'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='spingametransaction',
+            index=models.Index(fields=['transaction', 'game'], name='spin_spinga_transac_4a99d5_idx'),
+        ),
+    ]
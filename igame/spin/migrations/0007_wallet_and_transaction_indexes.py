@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.7 on 2026-10-18 11:29
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+POSITIVE_BONUS_WALLETS_INDEX = 'spin_wallet_positive_bonus_idx'
+
+
+def create_positive_bonus_wallets_index(apps, schema_editor):
+    # SQLite can only use a partial index when the query has the same literals as its WHERE clause, and Django
+    # always binds parameters, so the index would only slow down writes there.
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute(
+            "CREATE INDEX {} ON spin_wallet (user_id, current_balance) "
+            "WHERE money_type = 'bonus' AND current_balance > 0".format(POSITIVE_BONUS_WALLETS_INDEX)
+        )
+
+
+def drop_positive_bonus_wallets_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute('DROP INDEX {}'.format(POSITIVE_BONUS_WALLETS_INDEX))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('spin', '0006_spingametransaction_transaction_game_index'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['wallet', 'created_at'], name='spin_transa_wallet__e99513_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='wallet',
+            index=models.Index(fields=['user', 'money_type', 'current_balance'], name='spin_wallet_user_id_63d234_idx'),
+        ),
+        migrations.RunPython(create_positive_bonus_wallets_index, drop_positive_bonus_wallets_index),
+    ]
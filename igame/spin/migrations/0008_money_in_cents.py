@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from decimal import Decimal
+
+from django.db import migrations, models
+
+import spin.money
+
+
+POSITIVE_BONUS_WALLETS_INDEX = 'spin_wallet_positive_bonus_idx'
+
+
+def create_positive_bonus_wallets_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute(
+            "CREATE INDEX {} ON spin_wallet (user_id, current_balance) "
+            "WHERE money_type = 'bonus' AND current_balance > 0".format(POSITIVE_BONUS_WALLETS_INDEX)
+        )
+
+
+def drop_positive_bonus_wallets_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute('DROP INDEX {}'.format(POSITIVE_BONUS_WALLETS_INDEX))
+
+
+def convert_to_cents(model_name, table, column, decimal_field, default=None):
+    """
+    Moves `column` from a decimal to a whole number of cents.
+
+    The cents go into a new column first, so the old values are still around to convert back when migrating
+    backwards, and the decimal column is made nullable before that so it can be dropped and re-added.
+    """
+    cents_column = column + '_cents'
+    decimal_field.null = True
+    extra = {} if default is None else {'default': default}
+
+    return [
+        migrations.AlterField(model_name=model_name, name=column, field=decimal_field),
+        migrations.AddField(model_name=model_name, name=cents_column, field=spin.money.MoneyField(null=True)),
+        migrations.RunSQL(
+            'UPDATE {table} SET {cents} = CAST(ROUND({column} * 100) AS BIGINT)'.format(
+                table=table, column=column, cents=cents_column
+            ),
+            'UPDATE {table} SET {column} = {cents} / 100.0'.format(table=table, column=column, cents=cents_column),
+        ),
+        migrations.RemoveField(model_name=model_name, name=column),
+        migrations.RenameField(model_name=model_name, old_name=cents_column, new_name=column),
+        migrations.AlterField(model_name=model_name, name=column, field=spin.money.MoneyField(**extra)),
+    ]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('spin', '0007_wallet_and_transaction_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(drop_positive_bonus_wallets_index, create_positive_bonus_wallets_index),
+        migrations.RemoveIndex(model_name='wallet', name='spin_wallet_user_id_63d234_idx'),
+    ] + convert_to_cents(
+        'wallet', 'spin_wallet', 'current_balance',
+        models.DecimalField(decimal_places=2, default=Decimal('0'), max_digits=10), default=0,
+    ) + convert_to_cents(
+        'transaction', 'spin_transaction', 'amount', models.DecimalField(decimal_places=2, max_digits=5),
+    ) + convert_to_cents(
+        'bonuswageredtransaction', 'spin_bonuswageredtransaction', 'amount',
+        models.DecimalField(decimal_places=2, max_digits=5),
+    ) + [
+        migrations.AddIndex(
+            model_name='wallet',
+            index=models.Index(fields=['user', 'money_type', 'current_balance'], name='spin_wallet_user_id_63d234_idx'),
+        ),
+        migrations.RunPython(create_positive_bonus_wallets_index, drop_positive_bonus_wallets_index),
+    ]
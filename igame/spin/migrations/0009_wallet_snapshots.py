@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.7 on 2026-10-18 11:45
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+import spin.money
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('spin', '0008_money_in_cents'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WalletSnapshot',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('balance', spin.money.MoneyField()),
+                ('last_transaction_id', models.BigIntegerField()),
+                ('drift', spin.money.MoneyField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['wallet', 'id'], name='spin_transa_wallet__be7a29_idx'),
+        ),
+        migrations.AddField(
+            model_name='walletsnapshot',
+            name='wallet',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='snapshots', to='spin.Wallet'),
+        ),
+    ]
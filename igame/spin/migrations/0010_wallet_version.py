@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.7 on 2026-10-18 11:52
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('spin', '0009_wallet_snapshots'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='wallet',
+            name='version',
+            field=models.IntegerField(default=0),
+        ),
+    ]
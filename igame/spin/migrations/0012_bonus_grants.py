@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models import F
+import django.db.models.deletion
+
+import spin.money
+
+
+def fold_bonus_wallets(apps, schema_editor):
+    """
+    Turns every bonus wallet into a grant of its user's oldest bonus wallet, which becomes the user's only one.
+
+    The other wallets' transactions move to the remaining wallet, so its balance still matches its ledger. Their
+    snapshots are dropped, `reconcile_wallets` takes new ones.
+    """
+    Wallet = apps.get_model('spin', 'Wallet')
+    BonusGrant = apps.get_model('spin', 'BonusGrant')
+    BonusTransaction = apps.get_model('spin', 'BonusTransaction')
+    BonusWageredTransaction = apps.get_model('spin', 'BonusWageredTransaction')
+    Transaction = apps.get_model('spin', 'Transaction')
+    WalletSnapshot = apps.get_model('spin', 'WalletSnapshot')
+
+    user_ids = Wallet.objects.filter(money_type='bonus').order_by('user_id').values_list('user_id', flat=True)
+    for user_id in user_ids.distinct().iterator():
+        wallets = list(Wallet.objects.filter(user_id=user_id, money_type='bonus').order_by('id'))
+        wallet_ids = [wallet.pk for wallet in wallets]
+        bonus_wallet, folded_wallet_ids = wallets[0], wallet_ids[1:]
+        bonus_types = dict(
+            BonusTransaction.objects.
+            filter(transaction__wallet_id__in=wallet_ids).
+            values_list('transaction__wallet_id', 'bonus_type_id')
+        )
+
+        for wallet in wallets:
+            grant = BonusGrant.objects.create(
+                wallet=bonus_wallet,
+                bonus_type_id=bonus_types.get(wallet.pk),
+                balance=wallet.current_balance,
+                wagering_requirement=wallet.wagering_requirement,
+            )
+            BonusWageredTransaction.objects.filter(bonus_wallet=wallet).update(bonus_wallet=bonus_wallet, bonus_grant=grant)
+
+        Transaction.objects.filter(wallet_id__in=folded_wallet_ids).update(wallet=bonus_wallet)
+        WalletSnapshot.objects.filter(wallet_id__in=wallet_ids).delete()
+        Wallet.objects.filter(pk=bonus_wallet.pk).update(
+            current_balance=sum((wallet.current_balance for wallet in wallets), spin.money.Money(0)),
+            version=F('version') + 1,
+        )
+        Wallet.objects.filter(pk__in=folded_wallet_ids).delete()
+
+
+def check_deferred_constraints(apps, schema_editor):
+    """
+    PostgreSQL checks the foreign keys of the rows `fold_bonus_wallets` changed at the end of the transaction, and
+    refuses to alter their tables while those checks are pending.
+    """
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute('SET CONSTRAINTS ALL IMMEDIATE')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('spin', '0011_outbox_event'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BonusGrant',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('balance', spin.money.MoneyField()),
+                ('wagering_requirement', models.IntegerField(default=10)),
+                ('bonus_type', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to='spin.BonusType')),
+                ('wallet', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='bonus_grants', to='spin.Wallet')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='bonusgrant',
+            index=models.Index(fields=['wallet', 'id'], name='spin_bonusg_wallet__8326bf_idx'),
+        ),
+        migrations.AlterField(
+            model_name='bonuswageredtransaction',
+            name='bonus_wallet',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='bonus_wager_transactions', to='spin.Wallet'),
+        ),
+        migrations.AddField(
+            model_name='bonuswageredtransaction',
+            name='bonus_grant',
+            field=models.OneToOneField(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='wager_transaction', to='spin.BonusGrant'),
+        ),
+        # the transactions of the folded wallets can't be split between wallets again, going back keeps one bonus
+        # wallet per user
+        migrations.RunPython(fold_bonus_wallets, migrations.RunPython.noop),
+        migrations.RunPython(check_deferred_constraints, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='bonuswageredtransaction',
+            name='bonus_grant',
+            field=models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='wager_transaction', to='spin.BonusGrant'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='wallet',
+            unique_together=set([('user', 'money_type')]),
+        ),
+    ]
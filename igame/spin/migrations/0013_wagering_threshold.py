@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.7 on 2026-10-18 12:05
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import spin.money
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('spin', '0012_bonus_grants'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='wallet',
+            name='wagering_threshold',
+            field=spin.money.MoneyField(null=True),
+        ),
+        migrations.AddIndex(
+            model_name='bonusgrant',
+            index=models.Index(fields=['wallet', 'balance'], name='spin_bonusg_wallet__5d34e2_idx'),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.7 on 2026-10-18 12:24
+from __future__ import unicode_literals
+
+from django.db import migrations
+import spin.money
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('spin', '0013_wagering_threshold'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='bonustype',
+            name='amount',
+            field=spin.money.MoneyField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='bonustype',
+            name='min_deposit_amount',
+            field=spin.money.MoneyField(blank=True, null=True),
+        ),
+    ]
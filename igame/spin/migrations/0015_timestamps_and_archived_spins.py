@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+import spin.money
+
+
+def partition_archived_spins(apps, schema_editor):
+    """Recreates the archived spins table as a table partitioned by month on PostgreSQL."""
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+
+    schema_editor.execute('ALTER TABLE spin_archivedspin RENAME TO spin_archivedspin_unpartitioned')
+    schema_editor.execute(
+        'CREATE TABLE spin_archivedspin ('
+        'LIKE spin_archivedspin_unpartitioned INCLUDING DEFAULTS, '
+        'PRIMARY KEY (game_id, created_at)'
+        ') PARTITION BY RANGE (created_at)'
+    )
+    schema_editor.execute('DROP TABLE spin_archivedspin_unpartitioned')
+    schema_editor.execute('CREATE INDEX spin_archiv_wallet__2fcaf7_idx ON spin_archivedspin (wallet_id, created_at)')
+
+
+class Migration(migrations.Migration):
+    """
+    The time of day `Game.created_at` and `Transaction.created_at` held can't be turned into a date, existing rows
+    get the time of the migration instead.
+    """
+
+    dependencies = [
+        ('spin', '0014_bonus_type_rules'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='transaction',
+            name='spin_transa_wallet__e99513_idx',
+        ),
+        migrations.RemoveField(
+            model_name='game',
+            name='created_at',
+        ),
+        migrations.RemoveField(
+            model_name='transaction',
+            name='created_at',
+        ),
+        migrations.AddField(
+            model_name='game',
+            name='created_at',
+            field=models.DateTimeField(auto_now_add=True, db_index=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='transaction',
+            name='created_at',
+            field=models.DateTimeField(auto_now_add=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['wallet', 'created_at'], name='spin_transa_wallet__e99513_idx'),
+        ),
+        migrations.CreateModel(
+            name='ArchivedSpin',
+            fields=[
+                ('game_id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('transaction_id', models.BigIntegerField()),
+                ('outcome', models.CharField(choices=[('lost_game', 'User Lost'), ('won_game', 'User Won')], max_length=20)),
+                ('amount', spin.money.MoneyField()),
+                ('created_at', models.DateTimeField()),
+                ('wallet', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, related_name='archived_spins', to='spin.Wallet')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='archivedspin',
+            index=models.Index(fields=['wallet', 'created_at'], name='spin_archiv_wallet__2fcaf7_idx'),
+        ),
+        migrations.RunPython(partition_archived_spins, migrations.RunPython.noop),
+    ]
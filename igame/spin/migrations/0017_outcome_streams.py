@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.7 on 2026-10-18 13:01
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0008_alter_user_username_max_length'),
+        ('spin', '0016_api_token'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OutcomeStream',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='outcome_stream', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('seed', models.CharField(max_length=64)),
+                ('position', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='archivedspin',
+            name='outcome_position',
+            field=models.BigIntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='game',
+            name='outcome_position',
+            field=models.BigIntegerField(null=True),
+        ),
+    ]
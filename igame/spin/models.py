@@ -1,13 +1,11 @@
-from decimal import Decimal
-
 from django.contrib.auth.models import User
 from django.contrib.auth.signals import user_logged_in
-from django.db import models, transaction as db_transaction
-from django.db.models import F
+from django.db import models
 from django.db.models.signals import post_save
 from django.dispatch import receiver, Signal
 
-from .constants import SPIN_APP_SETTINGS as app_settings
+from .metrics import times_signal_handler
+from .money import Money, MoneyField
 
 
 class BonusType(models.Model):
@@ -20,25 +18,27 @@ class BonusType(models.Model):
 
     active = models.BooleanField(default=True)
     event = models.CharField(max_length=50, choices=EVENT_CHOICES, null=False)
+    # the parameters of the bonus rule of the event, empty ones take the defaults from `SPIN_APP_SETTINGS`
+    amount = MoneyField(null=True, blank=True)
+    min_deposit_amount = MoneyField(null=True, blank=True)
 
 
 @receiver(user_logged_in)
+@times_signal_handler
 def user_log_in_real_money_bonus(sender, **kwargs):
-    bonus_amount = app_settings['LOGIN_BONUS_AMOUNT']
+    from .bonus import handle_bonus_event
 
-    with db_transaction.atomic():
-        wallet_to_be_rewarded = Wallet.objects.get(money_type=Wallet.REAL_MONEY, user=kwargs['user'])
-        wallet_to_be_rewarded.current_balance = F('current_balance') + bonus_amount
-        wallet_to_be_rewarded.save()
-        transaction = Transaction.objects.create(amount=bonus_amount, wallet=wallet_to_be_rewarded)
-        bonus_type = BonusType.objects.get(event=BonusType.LOGIN)
-        bonus_transaction = BonusTransaction.objects.create(transaction=transaction, bonus_type=bonus_type)
+    handle_bonus_event(BonusType.LOGIN, kwargs['user'])
 
 
 class BalanceTooLowError(Exception):
     pass
 
 
+class WalletChangedError(Exception):
+    """Raised with optimistic wallet locking when a wallet was changed by someone else after it was read."""
+
+
 class Wallet(models.Model):
     REAL_MONEY = 'real_money'
     BONUS = 'bonus'
@@ -49,8 +49,20 @@ class Wallet(models.Model):
 
     money_type = models.CharField(max_length=50, choices=MONEY_TYPE_CHOICES, null=False)
     user = models.ForeignKey(User, related_name='wallets')
-    current_balance = models.DecimalField(max_digits=10, decimal_places=2, default=Decimal(0))
+    current_balance = MoneyField(default=0)
     wagering_requirement = models.IntegerField(default=10)
+    # bumped on every balance change, optimistic locking only writes if it's still the version that was read
+    version = models.IntegerField(default=0)
+    # bonus wallets only, see `spin.wagering.get_wagering_threshold`, unknown until wagering looks it up
+    wagering_threshold = MoneyField(null=True)
+
+    class Meta:
+        # bonuses share the user's one bonus wallet, see `BonusGrant`
+        unique_together = ('user', 'money_type')
+        indexes = [
+            # picking a wallet for a game, loading a user's wallets and wagering all filter on these
+            models.Index(fields=['user', 'money_type', 'current_balance']),
+        ]
 
     def __str__(self):
         return 'balance: {}, type: {}'.format(self.current_balance, self.money_type)
@@ -64,15 +76,35 @@ class Game(models.Model):
         (WON, 'User Won'),
     )
 
-    created_at = models.TimeField(auto_now=True)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
     outcome = models.CharField(max_length=20, choices=GAME_OUTCOME_CHOICES, null=False)
+    # where the outcome is in the user's `OutcomeStream`, null for outcomes that didn't come from one
+    outcome_position = models.BigIntegerField(null=True)
+
+
+class OutcomeStream(models.Model):
+    """
+    A user's stream of seeded outcomes, see `spin.outcomes.SeededUserOutcomes`. `position` is where the next
+    outcome is drawn from.
+    """
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True, related_name='outcome_stream')
+    seed = models.CharField(max_length=64)
+    position = models.BigIntegerField(default=0)
 
 
 class Transaction(models.Model):
-    created_at = models.TimeField(auto_now=True)
-    amount = models.DecimalField(max_digits=5, decimal_places=2, null=False)
+    created_at = models.DateTimeField(auto_now_add=True)
+    amount = MoneyField(null=False)
     wallet = models.ForeignKey(Wallet, related_name='transactions')
 
+    class Meta:
+        indexes = [
+            # a wallet's history over a range of time, e.g. today's spins of a user, is one range of this index
+            models.Index(fields=['wallet', 'created_at']),
+            # reconciliation sums the transactions of a wallet after its latest snapshot
+            models.Index(fields=['wallet', 'id']),
+        ]
+
     def __str__(self):
         return f'{self.amount}, Wallet: type:{self.wallet.money_type}, current_balance: {self.wallet.current_balance}'
 
@@ -82,6 +114,28 @@ class BonusTransaction(models.Model):
     bonus_type = models.ForeignKey(BonusType)
 
 
+class BonusGrant(models.Model):
+    """
+    A bonus given to a user.
+
+    All of a user's bonuses share one bonus wallet, whose balance is the sum of its grants' balances. Games are
+    still played with, and bonuses wagered from, one grant at a time, the way they used to be with a wallet per
+    bonus.
+    """
+    wallet = models.ForeignKey(Wallet, related_name='bonus_grants', on_delete=models.CASCADE)
+    bonus_type = models.ForeignKey(BonusType, null=True)
+    balance = MoneyField()
+    wagering_requirement = models.IntegerField(default=10)
+
+    class Meta:
+        indexes = [
+            # games take the oldest grant with enough balance, which is found by walking a wallet's grants in order
+            models.Index(fields=['wallet', 'id']),
+            # wagering starts at the grant with the lowest balance
+            models.Index(fields=['wallet', 'balance']),
+        ]
+
+
 class DepositTransaction(models.Model):
     transaction = models.OneToOneField(Transaction, on_delete=models.CASCADE, primary_key=True)
 
@@ -90,32 +144,106 @@ user_made_deposit_signal = Signal(providing_args=['user', 'deposit_amount'])
 
 
 @receiver(user_made_deposit_signal)
+@times_signal_handler
 def real_money_deposit_bonus(sender, user, deposit_amount, **kwargs):
-    from .bonus import give_user_a_bonus
+    from .bonus import handle_bonus_event
 
-    if deposit_amount > app_settings['MIN_REAL_MONEY_DEPOSIT_TO_GET_BONUS']:
-        bonus_type = BonusType.objects.get(event=BonusType.REAL_MONEY_DEPOSIT)
-        give_user_a_bonus(user, bonus_type, app_settings['DEFAULT_MONEY_DEPOSIT_BONUS_AMOUNT'])
+    handle_bonus_event(BonusType.REAL_MONEY_DEPOSIT, user, deposit_amount=deposit_amount)
 
 
 class SpinGameTransaction(models.Model):
     game = models.ForeignKey(Game)
     transaction = models.ForeignKey(Transaction, on_delete=models.CASCADE)
 
+    class Meta:
+        indexes = [
+            # money spent for wagering is summed over the games of a user's transactions
+            models.Index(fields=['transaction', 'game']),
+        ]
+
+
+class ArchivedSpin(models.Model):
+    """
+    A spin moved out of `Game`, `SpinGameTransaction` and `Transaction` by `spin.history.archive_spins`, as one row.
+
+    On PostgreSQL the table is partitioned by the month of `created_at`, a month of spins is dropped with its
+    partition. Its primary key is (game_id, created_at) there, partitions can't have keys without `created_at`.
+    Django 1.11 doesn't list partitioned tables, so `flush` leaves it alone, and a foreign key constraint on it would
+    stop `flush` from truncating the wallets.
+    """
+    game_id = models.BigIntegerField(primary_key=True)
+    transaction_id = models.BigIntegerField()
+    wallet = models.ForeignKey(Wallet, related_name='archived_spins', on_delete=models.CASCADE, db_constraint=False)
+    outcome = models.CharField(max_length=20, choices=Game.GAME_OUTCOME_CHOICES)
+    outcome_position = models.BigIntegerField(null=True)
+    amount = MoneyField()
+    created_at = models.DateTimeField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['wallet', 'created_at']),
+        ]
 
-user_spendt_money_signal = Signal(providing_args=['user_id']) # todo send this signal
+
+class DroppedSpinsTotal(models.Model):
+    """
+    The money a user lost in archived spins whose months were dropped, see `spin.history.drop_archived_month`. The
+    money spent for wagering is rebuilt with it, as the wagered bonuses it was spent on are still in the ledger.
+    """
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True, related_name='+')
+    lost = MoneyField(default=0)
+
+
+user_spendt_money_signal = Signal(providing_args=['user_id', 'user']) # todo send this signal
 
 
 class BonusWageredTransaction(models.Model):
     transaction = models.OneToOneField(Transaction, on_delete=models.CASCADE, primary_key=True)
-    bonus_wallet = models.OneToOneField(Wallet, related_name='bonus_wager_transaction')
+    bonus_wallet = models.ForeignKey(Wallet, related_name='bonus_wager_transactions')
+    bonus_grant = models.OneToOneField(BonusGrant, related_name='wager_transaction')
     real_money_wallet = models.ForeignKey(Wallet)
-    amount = models.DecimalField(max_digits=5, decimal_places=2, null=False)
+    amount = MoneyField(null=False)
+
+
+class WalletSnapshot(models.Model):
+    """
+    A wallet's balance according to the ledger: the sum of its transactions up to and including `last_transaction_id`.
+
+    `drift` is how far the wallet's cached `current_balance` was from that balance when the snapshot was taken.
+    """
+    wallet = models.ForeignKey(Wallet, related_name='snapshots', on_delete=models.CASCADE)
+    balance = MoneyField()
+    last_transaction_id = models.BigIntegerField()
+    drift = MoneyField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+
+class OutboxEvent(models.Model):
+    """
+    Bonus and wagering work left by a spin or deposit for `manage.py drain_outbox`.
+
+    It's written in the same database transaction as the spin or deposit, so it's never lost or done for a
+    spin that was rolled back.
+    """
+    USER_SPENT_MONEY = 'user_spent_money'
+    USER_MADE_DEPOSIT = 'user_made_deposit'
+    EVENT_CHOICES = (
+        (USER_SPENT_MONEY, 'User Played Games'),
+        (USER_MADE_DEPOSIT, 'User Deposited Real Money'),
+    )
+
+    event = models.CharField(max_length=50, choices=EVENT_CHOICES, null=False)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    amount = MoneyField(null=True)
+    # times draining it failed, see `spin.outbox.drain_outbox`
+    attempts = models.IntegerField(default=0)
 
 
 @receiver(user_spendt_money_signal)
-def update_bonus_wagering(user_id, **kwargs):
-    user = User.objects.get(pk=user_id)
+@times_signal_handler
+def update_bonus_wagering(user_id, user=None, **kwargs):
+    if user is None:
+        user = User.objects.get(pk=user_id)
 
     from .wagering import transfer_eligible_bonuses_to_real_money_wallet
     transfer_eligible_bonuses_to_real_money_wallet(user)
@@ -123,10 +251,18 @@ def update_bonus_wagering(user_id, **kwargs):
 
 
 @receiver(post_save, sender=User)
+@times_signal_handler
 def user_setup(sender, instance, created, **kwargs):
     if created:
         Wallet.objects.create(user=instance, money_type=Wallet.REAL_MONEY)
 
         from .wagering import MoneySpentForWagering
         money_spent = MoneySpentForWagering(instance.pk)
-        money_spent.set(Decimal(0))
+        money_spent.set(Money(0))
+
+
+class ApiToken(models.Model):
+    """The key a client of the JSON API sends as `Authorization: Token <key>`, one per user."""
+    key = models.CharField(max_length=40, primary_key=True)
+    user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='api_token')
+    created_at = models.DateTimeField(auto_now_add=True)
@@ -0,0 +1,95 @@
+from decimal import Decimal, ROUND_HALF_UP
+from functools import total_ordering
+
+from django.db import models
+
+
+CENTS_IN_A_UNIT = 100
+
+
+@total_ordering
+class Money:
+    """
+    An amount of money kept as a whole number of cents.
+
+    It can be created from anything `Decimal` accepts, e.g. `Money(10)` or `Money('0.50')`, and compares equal to
+    the same amount as a `Decimal` or `int`.
+    """
+
+    __slots__ = ('cents',)
+
+    def __init__(self, amount=0):
+        if isinstance(amount, Money):
+            self.cents = amount.cents
+        else:
+            self.cents = int((Decimal(amount) * CENTS_IN_A_UNIT).to_integral_value(rounding=ROUND_HALF_UP))
+
+    @classmethod
+    def from_cents(cls, cents):
+        money = cls.__new__(cls)
+        money.cents = int(cents)
+        return money
+
+    @property
+    def decimal(self):
+        return Decimal(self.cents) / CENTS_IN_A_UNIT
+
+    def __add__(self, other):
+        if not isinstance(other, (Money, Decimal, int)):
+            return NotImplemented
+        return Money.from_cents(self.cents + Money(other).cents)
+
+    __radd__ = __add__
+
+    def __sub__(self, other):
+        if not isinstance(other, (Money, Decimal, int)):
+            return NotImplemented
+        return Money.from_cents(self.cents - Money(other).cents)
+
+    def __rsub__(self, other):
+        return -self + other
+
+    def __neg__(self):
+        return Money.from_cents(-self.cents)
+
+    def __mul__(self, times):
+        if not isinstance(times, int):
+            return NotImplemented
+        return Money.from_cents(self.cents * times)
+
+    __rmul__ = __mul__
+
+    def __eq__(self, other):
+        if not isinstance(other, (Money, Decimal, int)):
+            return NotImplemented
+        return self.cents == Money(other).cents
+
+    def __lt__(self, other):
+        if not isinstance(other, (Money, Decimal, int)):
+            return NotImplemented
+        return self.cents < Money(other).cents
+
+    def __hash__(self):
+        return hash(self.decimal)
+
+    def __bool__(self):
+        return self.cents != 0
+
+    def __str__(self):
+        return '{:.2f}'.format(self.decimal)
+
+    def __repr__(self):
+        return "Money('{}')".format(self)
+
+
+class MoneyField(models.BigIntegerField):
+    """Stores `Money` as a whole number of cents."""
+
+    def from_db_value(self, value, expression, connection, context):
+        return None if value is None else Money.from_cents(value)
+
+    def to_python(self, value):
+        return None if value is None else Money(value)
+
+    def get_prep_value(self, value):
+        return None if value is None else Money(value).cents
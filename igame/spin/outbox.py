@@ -0,0 +1,88 @@
+from collections import defaultdict
+import logging
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import transaction as db_transaction
+from django.db.models import F
+
+from .constants import SPIN_APP_SETTINGS as app_settings
+from .models import OutboxEvent, user_made_deposit_signal, user_spendt_money_signal
+from .wallets import call_taking_back_counter_changes
+
+
+logger = logging.getLogger(__name__)
+
+
+def publish_event(event, user, amount=None):
+    """
+    Call inside the database transaction of the spin or deposit. With `OUTBOX_EVENTS = True` the event is written
+    to the outbox, otherwise its signal is sent right away.
+    """
+    if getattr(settings, 'OUTBOX_EVENTS', False):
+        OutboxEvent.objects.create(event=event, user=user, amount=amount)
+    else:
+        send_event(event, user, amount)
+
+
+def send_event(event, user, amount=None):
+    if event == OutboxEvent.USER_SPENT_MONEY:
+        user_spendt_money_signal.send(sender=None, user_id=user.pk, user=user)
+    elif event == OutboxEvent.USER_MADE_DEPOSIT:
+        user_made_deposit_signal.send(sender=None, user=user, deposit_amount=amount)
+
+
+def drain_outbox(batch_size):
+    """
+    Sends the signals of up to `batch_size` of the oldest outbox events and deletes them, returns how many there were.
+
+    Wagering only has to run once however many games a user played, so a user's spent money events are sent as
+    one signal, in place of their last one. Rows other workers are draining are skipped on PostgreSQL.
+
+    Each user's events are handled in a savepoint of their own. When a handler raises, that user's events are rolled
+    back and kept with one more attempt, the other users' are still done. Events that failed `OUTBOX_EVENT_ATTEMPTS`
+    times aren't drained anymore, they stay in the outbox to be looked into. The counter changes of what's rolled
+    back, e.g. the money spent a transferred bonus used up, are taken back with it.
+    """
+    return call_taking_back_counter_changes(drain_events, batch_size)
+
+
+def drain_events(batch_size):
+    with db_transaction.atomic():
+        events = list(
+            OutboxEvent.objects.
+            select_for_update(skip_locked=True).
+            filter(attempts__lt=app_settings['OUTBOX_EVENT_ATTEMPTS']).
+            order_by('pk')[:batch_size]
+        )
+        users = User.objects.in_bulk({event.user_id for event in events})
+        events_by_user = defaultdict(list)
+        for event in events:
+            events_by_user[event.user_id].append(event)
+
+        failed = []
+        for user_id, user_events in events_by_user.items():
+            try:
+                call_taking_back_counter_changes(send_user_events, users[user_id], user_events)
+            except Exception:
+                logger.exception('Outbox events %s of user %s failed', [event.pk for event in user_events], user_id)
+                failed.extend(event.pk for event in user_events)
+
+        OutboxEvent.objects.filter(pk__in=failed).update(attempts=F('attempts') + 1)
+        OutboxEvent.objects.filter(pk__in=[event.pk for event in events]).exclude(pk__in=failed).delete()
+
+    return len(events)
+
+
+def send_user_events(user, events):
+    """Sends the signals of the user's events in a savepoint."""
+    last_spent_money_event = max(
+        (event.pk for event in events if event.event == OutboxEvent.USER_SPENT_MONEY), default=None
+    )
+
+    with db_transaction.atomic():
+        for event in events:
+            if event.event == OutboxEvent.USER_SPENT_MONEY and event.pk != last_spent_money_event:
+                continue
+
+            send_event(event.event, user, event.amount)
@@ -0,0 +1,183 @@
+"""
+Generators of spin outcomes, the one used is configured in `settings.OUTCOME_GENERATOR`.
+
+Each outcome comes from a random 32-bit number, a spin is won when the number is below `win_probability` of
+2 ** 32. A win pays the bet and a loss takes it, so the return to player(RTP) of a spin is twice `win_probability`.
+"""
+import array
+import hashlib
+import hmac
+import os
+import secrets
+import struct
+import threading
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import IntegrityError, transaction as db_transaction
+from django.db.models import F
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+from .models import Game, OutcomeStream
+
+
+NUMBER_RANGE = 2 ** 32
+# a SHA-256 HMAC is eight 32-bit numbers
+NUMBERS_PER_BLOCK = 8
+
+_generator = None
+
+
+class OutcomeGenerator:
+    """Base class of the generators, which implement `draw`."""
+
+    def __init__(self, win_probability=0.5):
+        if not 0 <= win_probability <= 1:
+            raise ValueError('win_probability must be between 0 and 1, not {}'.format(win_probability))
+
+        self.win_probability = win_probability
+        self.threshold = int(win_probability * NUMBER_RANGE)
+
+    @property
+    def return_to_player(self):
+        return 2 * self.win_probability
+
+    def outcome(self, number):
+        return Game.WON if number < self.threshold else Game.LOST
+
+    def draw(self, user, count):
+        """
+        Returns `count` outcomes for the user's next games, and the position of the first one in the user's stream,
+        or `None` if the generator has no streams. It's called in the database transaction of the games.
+        """
+        raise NotImplementedError
+
+
+class SystemRandomOutcomes(OutcomeGenerator):
+    """Draws every outcome from the operating system's CSPRNG."""
+
+    def draw(self, user, count):
+        return [self.outcome(secrets.randbits(32)) for _ in range(count)], None
+
+
+class BufferedOutcomes(OutcomeGenerator):
+    """
+    Draws `block_size` outcomes at once from the operating system's CSPRNG and hands them out in order, the buffer
+    is shared by the threads of the process.
+    """
+
+    def __init__(self, block_size=4096, **options):
+        super().__init__(**options)
+        self.block_size = block_size
+        self.buffer = []
+        self.lock = threading.Lock()
+
+    def fill(self):
+        numbers = array.array('I')
+        numbers.frombytes(os.urandom(numbers.itemsize * self.block_size))
+        threshold = self.threshold
+        won, lost = Game.WON, Game.LOST
+        self.buffer.extend([won if number < threshold else lost for number in numbers])
+
+    def draw(self, user, count):
+        with self.lock:
+            while len(self.buffer) < count:
+                self.fill()
+            outcomes = self.buffer[:count]
+            del self.buffer[:count]
+
+        return outcomes, None
+
+
+def seeded_numbers(seed, start, count):
+    """
+    The numbers at positions `start` to `start + count` of the stream of `seed`, a hex string. Block `n` of the
+    stream is the HMAC-SHA256 of `n` as 8 big-endian bytes, keyed with the seed.
+    """
+    key = bytes.fromhex(seed)
+    first_block, skipped = divmod(start, NUMBERS_PER_BLOCK)
+    last_block = (start + count - 1) // NUMBERS_PER_BLOCK
+
+    numbers = []
+    for block in range(first_block, last_block + 1):
+        digest = hmac.new(key, block.to_bytes(8, 'big'), hashlib.sha256).digest()
+        numbers.extend(struct.unpack('>8I', digest))
+
+    return numbers[skipped:skipped + count]
+
+
+class SeededUserOutcomes(OutcomeGenerator):
+    """
+    Gives every user a stream of outcomes computed from a random seed of their own, see `seeded_numbers`.
+
+    Drawing moves the user's `OutcomeStream.position` past the outcomes drawn, in the games' database transaction,
+    and each game keeps the position of its outcome, so `python manage.py replay_outcomes` can recompute and check
+    any user's outcomes. Outcomes drawn for games the user couldn't afford are skipped.
+    """
+
+    def draw(self, user, count):
+        position = self.reserve(user, count) - count
+        seed = OutcomeStream.objects.filter(user_id=user.pk).values_list('seed', flat=True).get()
+
+        return [self.outcome(number) for number in seeded_numbers(seed, position, count)], position
+
+    def reserve(self, user, count):
+        """
+        Moves the user's stream `count` positions on and returns the new position. The UPDATE comes first, so
+        the row is locked until the games' transaction ends.
+        """
+        streams = OutcomeStream.objects.filter(user_id=user.pk)
+        if not streams.update(position=F('position') + count):
+            try:
+                with db_transaction.atomic():
+                    OutcomeStream.objects.create(user_id=user.pk, seed=secrets.token_hex(32), position=count)
+                return count
+            except IntegrityError:
+                # another request created the stream first
+                streams.update(position=F('position') + count)
+
+        return streams.values_list('position', flat=True).get()
+
+
+def replay_outcomes(user, start=0, count=None, win_probability=None):
+    """
+    Recomputes the (position, number, outcome) of the user's stream from its seed, from `start` up to the current
+    position or `count` of them. `win_probability` defaults to that of `settings.OUTCOME_GENERATOR`.
+    """
+    stream = OutcomeStream.objects.get(user_id=user.pk)
+    if count is None:
+        count = max(stream.position - start, 0)
+    if win_probability is None:
+        win_probability = settings.OUTCOME_GENERATOR.get('OPTIONS', {}).get('win_probability', 0.5)
+
+    generator = OutcomeGenerator(win_probability=win_probability)
+    numbers = seeded_numbers(stream.seed, start, count) if count else []
+
+    return [
+        (position, number, generator.outcome(number)) for position, number in enumerate(numbers, start)
+    ]
+
+
+def get_outcome_generator():
+    """Returns the generator configured in `settings.OUTCOME_GENERATOR`. It's created once per process."""
+    global _generator
+
+    if _generator is None:
+        backend = settings.OUTCOME_GENERATOR
+        _generator = import_string(backend['BACKEND'])(**backend.get('OPTIONS', {}))
+
+    return _generator
+
+
+@receiver(setting_changed)
+def reset_outcome_generator(setting, **kwargs):
+    global _generator
+
+    if setting == 'OUTCOME_GENERATOR':
+        _generator = None
+
+
+def draw_outcomes(user, count):
+    """The outcomes of the user's next `count` games and the stream position of the first, see `OutcomeGenerator`."""
+    return get_outcome_generator().draw(user, count)
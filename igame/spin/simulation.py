@@ -0,0 +1,325 @@
+"""
+Offline simulation of months of play, for tuning `SPIN_APP_SETTINGS`, the bonus types and the odds.
+
+Nothing is written to the database. Users are simulated in chunks. Each chunk keeps its users' wallets, bonus grants
+and money spent for wagering in NumPy arrays and moves all of them one step at a time. Every simulated day is a
+login, a deposit and `spins_per_day` spins.
+
+The bonuses are the ones the rules of the active bonus types give. They're evaluated once per event and deposit
+amount, so rules that look at the user's wallets can't be simulated. Games and wagering make the decisions of
+`spin.game_rules`, like `spin.game` and `spin.wagering` do, over the arrays. `check_against_orm` replays sampled
+users through the ORM to show the two agree, the tests run it with random settings.
+"""
+from collections import Counter, namedtuple
+from multiprocessing import Pool
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.contrib.auth.signals import user_logged_in
+from django.db import transaction as db_transaction
+from django.test import override_settings
+import numpy as np
+
+from .bonus_types import get_bonus_rules
+from .game_rules import (
+    is_a_bonus_transferable,
+    NO_GRANT,
+    NO_THRESHOLD,
+    pick_wallet_for_game,
+    wager_grant,
+    wagering_threshold,
+)
+from .constants import SPIN_APP_SETTINGS as app_settings
+from .deposit import deposit_real_money
+from .game import play_games
+from .models import BalanceTooLowError, BonusType, Game, Wallet
+from .money import Money
+from .wagering import MoneySpentForWagering
+from .wallets import get_user_wallets
+
+
+LOGIN = 'login'
+DEPOSIT = 'deposit'
+SPINS = 'spins'
+
+Plan = namedtuple(
+    'Plan', 'days spins_per_day login_probability deposit_probability deposit_amounts win_probability bet '
+            'wagering_requirement bonuses'
+)
+Plan.__doc__ = """
+What is simulated. Amounts are in cents. `bonuses` maps `LOGIN` and each deposit amount to the (money type, amount)
+of the bonuses given, see `get_bonuses`.
+"""
+
+Simulation = namedtuple('Simulation', 'totals logs states')
+Simulation.__doc__ = """
+`totals` are the sums of all users, `logs` the events of the recorded users and `states` their (real money, bonus,
+money spent) at the end.
+"""
+
+
+class BonusRuleContext:
+    """The `BonusContext` rules get in simulations, it has the event's data but no user or wallets."""
+
+    def __init__(self, **event_data):
+        self.user = None
+        self.wallets = None
+        self.event_data = event_data
+
+
+def evaluate_bonus_rules(event, **event_data):
+    context = BonusRuleContext(**event_data)
+    bonuses = [rule(context, bonus_type) for rule, bonus_type in get_bonus_rules(event)]
+
+    return [(bonus.money_type, Money(bonus.amount).cents) for bonus in bonuses if bonus is not None]
+
+
+def get_bonuses(deposit_amounts):
+    """The bonuses of a login and of each deposit amount, given by the rules of the active bonus types."""
+    bonuses = {LOGIN: evaluate_bonus_rules(BonusType.LOGIN)}
+    for amount in deposit_amounts:
+        bonuses[amount] = evaluate_bonus_rules(BonusType.REAL_MONEY_DEPOSIT, deposit_amount=Money.from_cents(amount))
+
+    return bonuses
+
+
+def get_plan(days, spins_per_day, login_probability, deposit_probability, deposit_amounts, win_probability=None):
+    """A `Plan` with the bet, the wagering requirement and the bonuses of `SPIN_APP_SETTINGS` and the bonus types."""
+    deposit_amounts = [Money(amount).cents for amount in deposit_amounts]
+    if win_probability is None:
+        win_probability = settings.OUTCOME_GENERATOR.get('OPTIONS', {}).get('win_probability', 0.5)
+
+    return Plan(
+        days, spins_per_day, login_probability, deposit_probability, deposit_amounts, win_probability,
+        app_settings['DEFAULT_GAME_LOSE_OR_WIN_AMOUNT'].cents, app_settings['BONUS_WAGERING_REQUIREMENT'],
+        get_bonuses(deposit_amounts),
+    )
+
+
+class SimulatedWallets:
+    """
+    The wallets of a chunk of simulated users, in cents.
+
+    Each user's bonus grants are a row of `grants`, in the order they were given, like their primary keys.
+    `thresholds` is what `get_wagering_threshold` would return for each user, `NO_THRESHOLD` for users without
+    bonus balance.
+    """
+
+    def __init__(self, users, wagering_requirement):
+        self.wagering_requirement = wagering_requirement
+        self.real_money = np.zeros(users, dtype=np.int64)
+        self.bonus = np.zeros(users, dtype=np.int64)
+        self.money_spent = np.zeros(users, dtype=np.int64)
+        self.grants = np.zeros((users, 1), dtype=np.int64)
+        self.requirements = np.zeros((users, 1), dtype=np.int64)
+        self.grant_counts = np.zeros(users, dtype=np.int64)
+        self.thresholds = np.full(users, NO_THRESHOLD, dtype=np.int64)
+        self.totals = Counter()
+
+    def state(self, user):
+        return int(self.real_money[user]), int(self.bonus[user]), int(self.money_spent[user])
+
+    def deposit(self, users, amount):
+        self.real_money[users] += amount
+        self.totals['deposited'] += amount * len(users)
+
+    def give_bonuses(self, users, bonuses):
+        """`give_bonuses` for the users with the (money type, amount) `bonuses`."""
+        for money_type, amount in bonuses:
+            if money_type == Wallet.REAL_MONEY:
+                self.real_money[users] += amount
+                self.totals['real money bonuses'] += amount * len(users)
+            else:
+                self.add_grants(users, amount)
+
+    def add_grants(self, users, amount):
+        if len(users) and self.grant_counts[users].max() == self.grants.shape[1]:
+            self.grants = np.hstack([self.grants, np.zeros_like(self.grants)])
+            self.requirements = np.hstack([self.requirements, np.zeros_like(self.requirements)])
+
+        columns = self.grant_counts[users]
+        self.grants[users, columns] = amount
+        self.requirements[users, columns] = self.wagering_requirement
+        self.grant_counts[users] += 1
+        self.bonus[users] += amount
+        self.totals['bonus grants'] += amount * len(users)
+        self.update_thresholds(users)
+
+    def user_grants(self, users):
+        """The users' grants and their requirements, without the columns none of them got a grant in yet."""
+        columns = self.grant_counts[users].max() if len(users) else 0
+        return self.grants[users, :columns], self.requirements[users, :columns]
+
+    def update_thresholds(self, users):
+        """Keeps the users' `wagering_threshold`, like the bonus wallet keeps it until its balance changes."""
+        grants, requirements = self.user_grants(users)
+        self.thresholds[users] = wagering_threshold(list(grants.T), list(requirements.T))
+
+    def spin(self, won, bet):
+        """
+        A game for every user, `won` by those `won` is true for, with the wallet and grant `pick_wallet_for_game`
+        picks. Users who can't afford it don't play. Wagering runs after every game, like it does when `play_game`
+        publishes the spent money event.
+        """
+        # users without bonus money have no grants with money, the others' are only looked at
+        real_money, grants = pick_wallet_for_game(self.real_money, self.bonus, [], bet)
+        with_bonus = np.flatnonzero(self.bonus > 0)
+        real_money[with_bonus], grants[with_bonus] = pick_wallet_for_game(
+            self.real_money[with_bonus], self.bonus[with_bonus], list(self.user_grants(with_bonus)[0].T), bet
+        )
+        bonus_users = np.flatnonzero(grants != NO_GRANT)
+
+        amounts = np.where(won, bet, -bet)
+        self.real_money += np.where(real_money, amounts, 0)
+        self.grants[bonus_users, grants[bonus_users]] += amounts[bonus_users]
+        self.bonus[bonus_users] += amounts[bonus_users]
+        self.update_thresholds(bonus_users)
+
+        played = real_money.copy()
+        played[bonus_users] = True
+        lost = played & ~won
+        self.money_spent[lost] += bet
+
+        spins = int(played.sum())
+        losses = int(lost.sum())
+        self.totals['spins'] += spins
+        self.totals['bonus spins'] += len(bonus_users)
+        self.totals['unaffordable spins'] += len(won) - spins
+        self.totals['lost'] += losses * bet
+        self.totals['won'] += (spins - losses) * bet
+
+        self.wager(np.flatnonzero(played & is_a_bonus_transferable(self.thresholds, self.money_spent)))
+
+    def wager(self, users):
+        """
+        `transfer_eligible_bonuses_to_real_money_wallet`: walks the users' grants in wagering order with `wager_grant`
+        and moves those it transfers.
+        """
+        if not len(users):
+            return
+
+        grants, requirements = self.user_grants(users)
+        # wagering order, the grants without balance last
+        order = np.argsort(np.where(grants > 0, grants, NO_THRESHOLD), axis=1, kind='stable')
+        balances = np.take_along_axis(grants, order, axis=1)
+        requirements = np.take_along_axis(requirements, order, axis=1)
+
+        money_spent = self.money_spent[users]
+        transferred = np.zeros_like(balances, dtype=bool)
+        wagering = True
+        for column in range(balances.shape[1]):
+            wagering, money_spent = wager_grant(balances[:, column], requirements[:, column], money_spent, wagering)
+            transferred[:, column] = wagering
+            if not wagering.any():
+                break
+
+        amounts = np.where(transferred, balances, 0).sum(axis=1)
+        wagered = self.money_spent[users] - money_spent
+        np.put_along_axis(grants, order, np.where(transferred, 0, balances), axis=1)
+        self.grants[users, :grants.shape[1]] = grants
+        self.bonus[users] -= amounts
+        self.real_money[users] += amounts
+        self.money_spent[users] -= wagered
+        self.update_thresholds(users)
+
+        self.totals['transferred'] += int(amounts.sum())
+        self.totals['wagered'] += int(wagered.sum())
+
+
+def simulate_chunk(plan, users, seed, recorded=0):
+    """Simulates `users` users with the NumPy generator seeded with `seed`, recording the events of the first few."""
+    random = np.random.default_rng(seed)
+    wallets = SimulatedWallets(users, plan.wagering_requirement)
+    logs = [[] for _ in range(recorded)]
+
+    for _ in range(plan.days):
+        logins = random.random(users) < plan.login_probability
+        deposits = random.random(users) < plan.deposit_probability
+        deposit_amounts = random.choice(plan.deposit_amounts, users)
+        won = random.random((plan.spins_per_day, users)) < plan.win_probability
+
+        wallets.give_bonuses(np.flatnonzero(logins), plan.bonuses[LOGIN])
+        for amount in plan.deposit_amounts:
+            depositing = np.flatnonzero(deposits & (deposit_amounts == amount))
+            wallets.deposit(depositing, amount)
+            wallets.give_bonuses(depositing, plan.bonuses[amount])
+        for spin in range(plan.spins_per_day):
+            wallets.spin(won[spin], plan.bet)
+
+        for user, log in enumerate(logs):
+            if logins[user]:
+                log.append((LOGIN, None))
+            if deposits[user]:
+                log.append((DEPOSIT, int(deposit_amounts[user])))
+            log.append((SPINS, [Game.WON if outcome else Game.LOST for outcome in won[:, user]]))
+
+    wallets.totals['real money balance'] = int(wallets.real_money.sum())
+    wallets.totals['bonus balance'] = int(wallets.bonus.sum())
+    wallets.totals['users'] = users
+
+    return Simulation(wallets.totals, logs, [wallets.state(user) for user in range(recorded)])
+
+
+def simulate(plan, users, seed=None, processes=1, chunk_size=10000, recorded=0):
+    """
+    Simulates `users` users in chunks of `chunk_size`, on `processes` processes. Chunks get seeds of their own from
+    `seed`, so the results don't depend on the number of processes. The first `recorded` users are recorded.
+    """
+    chunks = [min(chunk_size, users - first) for first in range(0, users, chunk_size)]
+    seeds = np.random.SeedSequence(seed).spawn(len(chunks))
+    arguments = [(plan, size, chunk_seed, min(recorded, size) if number == 0 else 0)
+                 for number, (size, chunk_seed) in enumerate(zip(chunks, seeds))]
+
+    if processes > 1:
+        with Pool(processes) as pool:
+            results = pool.starmap(simulate_chunk, arguments)
+    else:
+        results = [simulate_chunk(*chunk) for chunk in arguments]
+
+    return Simulation(sum((result.totals for result in results), Counter()), results[0].logs, results[0].states)
+
+
+def replay_through_orm(plan, log, username):
+    """
+    Plays the events of a simulated user's `log` for a new user through the ORM, with the bonus and wagering work of
+    the outbox done right away, and returns the user's (real money, bonus, money spent) in cents.
+    """
+    user = User.objects.create(username=username)
+    bet = Money.from_cents(plan.bet)
+
+    with override_settings(OUTBOX_EVENTS=False):
+        for event, data in log:
+            if event == LOGIN:
+                user_logged_in.send(sender=User, request=None, user=user)
+            elif event == DEPOSIT:
+                deposit_real_money(user, Money.from_cents(data))
+            else:
+                try:
+                    play_games(user, data, bet)
+                except BalanceTooLowError:
+                    pass
+
+    wallets = get_user_wallets(user)
+    bonus_wallet = wallets.bonus
+    return (
+        wallets.real_money.current_balance.cents,
+        bonus_wallet.current_balance.cents if bonus_wallet else 0,
+        MoneySpentForWagering(user.pk).total.cents,
+    )
+
+
+def check_against_orm(plan, simulation, username_prefix='simulated-'):
+    """
+    Replays the recorded users of `simulation` through the ORM in a database transaction that's rolled back, and
+    returns the (user, simulated state, ORM state) of those that ended differently.
+    """
+    mismatches = []
+
+    with db_transaction.atomic():
+        for user, (log, state) in enumerate(zip(simulation.logs, simulation.states)):
+            orm_state = replay_through_orm(plan, log, '{}{}'.format(username_prefix, user))
+            if orm_state != state:
+                mismatches.append((user, state, orm_state))
+        db_transaction.set_rollback(True)
+
+    return mismatches
@@ -1,26 +1,81 @@
+import asyncio
+from collections import defaultdict
+import datetime
 from decimal import Decimal
+from io import StringIO
+import json
+import re
+import threading
 import unittest
-from unittest import skip
+from unittest import mock
 
 from django.contrib.auth.models import User
-from django.test import TestCase
-
-from .bonus import create_default_bonus_types, give_user_a_bonus
+from django.core.management import call_command
+from django.db import connection, connections, OperationalError, transaction as db_transaction
+from django.db.migrations.executor import MigrationExecutor
+from django.db.models import F
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from fakeredis import FakeConnection, FakeServer
+from hypothesis import given, settings, strategies as st
+from hypothesis.extra.django import TestCase as HypothesisTestCase
+import numpy as np
+
+from .asgi import ASGIHandler
+from .bonus import create_default_bonus_types, give_user_a_bonus, handle_bonus_event
+from .bonus_types import bonus_rule, get_bonus_rules, invalidate_bonus_types
+from .constants import SPIN_APP_SETTINGS as app_settings
 from .deduct import deduct_real_money__user_lost_game, get_wallet_for_game, negify
 from .deposit import deposit_real_money
-from .game import play_game, reward_user
+from .game import play_game, play_games, play_random_game, play_random_games, reward_user
+from .game_rules import is_a_bonus_transferable, pick_wallet_for_game, wager_grant, wagering_threshold
+from .history import archive_spins, drop_archived_months, get_user_spins, month_start
+from .ledger import reconcile_wallets
+from .middleware import logger as metrics_logger
 from .models import (
+    ApiToken,
+    ArchivedSpin,
     BalanceTooLowError,
+    BonusGrant,
     BonusTransaction,
     BonusType,
+    BonusWageredTransaction,
     DepositTransaction,
+    DroppedSpinsTotal,
     Game,
+    OutboxEvent,
+    OutcomeStream,
     SpinGameTransaction,
     Transaction,
+    user_made_deposit_signal,
+    user_spendt_money_signal,
     Wallet,
+    WalletChangedError,
+    WalletSnapshot,
+)
+from .money import Money
+from .outbox import drain_outbox
+from .outcomes import BufferedOutcomes, OutcomeGenerator, replay_outcomes, seeded_numbers
+from .simulation import check_against_orm, get_bonuses, get_plan, LOGIN, simulate
+from .sqlite import apply_sqlite_pragmas
+from .wagering import (
+    calculate_money_spent_totals,
+    get_wagering_threshold,
+    MoneySpentForWagering,
+    transfer_eligible_bonuses_to_real_money_wallet,
 )
-from .wagering import MoneySpentForWagering, transfer_eligible_bonuses_to_real_money_wallet
-from redis.fake_redis import FakeReadis, fake_redis
+from .wallets import (
+    change_wallet_balance,
+    get_user_wallets,
+    retries_when_database_is_locked,
+    WALLETS_CHANGED_CHANNEL,
+)
+from counters import get_counters
+from counters.fake_redis import FakeReadis, fake_redis
+from counters.redis_client import RedisCounters
+from pubsub.in_process import InProcessBroker
+from pubsub.redis_client import RedisBroker
 
 
 class TestDepositRealMoneyFunction(TestCase):
@@ -44,6 +99,42 @@ class TestDepositRealMoneyFunction(TestCase):
             deposit_amount
         )
 
+    def test_deposit_of_more_than_999(self):
+        create_default_bonus_types()
+        deposit_real_money(self.user, Decimal('1234567.89'))
+
+        wallet = Wallet.objects.get(user=self.user, money_type=Wallet.REAL_MONEY)
+        self.assertEqual(wallet.current_balance, Money('1234567.89'))
+        self.assertEqual(DepositTransaction.objects.get().transaction.amount, Decimal('1234567.89'))
+
+
+class TestMoney(unittest.TestCase):
+
+    def test_amount_is_kept_in_cents(self):
+        self.assertEqual(Money('10.50').cents, 1050)
+        self.assertEqual(Money(3).cents, 300)
+        self.assertEqual(Money.from_cents(1050), Money('10.50'))
+
+    def test_fractions_of_a_cent_are_rounded_half_up(self):
+        self.assertEqual(Money('0.005').cents, 1)
+        self.assertEqual(Money('0.004').cents, 0)
+        self.assertEqual(Money('-0.005').cents, -1)
+
+    def test_arithmetic(self):
+        self.assertEqual(Money('0.10') + Money('0.20'), Money('0.30'))
+        self.assertEqual(Money(5) - 2, Money(3))
+        self.assertEqual(10 - Money('0.01'), Money('9.99'))
+        self.assertEqual(-Money(2), Money(-2))
+        self.assertEqual(Money('1.50') * 10, Money(15))
+        self.assertEqual(sum([Money(1), Money(2)]), Money(3))
+
+    def test_compares_with_decimals_and_ints(self):
+        self.assertEqual(Money('2.50'), Decimal('2.5'))
+        self.assertLess(Money(2), 3)
+        self.assertGreater(Money('0.01'), Decimal(0))
+        self.assertFalse(Money(0))
+        self.assertEqual(str(Money(2)), '2.00')
+
 
 class TestDecudtRealMoneyFunctionBecauseUserLostFunction(TestCase):
 
@@ -160,10 +251,10 @@ class TestDecudtRealMoneyFunctionBecauseUserLostFunction(TestCase):
 
     def test_after_money_is_deducted_wallets_have_correct_balance__3(self):
         """
-        user has 1 real money wallet and 2 bonus wallets
+        user has 1 real money wallet and a bonus wallet with 2 bonuses
         real money wallet doesn't have enough money in it
-        first bonus wallet has enough money in it, so it gets charged
-        second bonus wallet doesn't get charged
+        first bonus has enough money in it, so it gets charged
+        second bonus doesn't get charged
         """
         create_default_bonus_types()
         bonus_amount = Decimal(15)
@@ -179,23 +270,21 @@ class TestDecudtRealMoneyFunctionBecauseUserLostFunction(TestCase):
             self.beginning_wallet_balance
         )
         self.assertEqual(
-            Wallet.objects.filter(user=self.user, money_type=Wallet.BONUS).first().current_balance,
-            bonus_amount-deduct_amount
-        )
-        self.assertEqual(
-            Wallet.objects.filter(user=self.user, money_type=Wallet.BONUS).last().current_balance,
-            bonus_amount
+            Wallet.objects.get(user=self.user, money_type=Wallet.BONUS).current_balance,
+            bonus_amount*2-deduct_amount
         )
+        self.assertEqual(BonusGrant.objects.order_by('id').first().balance, bonus_amount-deduct_amount)
+        self.assertEqual(BonusGrant.objects.order_by('id').last().balance, bonus_amount)
         self.assertEqual(Transaction.objects.count(), prev_num_transactions+1)
         self.assertEqual(Game.objects.count(), 1)
         self.assertEqual(SpinGameTransaction.objects.count(), 1)
 
     def test_after_money_is_deducted_wallets_have_correct_balance__4(self):
         """
-        user has 1 real money wallet and 2 bonus wallets
+        user has 1 real money wallet and a bonus wallet with 2 bonuses
         real money wallet doesn't have enough money in it
-        first bonus wallet doesn't have enough money in it
-        second bonus wallet gets charged
+        first bonus doesn't have enough money in it
+        second bonus gets charged
         """
         create_default_bonus_types()
         bonus_amount = Decimal(23)
@@ -211,13 +300,11 @@ class TestDecudtRealMoneyFunctionBecauseUserLostFunction(TestCase):
             self.beginning_wallet_balance
         )
         self.assertEqual(
-            Wallet.objects.filter(user=self.user, money_type=Wallet.BONUS).first().current_balance,
+            Wallet.objects.get(user=self.user, money_type=Wallet.BONUS).current_balance,
             bonus_amount
         )
-        self.assertEqual(
-            Wallet.objects.filter(user=self.user, money_type=Wallet.BONUS).last().current_balance,
-            0
-        )
+        self.assertEqual(BonusGrant.objects.order_by('id').first().balance, bonus_amount)
+        self.assertEqual(BonusGrant.objects.order_by('id').last().balance, 0)
         self.assertEqual(Transaction.objects.count(), prev_num_transactions+1)
         self.assertEqual(Game.objects.count(), 1)
         self.assertEqual(SpinGameTransaction.objects.count(), 1)
@@ -253,6 +340,18 @@ class GiveUserBonusFunction(TestCase):
             Wallet.objects.get(money_type=Wallet.BONUS).current_balance, bonus_amount
         )
 
+    def test_bonuses_share_one_bonus_wallet(self):
+        give_user_a_bonus(self.user, self.login_bonus_type, Decimal(10))
+        give_user_a_bonus(self.user, self.money_deposit_bonus_type, Decimal(5))
+
+        wallet = Wallet.objects.get(money_type=Wallet.BONUS)
+        self.assertEqual(wallet.current_balance, Decimal(15))
+        self.assertEqual(
+            list(wallet.bonus_grants.order_by('id').values_list('bonus_type', 'balance')),
+            [(self.login_bonus_type.pk, Decimal(10)), (self.money_deposit_bonus_type.pk, Decimal(5))]
+        )
+        self.assertEqual(Transaction.objects.filter(wallet=wallet).count(), 2)
+
 
 class RewardUser(TestCase):
 
@@ -295,6 +394,284 @@ class RewardUser(TestCase):
         self.assertEqual(Game.objects.count(), 1)
         self.assertEqual(Transaction.objects.count(), 2) # 1 for money deposit 1 for reward
 
+    def test_user_wins_and_money_is_rewarded_to_oldest_bonus_that_can_afford_the_bet(self):
+        create_default_bonus_types()
+        give_user_a_bonus(self.user, BonusType.objects.get(event=BonusType.LOGIN), Decimal(1))
+        give_user_a_bonus(self.user, BonusType.objects.get(event=BonusType.LOGIN), Decimal(3))
+        give_user_a_bonus(self.user, BonusType.objects.get(event=BonusType.LOGIN), Decimal(4))
+
+        reward_user(self.user, Decimal(2))
+
+        self.assertEqual(Wallet.objects.get(money_type=Wallet.BONUS).current_balance, Decimal(10))
+        self.assertEqual(
+            list(BonusGrant.objects.order_by('id').values_list('balance', flat=True)),
+            [Decimal(1), Decimal(5), Decimal(4)]
+        )
+
+
+# separate games only match a batch when wagering runs right after every game
+@override_settings(OUTBOX_EVENTS=False)
+class TestPlayGames(TestCase):
+
+    def setUp(self):
+        create_default_bonus_types()
+        self.one_by_one_user = User.objects.create(username='one-by-one')
+        self.batch_user = User.objects.create(username='batch')
+
+        for user in (self.one_by_one_user, self.batch_user):
+            deposit_real_money(user, Decimal(5))
+            give_user_a_bonus(user, BonusType.objects.get(event=BonusType.LOGIN), Decimal(3))
+            give_user_a_bonus(user, BonusType.objects.get(event=BonusType.LOGIN), Decimal(4))
+
+    def tearDown(self):
+        fake_redis.clear()
+
+    def ledger(self, user):
+        wallet_positions = {w.id: i for i, w in enumerate(user.wallets.order_by('id'))}
+        spins = SpinGameTransaction.objects.filter(transaction__wallet__user=user).order_by('id')
+
+        return (
+            [(s.game.outcome, wallet_positions[s.transaction.wallet_id], s.transaction.amount) for s in spins],
+            [w.current_balance for w in user.wallets.order_by('id')],
+        )
+
+    def play_one_by_one(self, outcomes, bet_amount):
+        played = []
+        for outcome in outcomes:
+            try:
+                play_game(self.one_by_one_user, outcome, bet_amount)
+            except BalanceTooLowError:
+                break
+            played.append(outcome)
+
+        return played
+
+    def test_batch_writes_the_same_ledger_as_separate_games(self):
+        outcomes = [Game.LOST, Game.WON, Game.LOST, Game.LOST, Game.LOST, Game.WON, Game.LOST]
+
+        self.assertEqual(play_games(self.batch_user, outcomes, Decimal(2)), self.play_one_by_one(outcomes, Decimal(2)))
+        self.assertEqual(self.ledger(self.batch_user), self.ledger(self.one_by_one_user))
+
+    def test_batch_stops_when_user_runs_out_of_money_like_separate_games_do(self):
+        outcomes = [Game.LOST] * 10
+
+        played = play_games(self.batch_user, outcomes, Decimal(2))
+
+        self.assertEqual(played, self.play_one_by_one(outcomes, Decimal(2)))
+        self.assertLess(len(played), len(outcomes))
+        self.assertEqual(self.ledger(self.batch_user), self.ledger(self.one_by_one_user))
+
+    def test_batch_raises_when_no_game_can_be_played(self):
+        with self.assertRaises(BalanceTooLowError):
+            play_games(self.batch_user, [Game.WON], Decimal(50))
+
+        self.assertEqual(Game.objects.count(), 0)
+
+    def test_count_plays_that_many_random_games(self):
+        prev_num_games = Game.objects.count()
+
+        self.assertEqual(len(play_games(self.batch_user, 3, Decimal(1))), 3)
+        self.assertEqual(Game.objects.count(), prev_num_games+3)
+        self.assertEqual(SpinGameTransaction.objects.count(), 3)
+
+
+class TestOutcomeGenerators(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='test-user')
+        deposit_real_money(self.user, 100)
+
+    def test_seeded_games_keep_their_position_in_the_users_stream(self):
+        outcomes = play_random_games(self.user, 5) + [play_random_game(self.user)]
+
+        games = Game.objects.order_by('pk')
+        self.assertEqual([game.outcome_position for game in games], list(range(6)))
+        self.assertEqual([outcome for _, _, outcome in replay_outcomes(self.user)], outcomes)
+        self.assertEqual(OutcomeStream.objects.get(user=self.user).position, 6)
+
+    def test_failed_spin_does_not_move_the_stream(self):
+        Wallet.objects.filter(user=self.user).update(current_balance=0)
+
+        with self.assertRaises(BalanceTooLowError):
+            play_random_game(self.user)
+
+        self.assertFalse(OutcomeStream.objects.filter(user=self.user).exists())
+
+    def test_users_get_streams_of_their_own(self):
+        other_user = User.objects.create(username='other-user')
+        deposit_real_money(other_user, 100)
+
+        play_random_games(self.user, 3)
+        play_random_games(other_user, 3)
+
+        seeds = OutcomeStream.objects.values_list('seed', flat=True)
+        self.assertNotEqual(seeds.get(user=self.user), seeds.get(user=other_user))
+        self.assertEqual(Game.objects.filter(outcome_position=2).count(), 2)
+
+    def test_seeded_numbers_dont_depend_on_where_the_draw_starts(self):
+        seed = '00' * 32
+
+        self.assertEqual(seeded_numbers(seed, 3, 10), seeded_numbers(seed, 0, 13)[3:])
+        self.assertEqual(len(seeded_numbers(seed, 7, 1)), 1)
+
+    @override_settings(OUTCOME_GENERATOR={
+        'BACKEND': 'spin.outcomes.BufferedOutcomes', 'OPTIONS': {'win_probability': 1, 'block_size': 4},
+    })
+    def test_buffered_outcomes_follow_the_win_probability(self):
+        self.assertEqual(play_random_games(self.user, 10), [Game.WON] * 10)
+        self.assertEqual(Game.objects.filter(outcome_position__isnull=True).count(), 10)
+        self.assertFalse(OutcomeStream.objects.exists())
+
+    def test_buffered_outcomes_are_handed_out_once(self):
+        generator = BufferedOutcomes(block_size=4)
+
+        outcomes, position = generator.draw(self.user, 6)
+
+        self.assertEqual(len(outcomes), 6)
+        self.assertIsNone(position)
+        self.assertEqual(len(generator.buffer), 2)
+
+    def test_win_probability_sets_the_return_to_player(self):
+        self.assertEqual(OutcomeGenerator(win_probability=0.485).return_to_player, 0.97)
+        with self.assertRaises(ValueError):
+            OutcomeGenerator(win_probability=1.5)
+
+    def test_replay_reports_spins_that_dont_match_their_seed(self):
+        play_random_games(self.user, 4)
+        game = Game.objects.get(outcome_position=2)
+        Game.objects.filter(pk=game.pk).update(outcome=Game.WON if game.outcome == Game.LOST else Game.LOST)
+        out = StringIO()
+
+        call_command('replay_outcomes', 'test-user', quiet=True, stdout=out)
+
+        self.assertIn('Replayed 4 outcomes, 4 played, 1 mismatched', out.getvalue())
+        self.assertTrue(out.getvalue().startswith('2: '))
+
+
+class TestSimulation(TestCase):
+
+    def setUp(self):
+        create_default_bonus_types()
+        self.overrides = {
+            'DEFAULT_GAME_LOSE_OR_WIN_AMOUNT': Money(10),
+            'LOGIN_BONUS_AMOUNT': Money(1),
+            'DEFAULT_MONEY_DEPOSIT_BONUS_AMOUNT': Money(30),
+            'BONUS_WAGERING_REQUIREMENT': 20,
+        }
+        with mock.patch.dict(app_settings, self.overrides):
+            self.plan = get_plan(10, 30, 0.5, 0.3, ['50', '150'], win_probability=0.48)
+
+    def tearDown(self):
+        fake_redis.clear()
+
+    def test_bonuses_are_those_of_the_rules(self):
+        bonuses = get_bonuses([Money(50).cents, Money(150).cents])
+
+        self.assertEqual(bonuses[LOGIN], [(Wallet.REAL_MONEY, Money(100).cents)])
+        self.assertEqual(bonuses[Money(50).cents], [])
+        self.assertEqual(bonuses[Money(150).cents], [(Wallet.BONUS, Money(10).cents)])
+
+    def test_simulated_users_end_like_users_played_through_the_database(self):
+        simulation = simulate(self.plan, 40, seed=1, recorded=20)
+
+        self.assertGreater(simulation.totals['bonus spins'], 0)
+        self.assertGreater(simulation.totals['transferred'], 0)
+        # the database gives the bonuses of the rules with the settings of the plan
+        with mock.patch.dict(app_settings, self.overrides):
+            self.assertEqual(check_against_orm(self.plan, simulation), [])
+        self.assertFalse(User.objects.filter(username__startswith='simulated-').exists())
+
+    def test_results_dont_depend_on_the_number_of_processes(self):
+        in_one_process = simulate(self.plan, 30, seed=1, chunk_size=10)
+        in_two_processes = simulate(self.plan, 30, seed=1, processes=2, chunk_size=10)
+
+        self.assertEqual(in_one_process.totals, in_two_processes.totals)
+        self.assertEqual(in_one_process.totals['users'], 30)
+
+
+    def test_simulate_play_cross_checks_the_simulation_against_the_database(self):
+        out = StringIO()
+
+        call_command(
+            'simulate_play', users=20, days=10, spins_per_day=30, deposit_probability=0.3, deposit_amounts='50,150',
+            win_probability=0.48, bet=Money(10), login_bonus=Money(1), deposit_bonus=Money(30),
+            wagering_requirement=20, seed=1, check=20, stdout=out,
+        )
+
+        self.assertIn('Cross-checked 20 users through the database', out.getvalue())
+        self.assertIn('0 mismatched', out.getvalue())
+
+
+class TestSimulationAgreesWithTheDatabase(HypothesisTestCase):
+    """The simulation has its own copy of the game and wagering rules, so it's checked with any settings."""
+
+    def tearDown(self):
+        fake_redis.clear()
+
+    @settings(max_examples=20, deadline=None)
+    @given(
+        bet=st.integers(1, 20),
+        login_bonus=st.integers(0, 50),
+        deposit_bonus=st.integers(0, 50),
+        wagering_requirement=st.integers(0, 30),
+        win_probability=st.sampled_from([0, 0.3, 0.5, 0.7, 1]),
+        seed=st.integers(0, 1000),
+    )
+    def test_simulated_users_end_like_users_played_through_the_database(
+            self, bet, login_bonus, deposit_bonus, wagering_requirement, win_probability, seed):
+        # examples are rolled back one by one, but the counters of the users they created are kept
+        fake_redis.clear()
+        create_default_bonus_types()
+        overrides = {
+            'DEFAULT_GAME_LOSE_OR_WIN_AMOUNT': Money(bet),
+            'LOGIN_BONUS_AMOUNT': Money(login_bonus),
+            'DEFAULT_MONEY_DEPOSIT_BONUS_AMOUNT': Money(deposit_bonus),
+            'BONUS_WAGERING_REQUIREMENT': wagering_requirement,
+        }
+
+        with mock.patch.dict(app_settings, overrides):
+            plan = get_plan(5, 10, 0.5, 0.3, ['20', '150'], win_probability=win_probability)
+            simulation = simulate(plan, 5, seed=seed, recorded=5)
+
+            self.assertEqual(check_against_orm(plan, simulation), [])
+
+
+users_grants = st.lists(
+    st.tuples(st.integers(0, 50), st.integers(0, 50), st.lists(st.integers(0, 30), min_size=3, max_size=3)),
+    min_size=1, max_size=10,
+)
+
+
+class TestGameRules(SimpleTestCase):
+    """The database code calls the rules with one user's numbers, the simulation with arrays of many users."""
+
+    def columns(self, values):
+        return [np.array(column, dtype=np.int64) for column in zip(*values)]
+
+    @settings(max_examples=200, deadline=None)
+    @given(users_grants, st.integers(1, 20), st.integers(0, 30), st.integers(0, 200))
+    def test_arrays_of_users_get_the_decisions_each_user_gets(self, users, bet, requirement, money_spent):
+        real_money = np.array([user_real_money for user_real_money, _, _ in users], dtype=np.int64)
+        bonus = np.array([user_bonus for _, user_bonus, _ in users], dtype=np.int64)
+        grants = self.columns([user_grants for _, _, user_grants in users])
+        requirements = [np.full(len(users), requirement, dtype=np.int64)] * 3
+
+        with_real_money, grant = pick_wallet_for_game(real_money, bonus, grants, bet)
+        thresholds = wagering_threshold(grants, requirements)
+        transferable = is_a_bonus_transferable(thresholds, money_spent)
+        wagering, money_spent_left = wager_grant(grants[0], requirements[0], np.full(len(users), money_spent))
+
+        for index, (user_real_money, user_bonus, user_grants) in enumerate(users):
+            self.assertEqual(
+                pick_wallet_for_game(user_real_money, user_bonus, user_grants, bet),
+                (with_real_money[index], grant[index])
+            )
+            threshold = wagering_threshold(user_grants, [requirement] * 3)
+            self.assertEqual(threshold, thresholds[index])
+            self.assertEqual(is_a_bonus_transferable(threshold, money_spent), transferable[index])
+            self.assertEqual(
+                wager_grant(user_grants[0], requirement, money_spent), (wagering[index], money_spent_left[index])
+            )
 
 class TestDepositRealMoney(TestCase):
 
@@ -319,6 +696,152 @@ class TestUserLogin(TestCase):
         pass
 
 
+class TestBonusTypes(TestCase):
+
+    def setUp(self):
+        create_default_bonus_types()
+        self.user = User.objects.create(username='test-user')
+
+    def test_bonus_types_are_looked_up_without_queries_once_loaded(self):
+        rules = get_bonus_rules(BonusType.LOGIN)
+
+        with self.assertNumQueries(0):
+            self.assertEqual(get_bonus_rules(BonusType.LOGIN), rules)
+            self.assertEqual(
+                [bonus_type.event for _, bonus_type in get_bonus_rules(BonusType.REAL_MONEY_DEPOSIT)],
+                [BonusType.REAL_MONEY_DEPOSIT]
+            )
+
+    def test_saving_a_bonus_type_reloads_them(self):
+        handle_bonus_event(BonusType.LOGIN, self.user)
+        bonus_type = BonusType.objects.get(event=BonusType.LOGIN)
+        bonus_type.active = False
+        bonus_type.save()
+
+        handle_bonus_event(BonusType.LOGIN, self.user)
+        self.assertEqual(BonusTransaction.objects.count(), 1)
+
+        new_bonus_type = BonusType.objects.create(active=True, event=BonusType.LOGIN)
+        handle_bonus_event(BonusType.LOGIN, self.user)
+        self.assertEqual(BonusTransaction.objects.latest('pk').bonus_type, new_bonus_type)
+
+        new_bonus_type.delete()
+        handle_bonus_event(BonusType.LOGIN, self.user)
+        self.assertEqual(
+            Wallet.objects.get(user=self.user, money_type=Wallet.REAL_MONEY).current_balance,
+            2 * app_settings['LOGIN_BONUS_AMOUNT']
+        )
+
+    def test_no_login_bonus_when_its_bonus_type_is_inactive(self):
+        BonusType.objects.filter(event=BonusType.LOGIN).get().delete()
+        BonusType.objects.create(active=False, event=BonusType.LOGIN)
+
+        self.client.force_login(self.user)
+
+        self.assertEqual(get_user_wallets(self.user).real_money.current_balance, 0)
+        self.assertEqual(BonusTransaction.objects.count(), 0)
+
+    def test_login_bonus_is_given_with_the_active_bonus_type(self):
+        self.client.force_login(self.user)
+
+        self.assertEqual(
+            Wallet.objects.get(user=self.user, money_type=Wallet.REAL_MONEY).current_balance,
+            app_settings['LOGIN_BONUS_AMOUNT']
+        )
+        self.assertEqual(BonusTransaction.objects.get().bonus_type, BonusType.objects.get(event=BonusType.LOGIN))
+
+
+
+class TestBonusRules(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='test-user')
+        # the registry compiled with a test's rules outlives them, and rolled back bonus types don't send signals
+        self.addCleanup(invalidate_bonus_types)
+
+    def deposit_bonus_types(self, count, **fields):
+        return [BonusType.objects.create(event=BonusType.REAL_MONEY_DEPOSIT, **fields) for _ in range(count)]
+
+    @mock.patch('spin.bonus_types._rules', defaultdict(list))
+    def test_rules_are_evaluated_for_each_active_bonus_type_against_one_context(self):
+        first = BonusType.objects.create(active=True, event='test_event')
+        BonusType.objects.create(active=False, event='test_event')
+        second = BonusType.objects.create(active=True, event='test_event')
+        calls = []
+
+        @bonus_rule('test_event')
+        def record(context, bonus_type):
+            calls.append((context, bonus_type))
+
+        handle_bonus_event('test_event', self.user, amount=1)
+        with self.assertNumQueries(0):
+            handle_bonus_event(BonusType.LOGIN, self.user)
+
+        self.assertEqual([bonus_type for _, bonus_type in calls], [first, second])
+        self.assertIs(calls[0][0], calls[1][0])
+        self.assertEqual(calls[0][0].user, self.user)
+        self.assertEqual(calls[0][0].event_data, {'amount': 1})
+
+    def test_rule_parameters_of_the_bonus_types_are_used(self):
+        small, = self.deposit_bonus_types(1, amount=Money(3), min_deposit_amount=Money(5))
+        large, = self.deposit_bonus_types(1, amount=Money(7), min_deposit_amount=Money(50))
+
+        handle_bonus_event(BonusType.REAL_MONEY_DEPOSIT, self.user, deposit_amount=Money(10))
+
+        self.assertEqual(list(BonusGrant.objects.values_list('bonus_type', 'balance')), [(small.pk, 3)])
+        self.assertEqual(get_user_wallets(self.user).bonus.current_balance, 3)
+
+    def test_the_bonuses_of_all_rules_are_given_with_the_same_queries(self):
+        self.deposit_bonus_types(1)
+        handle_bonus_event(BonusType.REAL_MONEY_DEPOSIT, self.user, deposit_amount=Money(1000))
+        with CaptureQueriesContext(connection) as one_rule:
+            handle_bonus_event(BonusType.REAL_MONEY_DEPOSIT, self.user, deposit_amount=Money(1000))
+
+        self.deposit_bonus_types(49)
+        get_bonus_rules(BonusType.REAL_MONEY_DEPOSIT)
+        with CaptureQueriesContext(connection) as fifty_rules:
+            handle_bonus_event(BonusType.REAL_MONEY_DEPOSIT, self.user, deposit_amount=Money(1000))
+
+        self.assertEqual(len(fifty_rules), len(one_rule))
+        self.assertEqual(BonusGrant.objects.count(), 52)
+        self.assertEqual(BonusTransaction.objects.count(), 52)
+        self.assertEqual(
+            Wallet.objects.get(user=self.user, money_type=Wallet.BONUS).current_balance,
+            52 * app_settings['DEFAULT_MONEY_DEPOSIT_BONUS_AMOUNT']
+        )
+        wallet_ids = list(Wallet.objects.filter(user=self.user).values_list('pk', flat=True))
+        self.assertEqual(reconcile_wallets(wallet_ids), [])
+
+
+
+class TestUserWallets(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='test-user')
+        create_default_bonus_types()
+        give_user_a_bonus(self.user, BonusType.objects.get(event=BonusType.LOGIN), Decimal(10))
+
+    def tearDown(self):
+        fake_redis.clear()
+
+    def test_all_wallets_are_loaded_with_one_query(self):
+        with self.assertNumQueries(1):
+            wallets = get_user_wallets(self.user)
+            self.assertEqual(wallets.real_money.money_type, Wallet.REAL_MONEY)
+            self.assertEqual(wallets.bonus.money_type, Wallet.BONUS)
+            get_user_wallets(self.user)
+
+    def test_wallets_are_reloaded_after_they_change(self):
+        get_user_wallets(self.user)
+        deposit_real_money(self.user, Decimal(10))
+
+        self.assertEqual(get_user_wallets(self.user).real_money.current_balance, Decimal(10))
+
+    def test_game_is_played_with_first_wallet_that_has_enough_money(self):
+        self.assertEqual(get_user_wallets(self.user).for_game(Decimal(5)).money_type, Wallet.BONUS)
+        with self.assertRaises(BalanceTooLowError):
+            get_user_wallets(self.user).for_game(Decimal(11))
+
 
 class TestRedisFakerClass(unittest.TestCase):
 
@@ -326,7 +849,7 @@ class TestRedisFakerClass(unittest.TestCase):
         self.redis = FakeReadis()
 
     def tearDown(self):
-        self.redis.storage = dict()
+        self.redis.clear()
 
     def test_set_and_get_two_keys(self):
         self.redis.set('a', 10)
@@ -351,6 +874,87 @@ class TestRedisFakerClass(unittest.TestCase):
         self.assertEqual(len(fake_redis.storage), 0)
         self.assertEqual(len(FakeReadis.storage), 0)
 
+    def test_increments_from_many_threads_are_not_lost(self):
+        self.redis.set('a', 0)
+
+        def increment():
+            for _ in range(1000):
+                self.redis.incr('a', 1)
+
+        threads = [threading.Thread(target=increment) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(self.redis.get('a'), 8000)
+
+
+class TestRedisCounters(unittest.TestCase):
+
+    def setUp(self):
+        self.server = FakeServer()
+        self.redis = RedisCounters(connection_class=FakeConnection, server=self.server)
+
+    def test_set_and_get_value(self):
+        self.redis.set('a', 1050)
+
+        self.assertEqual(self.redis.get('a'), 1050)
+        self.assertIsNone(self.redis.get('b'))
+
+    def test_increment_and_decrement_value(self):
+        self.redis.set('a', 1000)
+        self.redis.incr('a', 225)
+        self.assertEqual(self.redis.get('a'), 1225)
+
+        self.redis.decr('a', 1225)
+        self.assertEqual(self.redis.get('a'), 0)
+
+    def test_clear_only_removes_own_keys(self):
+        other = RedisCounters(key_prefix='other:', connection_class=FakeConnection, server=self.server)
+        self.redis.set('a', 1)
+        other.set('a', 2)
+
+        self.redis.clear()
+
+        self.assertIsNone(self.redis.get('a'))
+        self.assertEqual(other.get('a'), 2)
+
+
+class TestRedisBroker(unittest.TestCase):
+
+    def setUp(self):
+        self.server = FakeServer()
+        self.broker = RedisBroker(connection_class=FakeConnection, server=self.server)
+        self.received = []
+        self.delivered = threading.Event()
+
+    def receive(self, message):
+        self.received.append(message)
+        self.delivered.set()
+
+    def test_subscribers_hear_messages_of_other_processes(self):
+        self.broker.subscribe('a', self.receive)
+        other_process = RedisBroker(connection_class=FakeConnection, server=self.server)
+
+        other_process.publish('b', 'not subscribed')
+        other_process.publish('a', '42')
+
+        self.assertTrue(self.delivered.wait(2))
+        self.assertEqual(self.received, ['42'])
+
+    def test_unsubscribed_callbacks_are_not_called(self):
+        self.broker.subscribe('a', self.receive)
+        self.broker.unsubscribe('a', self.receive)
+        in_process = InProcessBroker()
+        in_process.subscribe('a', self.receive)
+        in_process.unsubscribe('a', self.receive)
+
+        self.broker.publish('a', '1')
+        in_process.publish('a', '1')
+
+        self.assertFalse(self.delivered.wait(0.2))
+
 
 class TestMoneySpentClass(TestCase):
 
@@ -359,7 +963,7 @@ class TestMoneySpentClass(TestCase):
         self.money_spent = MoneySpentForWagering(self.user.pk)
 
     def tearDown(self):
-        self.money_spent.redis.storage = dict()
+        self.money_spent.redis.clear()
 
     def test_key_to_cached_amount_of_money_spent_by_user(self):
         self.assertIn(str(self.user.pk), self.money_spent.key)
@@ -369,9 +973,54 @@ class TestMoneySpentClass(TestCase):
 
         self.assertEqual(self.money_spent.total, Decimal(100))
 
-    @skip('Not implemented method')
     def test_calculate_total_money_spent_for_user_when_its_not_in_cache(self):
-        self.money_spent.calculate_total()
+        deposit_real_money(self.user, Decimal(10))
+        play_game(self.user, Game.LOST, Decimal(2))
+        play_game(self.user, Game.WON, Decimal(2))
+        play_game(self.user, Game.LOST, Decimal(3))
+        self.money_spent.redis.clear()
+
+        self.assertEqual(self.money_spent.calculate_total(), Decimal(5))
+        self.assertEqual(self.money_spent.total, Decimal(5))
+
+    def test_lost_game_rebuilds_a_missing_counter_before_increasing_it(self):
+        deposit_real_money(self.user, Decimal(10))
+        play_game(self.user, Game.LOST, Decimal(2))
+        self.money_spent.redis.clear()
+
+        play_game(self.user, Game.LOST, Decimal(2))
+
+        self.assertEqual(self.money_spent.total, Decimal(4))
+
+    def test_calculated_total_leaves_out_wagering_requirement_of_transferred_bonuses(self):
+        create_default_bonus_types()
+        deposit_real_money(self.user, Decimal(30))
+        give_user_a_bonus(self.user, BonusType.objects.get(event=BonusType.LOGIN), Decimal(2))
+        play_games(self.user, [Game.LOST] * 12, Decimal(2))
+        cached_total = self.money_spent.total
+        self.money_spent.redis.clear()
+
+        self.assertEqual(BonusWageredTransaction.objects.count(), 1)
+        self.assertEqual(cached_total, Decimal(4))
+        self.assertEqual(self.money_spent.calculate_total(), cached_total)
+
+    def test_warm_up_command_rebuilds_counters_of_all_users(self):
+        other_user = User.objects.create(username='other-user')
+        deposit_real_money(self.user, Decimal(10))
+        play_game(self.user, Game.LOST, Decimal(2))
+        self.money_spent.redis.clear()
+
+        call_command('warm_wagering_counters', batch_size=1, stdout=StringIO())
+
+        self.assertEqual(self.money_spent.redis.get(self.money_spent.key), Money(2).cents)
+        self.assertEqual(self.money_spent.redis.get(MoneySpentForWagering(other_user.pk).key), 0)
+
+    def test_losing_games_increase_money_spent(self):
+        deposit_real_money(self.user, Decimal(10))
+        play_game(self.user, Game.LOST, Decimal(2))
+        play_games(self.user, [Game.LOST, Game.WON, Game.LOST], Decimal(2))
+
+        self.assertEqual(self.money_spent.total, Decimal(6))
 
     def test_increase_money_spent_for_user(self):
         self.money_spent.set(Decimal(0))
@@ -386,6 +1035,33 @@ class TestMoneySpentClass(TestCase):
         self.assertEqual(self.money_spent.total, Decimal(9))
 
 
+@override_settings(COUNTER_BACKEND={
+    'BACKEND': 'counters.redis_client.RedisCounters',
+    'OPTIONS': {'connection_class': FakeConnection, 'server': FakeServer()},
+})
+class TestMoneySpentWithRedisCounters(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='test-user')
+        self.money_spent = MoneySpentForWagering(self.user.pk)
+
+    def tearDown(self):
+        self.money_spent.redis.clear()
+
+    def test_counter_backend_comes_from_settings(self):
+        self.assertIsInstance(get_counters(), RedisCounters)
+        self.assertIs(self.money_spent.redis, get_counters())
+
+    def test_new_user_starts_with_zero_money_spent(self):
+        self.assertEqual(self.money_spent.total, Decimal(0))
+
+    def test_increase_and_decrease_money_spent(self):
+        self.money_spent.increase(Decimal('10.50'))
+        self.money_spent.decrease(Decimal(4))
+
+        self.assertEqual(self.money_spent.total, Decimal('6.50'))
+
+
 class TestBonusWagerUpdate(TestCase):
 
     def setUp(self):
@@ -453,3 +1129,958 @@ class TestBonusWagerUpdate(TestCase):
 
         self.assertEqual(self.money_spent.total, Decimal(10))
 
+    def test_every_wagered_bonus_is_added_to_real_money_wallet(self):
+        give_user_a_bonus(self.user, BonusType.objects.get(event=BonusType.LOGIN), Decimal(10))
+        give_user_a_bonus(self.user, BonusType.objects.get(event=BonusType.LOGIN), Decimal(5))
+        self.money_spent.set((Decimal(150)))
+
+        transfer_eligible_bonuses_to_real_money_wallet(self.user)
+
+        self.assertEqual(
+            Wallet.objects.get(user=self.user, money_type=Wallet.REAL_MONEY).current_balance, Decimal(15)
+        )
+
+    def test_wagered_bonuses_are_taken_out_of_bonus_wallet_and_their_grants(self):
+        give_user_a_bonus(self.user, BonusType.objects.get(event=BonusType.LOGIN), Decimal(20))
+        give_user_a_bonus(self.user, BonusType.objects.get(event=BonusType.LOGIN), Decimal(5))
+        self.money_spent.set((Decimal(60)))
+
+        transfer_eligible_bonuses_to_real_money_wallet(self.user)
+
+        self.assertEqual(Wallet.objects.get(user=self.user, money_type=Wallet.BONUS).current_balance, Decimal(20))
+        self.assertEqual(
+            list(BonusGrant.objects.order_by('id').values_list('balance', flat=True)), [Decimal(20), Decimal(0)]
+        )
+        self.assertEqual(BonusWageredTransaction.objects.get().bonus_grant.balance, Decimal(0))
+        self.assertFalse(reconcile_wallets(list(Wallet.objects.values_list('pk', flat=True))))
+
+
+def grants_wagered_by_walking_all_grants(grants, money_spent_total):
+    """The ids of the grants wagering transferred before it had a threshold, given (id, balance, requirement)s."""
+    wagered = []
+    for grant_id, balance, wagering_requirement in sorted(grants, key=lambda grant: (grant[1], grant[0])):
+        if balance <= 0:
+            continue
+        if money_spent_total < balance * wagering_requirement:
+            break
+        money_spent_total -= balance * wagering_requirement
+        wagered.append(grant_id)
+
+    return wagered
+
+
+bonuses = st.lists(st.tuples(st.integers(0, 20), st.sampled_from([0, 1, 5, 10])), max_size=6)
+actions = st.lists(st.one_of(
+    st.tuples(st.just('bonus'), st.integers(0, 20), st.sampled_from([0, 1, 5, 10])),
+    st.tuples(st.just('spin'), st.sampled_from([Game.LOST, Game.WON]), st.integers(1, 5)),
+    st.tuples(st.just('deposit'), st.integers(1, 10)),
+    st.tuples(st.just('spend'), st.integers(0, 100)),
+), max_size=15)
+
+
+class TestWageringThreshold(HypothesisTestCase):
+
+    def tearDown(self):
+        fake_redis.clear()
+
+    def create_user(self):
+        # examples are rolled back one by one, so everything they need is created in them
+        create_default_bonus_types()
+        user = User.objects.create(username='test-user')
+        MoneySpentForWagering(user.pk).set(0)
+        return user
+
+    def give_bonus(self, user, amount, wagering_requirement):
+        give_user_a_bonus(user, BonusType.objects.get(event=BonusType.LOGIN), Decimal(amount))
+        BonusGrant.objects.filter(pk=BonusGrant.objects.latest('pk').pk).update(wagering_requirement=wagering_requirement)
+
+    def grants(self, user):
+        return list(BonusGrant.objects.filter(wallet__user=user).values_list('pk', 'balance', 'wagering_requirement'))
+
+    def assert_wagering_matches_walking_all_grants(self, user):
+        expected = grants_wagered_by_walking_all_grants(self.grants(user), MoneySpentForWagering(user.pk).total)
+
+        transfer_eligible_bonuses_to_real_money_wallet(user)
+
+        self.assertEqual(
+            sorted(BonusWageredTransaction.objects.filter(bonus_wallet__user=user).values_list('bonus_grant', flat=True)),
+            sorted(expected)
+        )
+        BonusWageredTransaction.objects.all().delete()
+
+    @settings(max_examples=50, deadline=None)
+    @given(bonuses, st.integers(0, 300))
+    def test_transfers_the_same_bonuses_as_walking_all_grants(self, bonuses, money_spent):
+        user = self.create_user()
+        for amount, wagering_requirement in bonuses:
+            self.give_bonus(user, amount, wagering_requirement)
+        MoneySpentForWagering(user.pk).set(Decimal(money_spent))
+
+        self.assert_wagering_matches_walking_all_grants(user)
+
+    @settings(max_examples=100, deadline=None)
+    @given(actions)
+    def test_kept_threshold_transfers_the_same_bonuses_as_walking_all_grants(self, actions):
+        user = self.create_user()
+        for action in actions:
+            if action[0] == 'bonus':
+                self.give_bonus(user, action[1], action[2])
+            elif action[0] == 'spin':
+                try:
+                    play_game(user, action[1], Decimal(action[2]))
+                except BalanceTooLowError:
+                    pass
+            elif action[0] == 'deposit':
+                deposit_real_money(user, Decimal(action[1]))
+            else:
+                MoneySpentForWagering(user.pk).increase(Decimal(action[1]))
+
+            self.assert_wagering_matches_walking_all_grants(user)
+
+    def test_only_the_counter_is_read_below_the_threshold_once_wallets_are_loaded(self):
+        user = self.create_user()
+        self.give_bonus(user, 10, 10)
+        get_wagering_threshold(get_user_wallets(user).bonus)
+        MoneySpentForWagering(user.pk).set(Decimal(99))
+
+        with self.assertNumQueries(0):
+            transfer_eligible_bonuses_to_real_money_wallet(user)
+
+    def test_threshold_is_looked_up_again_after_the_bonus_wallet_changes(self):
+        user = self.create_user()
+        self.give_bonus(user, 10, 10)
+        self.assertEqual(get_wagering_threshold(get_user_wallets(user).bonus), Decimal(100))
+        self.give_bonus(user, 3, 10)
+
+        self.assertIsNone(Wallet.objects.get(user=user, money_type=Wallet.BONUS).wagering_threshold)
+        self.assertEqual(get_wagering_threshold(get_user_wallets(user).bonus), Decimal(30))
+
+
+class TestReconcileWallets(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='test-user')
+        self.wallet = Wallet.objects.get(user=self.user, money_type=Wallet.REAL_MONEY)
+        deposit_real_money(self.user, Decimal(10))
+        self.money_spent = MoneySpentForWagering(self.user.pk)
+
+    def tearDown(self):
+        self.money_spent.redis.clear()
+
+    def test_snapshot_records_ledger_balance_and_last_transaction(self):
+        drifts = reconcile_wallets([self.wallet.pk])
+
+        snapshot = WalletSnapshot.objects.get()
+        self.assertEqual(drifts, [])
+        self.assertEqual(snapshot.balance, Decimal(10))
+        self.assertEqual(snapshot.last_transaction_id, Transaction.objects.get().pk)
+        self.assertEqual(snapshot.drift, 0)
+
+    def test_only_transactions_after_the_latest_snapshot_are_summed(self):
+        reconcile_wallets([self.wallet.pk])
+        # rewriting history before the snapshot goes unnoticed, which shows older rows aren't read again
+        Transaction.objects.update(amount=1)
+        play_games(self.user, [Game.LOST, Game.WON, Game.LOST], Decimal(2))
+
+        drifts = reconcile_wallets([self.wallet.pk])
+
+        self.assertEqual(drifts, [])
+        self.assertEqual(WalletSnapshot.objects.latest('pk').balance, Decimal(8))
+
+    def test_wallets_without_new_transactions_get_no_new_snapshot(self):
+        reconcile_wallets([self.wallet.pk])
+        reconcile_wallets([self.wallet.pk])
+
+        self.assertEqual(WalletSnapshot.objects.count(), 1)
+
+    def test_drift_is_flagged_until_it_is_fixed(self):
+        reconcile_wallets([self.wallet.pk])
+        Wallet.objects.filter(pk=self.wallet.pk).update(current_balance=F('current_balance') + 500)
+
+        self.assertEqual(reconcile_wallets([self.wallet.pk]), [(self.wallet.pk, Decimal(15), Decimal(10))])
+        deposit_real_money(self.user, Decimal(1))
+        self.assertEqual(reconcile_wallets([self.wallet.pk]), [(self.wallet.pk, Decimal(16), Decimal(11))])
+        self.assertEqual(WalletSnapshot.objects.latest('pk').drift, Decimal(5))
+
+    def test_command_reports_drifted_wallets(self):
+        other_user = User.objects.create(username='other-user')
+        Wallet.objects.filter(user=other_user).update(current_balance=100)
+        out = StringIO()
+
+        call_command('reconcile_wallets', batch_size=1, stdout=out)
+
+        self.assertIn('Wallet {}: cached balance 100.00, ledger balance 0.00'.format(
+            Wallet.objects.get(user=other_user).pk
+        ), out.getvalue())
+        self.assertIn('Checked 2 wallets, 1 drifted', out.getvalue())
+
+
+@override_settings(WALLET_LOCKING='optimistic')
+class TestOptimisticWalletLocking(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='test-user')
+        deposit_real_money(self.user, Decimal(10))
+        self.wallet = Wallet.objects.get(user=self.user, money_type=Wallet.REAL_MONEY)
+
+    def tearDown(self):
+        fake_redis.clear()
+
+    def change_wallet_behind_users_back(self, balance):
+        Wallet.objects.filter(pk=self.wallet.pk).update(current_balance=balance, version=F('version') + 1)
+
+    def test_every_balance_change_bumps_the_version(self):
+        deposit_real_money(self.user, Decimal(1))
+        play_game(self.user, Game.LOST, Decimal(2))
+
+        self.assertEqual(Wallet.objects.get(pk=self.wallet.pk).version, self.wallet.version + 2)
+
+    def test_stale_wallet_is_not_written(self):
+        self.change_wallet_behind_users_back(1)
+
+        with self.assertRaises(WalletChangedError):
+            change_wallet_balance(self.wallet, Money(-5))
+        self.assertEqual(Wallet.objects.get(pk=self.wallet.pk).current_balance, Decimal(1))
+
+    def test_game_is_played_again_with_the_fresh_wallet(self):
+        get_user_wallets(self.user)
+        self.change_wallet_behind_users_back(7)
+
+        play_game(self.user, Game.LOST, Decimal(2))
+
+        self.assertEqual(Wallet.objects.get(pk=self.wallet.pk).current_balance, Decimal(5))
+        self.assertEqual(Game.objects.count(), 1)
+
+    def test_game_is_rolled_back_when_the_fresh_wallet_cant_afford_it(self):
+        get_user_wallets(self.user)
+        self.change_wallet_behind_users_back(1)
+
+        with self.assertRaises(BalanceTooLowError):
+            play_game(self.user, Game.LOST, Decimal(5))
+        self.assertEqual(Wallet.objects.get(pk=self.wallet.pk).current_balance, Decimal(1))
+        self.assertEqual(Game.objects.count(), 0)
+
+    def test_batch_is_played_again_with_the_fresh_wallet(self):
+        get_user_wallets(self.user)
+        self.change_wallet_behind_users_back(4)
+
+        played = play_games(self.user, [Game.LOST] * 5, Decimal(2))
+
+        self.assertEqual(played, [Game.LOST] * 2)
+        self.assertEqual(Wallet.objects.get(pk=self.wallet.pk).current_balance, 0)
+        self.assertEqual(Transaction.objects.filter(amount__lt=0).count(), 2)
+
+
+    def test_dashboard_deposit_asks_to_try_again_when_the_wallets_keep_changing(self):
+        self.client.force_login(self.user)
+
+        with mock.patch('spin.views.deposit_real_money', side_effect=WalletChangedError):
+            response = self.client.post('/dashboard/', {'amount': '5'}, follow=True)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [str(message) for message in response.context['messages']],
+            ['Your wallets changed while you were depositing, please try again!']
+        )
+
+class TestConditionalDebit(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='test-user')
+        deposit_real_money(self.user, Decimal(10))
+        self.real_money_wallet = Wallet.objects.get(user=self.user, money_type=Wallet.REAL_MONEY)
+
+    def tearDown(self):
+        fake_redis.clear()
+
+    def spend_behind_users_back(self, wallet, balance):
+        get_user_wallets(self.user)
+        Wallet.objects.filter(pk=wallet.pk).update(current_balance=balance)
+
+    def test_stale_balance_cant_overdraw_the_wallet(self):
+        self.spend_behind_users_back(self.real_money_wallet, 1)
+
+        with self.assertRaises(BalanceTooLowError):
+            deduct_real_money__user_lost_game(self.user, Decimal(5))
+        self.assertEqual(Wallet.objects.get(pk=self.real_money_wallet.pk).current_balance, Decimal(1))
+        self.assertEqual(Game.objects.count(), 0)
+
+    def test_next_wallet_pays_when_the_first_one_was_spent(self):
+        create_default_bonus_types()
+        give_user_a_bonus(self.user, BonusType.objects.get(event=BonusType.LOGIN), Decimal(10))
+        self.spend_behind_users_back(self.real_money_wallet, 1)
+
+        deduct_real_money__user_lost_game(self.user, Decimal(5))
+
+        self.assertEqual(Wallet.objects.get(pk=self.real_money_wallet.pk).current_balance, Decimal(1))
+        self.assertEqual(Wallet.objects.get(user=self.user, money_type=Wallet.BONUS).current_balance, Decimal(5))
+
+    def test_lost_game_reads_nothing_when_wallets_are_loaded(self):
+        get_user_wallets(self.user)
+
+        # the debit, the game, the transaction and the link between them
+        with self.assertNumQueries(4):
+            deduct_real_money__user_lost_game(self.user, Decimal(5))
+
+
+@override_settings(OUTBOX_EVENTS=True)
+class TestOutbox(TestCase):
+
+    def setUp(self):
+        create_default_bonus_types()
+        self.user = User.objects.create(username='test-user')
+        self.spent_money_signals = []
+        user_spendt_money_signal.connect(self.count_spent_money_signal)
+
+    def tearDown(self):
+        user_spendt_money_signal.disconnect(self.count_spent_money_signal)
+        fake_redis.clear()
+
+    def count_spent_money_signal(self, user_id, **kwargs):
+        self.spent_money_signals.append(user_id)
+
+    def test_deposit_bonus_is_given_when_the_outbox_is_drained(self):
+        deposit_real_money(self.user, Decimal(200))
+
+        self.assertEqual(OutboxEvent.objects.get().amount, Decimal(200))
+        self.assertFalse(Wallet.objects.filter(user=self.user, money_type=Wallet.BONUS).exists())
+
+        self.assertEqual(drain_outbox(batch_size=10), 1)
+        self.assertTrue(Wallet.objects.filter(user=self.user, money_type=Wallet.BONUS).exists())
+        self.assertFalse(OutboxEvent.objects.exists())
+
+    def test_games_of_a_user_are_coalesced_into_one_signal(self):
+        other_user = User.objects.create(username='other-user')
+        for user in (self.user, other_user):
+            deposit_real_money(user, Decimal(10))
+            play_game(user, Game.LOST, Decimal(1))
+            play_games(user, [Game.WON, Game.LOST], Decimal(1))
+
+        self.assertEqual(self.spent_money_signals, [])
+        self.assertEqual(drain_outbox(batch_size=100), 6)
+        self.assertEqual(sorted(self.spent_money_signals), [self.user.pk, other_user.pk])
+
+    def test_rolled_back_games_leave_no_events(self):
+        with self.assertRaises(BalanceTooLowError):
+            play_game(self.user, Game.LOST, Decimal(1))
+
+        self.assertFalse(OutboxEvent.objects.exists())
+
+    def test_a_failing_handler_only_keeps_its_users_events(self):
+        other_user = User.objects.create(username='other-user')
+        for user in (self.user, other_user):
+            deposit_real_money(user, Decimal(200))
+
+        def fail_for_user(sender, user, **kwargs):
+            if user.pk == self.user.pk:
+                raise WalletChangedError
+
+        user_made_deposit_signal.connect(fail_for_user)
+        try:
+            with mock.patch('spin.outbox.logger') as logger:
+                self.assertEqual(drain_outbox(batch_size=10), 2)
+        finally:
+            user_made_deposit_signal.disconnect(fail_for_user)
+
+        logger.exception.assert_called_once()
+        self.assertEqual(OutboxEvent.objects.get().user, self.user)
+        self.assertEqual(OutboxEvent.objects.get().attempts, 1)
+        self.assertTrue(Wallet.objects.filter(user=other_user, money_type=Wallet.BONUS).exists())
+        self.assertFalse(BonusGrant.objects.filter(wallet__user=self.user).exists())
+
+    def test_counter_changes_of_a_failing_users_events_are_taken_back(self):
+        deposit_real_money(self.user, Decimal(200))
+        drain_outbox(batch_size=10)
+        play_games(self.user, [Game.LOST] * 100, Decimal(1))
+        deposit_real_money(self.user, Decimal(1))
+
+        def fail(sender, user, **kwargs):
+            raise WalletChangedError
+
+        # wagering transfers the bonus and uses up the money spent, then the deposit's handler raises
+        user_made_deposit_signal.connect(fail)
+        try:
+            with mock.patch('spin.outbox.logger'):
+                drain_outbox(batch_size=10)
+        finally:
+            user_made_deposit_signal.disconnect(fail)
+
+        self.assertEqual(MoneySpentForWagering(self.user.pk).total, Decimal(100))
+        self.assertFalse(BonusWageredTransaction.objects.exists())
+
+        drain_outbox(batch_size=10)
+
+        self.assertEqual(MoneySpentForWagering(self.user.pk).total, 0)
+        self.assertEqual(BonusWageredTransaction.objects.count(), 1)
+
+    def test_events_failing_every_attempt_are_left_in_the_outbox(self):
+        deposit_real_money(self.user, Decimal(200))
+        OutboxEvent.objects.update(attempts=app_settings['OUTBOX_EVENT_ATTEMPTS'])
+
+        self.assertEqual(drain_outbox(batch_size=10), 0)
+        self.assertTrue(OutboxEvent.objects.exists())
+
+    def test_command_drains_in_batches(self):
+        deposit_real_money(self.user, Decimal(10))
+        play_game(self.user, Game.WON, Decimal(1))
+        out = StringIO()
+
+        call_command('drain_outbox', batch_size=1, once=True, stdout=out)
+
+        self.assertIn('Drained 2 events', out.getvalue())
+        self.assertFalse(OutboxEvent.objects.exists())
+
+
+class TestSpinHistory(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='test-user')
+        deposit_real_money(self.user, Decimal(10))
+        play_games(self.user, [Game.LOST, Game.WON, Game.LOST], Decimal(1))
+        self.two_months_ago = timezone.now() - datetime.timedelta(days=62)
+        self.wallet_ids = list(Wallet.objects.filter(user=self.user).values_list('pk', flat=True))
+
+    def tearDown(self):
+        fake_redis.clear()
+
+    def backdate_spins(self):
+        Transaction.objects.filter(spingametransaction__isnull=False).update(created_at=self.two_months_ago)
+
+    def test_timestamps_are_set_once(self):
+        transaction = Transaction.objects.first()
+        created_at = transaction.created_at
+        transaction.amount = Money(11)
+        transaction.save()
+
+        self.assertEqual(Transaction.objects.get(pk=transaction.pk).created_at, created_at)
+        self.assertEqual(created_at.date(), timezone.now().date())
+
+    def test_reconciled_spins_are_archived_without_changing_the_history(self):
+        self.backdate_spins()
+        reconcile_wallets(self.wallet_ids)
+        spins = get_user_spins(self.user, self.two_months_ago, timezone.now())
+        money_spent = calculate_money_spent_totals([self.user.pk])
+
+        self.assertEqual(archive_spins(month_start(timezone.now()), batch_size=2), 3)
+
+        self.assertEqual(ArchivedSpin.objects.count(), 3)
+        self.assertFalse(Game.objects.exists())
+        self.assertFalse(SpinGameTransaction.objects.exists())
+        self.assertEqual(Transaction.objects.count(), 1)
+        self.assertEqual(get_user_spins(self.user, self.two_months_ago, timezone.now()), spins)
+        self.assertEqual(calculate_money_spent_totals([self.user.pk]), money_spent)
+        self.assertEqual(reconcile_wallets(self.wallet_ids), [])
+
+    def test_spins_that_were_not_reconciled_or_are_recent_stay(self):
+        reconcile_wallets(self.wallet_ids)
+        self.assertEqual(archive_spins(month_start(timezone.now())), 0)
+
+        self.backdate_spins()
+        play_game(self.user, Game.LOST, Decimal(1))
+        Transaction.objects.filter(spingametransaction__isnull=False).update(created_at=self.two_months_ago)
+        self.assertEqual(archive_spins(month_start(timezone.now())), 3)
+        self.assertEqual(Game.objects.count(), 1)
+
+    def test_old_archived_months_are_dropped(self):
+        self.backdate_spins()
+        reconcile_wallets(self.wallet_ids)
+        archive_spins(month_start(timezone.now()))
+
+        drop_archived_months(month_start(self.two_months_ago))
+        self.assertEqual(ArchivedSpin.objects.count(), 3)
+        drop_archived_months(month_start(timezone.now()))
+        self.assertFalse(ArchivedSpin.objects.exists())
+
+
+    def test_money_spent_is_rebuilt_the_same_after_months_are_dropped(self):
+        create_default_bonus_types()
+        deposit_real_money(self.user, Decimal(20))
+        give_user_a_bonus(self.user, BonusType.objects.get(event=BonusType.LOGIN), Decimal(1))
+        play_games(self.user, [Game.LOST] * 10, Decimal(1))
+        self.backdate_spins()
+        reconcile_wallets(self.wallet_ids)
+        archive_spins(month_start(timezone.now()))
+        money_spent = calculate_money_spent_totals([self.user.pk])
+
+        drop_archived_months(month_start(timezone.now()))
+        self.assertFalse(ArchivedSpin.objects.exists())
+        self.assertEqual(DroppedSpinsTotal.objects.get(user=self.user).lost, Decimal(12))
+        self.assertEqual(BonusWageredTransaction.objects.count(), 1)
+        self.assertEqual(calculate_money_spent_totals([self.user.pk]), money_spent)
+
+        play_game(self.user, Game.LOST, Decimal(1))
+        self.backdate_spins()
+        reconcile_wallets(self.wallet_ids)
+        archive_spins(month_start(timezone.now()))
+        drop_archived_months(month_start(timezone.now()))
+        self.assertEqual(calculate_money_spent_totals([self.user.pk]), {self.user.pk: money_spent[self.user.pk] + 1})
+
+@unittest.skipUnless(connection.vendor == 'sqlite', 'Only SQLite connections are tuned')
+class TestSQLiteTuning(TestCase):
+
+    @override_settings(SQLITE_PRAGMAS={'cache_size': -1234, 'busy_timeout': 4321})
+    def test_pragmas_are_run_on_new_connections(self):
+        apply_sqlite_pragmas(sender=None, connection=connection)
+
+        with connection.cursor() as cursor:
+            self.assertEqual(cursor.execute('PRAGMA cache_size').fetchone()[0], -1234)
+            self.assertEqual(cursor.execute('PRAGMA busy_timeout').fetchone()[0], 4321)
+
+
+@unittest.skipUnless(connection.vendor == 'sqlite', 'Only SQLite writes are retried')
+@mock.patch('spin.wallets.time.sleep')
+class TestRetriesWhenDatabaseIsLocked(unittest.TestCase):
+    """Runs outside a database transaction, writes are only retried when they aren't part of a bigger one."""
+
+    def setUp(self):
+        self.user = User(pk=1)
+
+    def decorated(self, *errors):
+        write = mock.Mock(side_effect=list(errors) + ['written'])
+        return write, retries_when_database_is_locked(write)
+
+    def test_locked_write_is_run_again(self, sleep):
+        write, retried_write = self.decorated(OperationalError('database is locked'))
+
+        self.assertEqual(retried_write(self.user, Money(1)), 'written')
+        self.assertEqual(write.call_count, 2)
+        sleep.assert_called_once()
+
+    def test_other_errors_are_raised(self, sleep):
+        write, retried_write = self.decorated(OperationalError('no such table: spin_wallet'))
+
+        with self.assertRaises(OperationalError):
+            retried_write(self.user)
+        self.assertEqual(write.call_count, 1)
+
+    def test_gives_up_after_the_last_attempt(self, sleep):
+        attempts = app_settings['DATABASE_LOCKED_ATTEMPTS']
+        write, retried_write = self.decorated(*[OperationalError('database is locked')] * attempts)
+
+        with self.assertRaises(OperationalError):
+            retried_write(self.user)
+        self.assertEqual(write.call_count, attempts)
+
+    def test_writes_inside_a_transaction_are_not_run_again(self, sleep):
+        write, retried_write = self.decorated(OperationalError('database is locked'))
+
+        with mock.patch.object(connection, 'in_atomic_block', True), self.assertRaises(OperationalError):
+            retried_write(self.user)
+        self.assertEqual(write.call_count, 1)
+
+
+@unittest.skipUnless(connection.vendor == 'sqlite', 'Only SQLite writes are retried')
+@mock.patch('spin.wallets.time.sleep')
+class TestRetriedWritesCountMoneySpentOnce(TransactionTestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='test-user')
+        deposit_real_money(self.user, Decimal(10))
+
+    def tearDown(self):
+        fake_redis.clear()
+
+    def test_lost_game_run_again_after_a_locked_write(self, sleep):
+        create_event = OutboxEvent.objects.create
+        errors = [OperationalError('database is locked')]
+
+        def create_event_once_locked(**kwargs):
+            if errors:
+                raise errors.pop()
+            return create_event(**kwargs)
+
+        with mock.patch.object(OutboxEvent.objects, 'create', side_effect=create_event_once_locked):
+            play_game(self.user, Game.LOST, Decimal(2))
+
+        sleep.assert_called_once()
+        self.assertEqual(Game.objects.count(), 1)
+        self.assertEqual(MoneySpentForWagering(self.user.pk).total, Decimal(2))
+        self.assertEqual(MoneySpentForWagering(self.user.pk).calculate_total(), Decimal(2))
+
+
+class TestApi(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='test-user')
+        self.user.set_password('PassworD')
+        self.user.save()
+        self.key = ApiToken.objects.create(user=self.user, key='test-key').key
+
+    def tearDown(self):
+        fake_redis.clear()
+
+    def post(self, url, data, key='test-key'):
+        return self.client.post(url, json.dumps(data), content_type='application/json',
+                                HTTP_AUTHORIZATION='Token {}'.format(key))
+
+    def test_token_is_given_for_the_right_password(self):
+        response = self.post('/api/token', {'username': 'test-user', 'password': 'PassworD'}, key=None)
+        self.assertEqual(response.json(), {'token': 'test-key'})
+
+        response = self.post('/api/token', {'username': 'test-user', 'password': 'wrong'}, key=None)
+        self.assertEqual(response.status_code, 401)
+
+    def test_requests_without_a_valid_token_are_refused(self):
+        self.assertEqual(self.post('/api/spin', {}, key='wrong-key').status_code, 401)
+        self.assertEqual(self.client.post('/api/spin').status_code, 401)
+        self.assertEqual(self.client.get('/api/spin', HTTP_AUTHORIZATION='Token test-key').status_code, 405)
+
+    def test_deposit_answers_with_the_new_balances(self):
+        response = self.post('/api/deposit', {'amount': '12.50'})
+
+        self.assertEqual(response.json(), {'wallets': {'real_money': '12.50', 'bonus': None}})
+        self.assertEqual(self.post('/api/deposit', {'amount': 'a lot'}).status_code, 400)
+
+    def test_deposits_of_nothing_negative_or_too_large_amounts_are_refused(self):
+        for amount in ['0', '0.00', '-5', '-0.01', '1000000.01', '1e30', '99999999999999999999.99']:
+            response = self.post('/api/deposit', {'amount': amount})
+
+            self.assertEqual(response.status_code, 400, amount)
+            self.assertIn('amount', response.json()['error'], amount)
+        self.assertFalse(Transaction.objects.exists())
+
+    def test_deposit_asks_to_try_again_when_the_wallets_keep_changing(self):
+        with mock.patch('spin.api.deposit_real_money', side_effect=WalletChangedError):
+            response = self.post('/api/deposit', {'amount': '10'})
+
+        self.assertEqual(response.status_code, 409)
+
+    def test_spin_answers_with_the_outcomes_and_the_new_balances(self):
+        deposit_real_money(self.user, Decimal(10))
+
+        response = self.post('/api/spin', {'games': 3}).json()
+
+        self.assertEqual(len(response['outcomes']), 3)
+        self.assertEqual(
+            Decimal(response['wallets']['real_money']),
+            Wallet.objects.get(user=self.user, money_type=Wallet.REAL_MONEY).current_balance
+        )
+        self.assertEqual(Game.objects.count(), 3)
+
+    def test_spin_without_money_is_refused(self):
+        response = self.post('/api/spin', {})
+
+        self.assertEqual(response.status_code, 402)
+        self.assertFalse(Game.objects.exists())
+
+    def test_wallets_are_read_without_a_session(self):
+        with self.assertNumQueries(2):
+            response = self.client.get('/api/wallets', HTTP_AUTHORIZATION='Token test-key')
+
+        self.assertEqual(response.json(), {'wallets': {'real_money': '0.00', 'bonus': None}})
+        self.assertNotIn('sessionid', response.cookies)
+
+    def test_wallets_are_not_streamed_under_wsgi(self):
+        self.assertEqual(self.client.get('/api/wallets/stream').status_code, 204)
+
+
+class TestAsgi(TransactionTestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='test-user')
+        ApiToken.objects.create(user=self.user, key='test-key')
+        self.handler = ASGIHandler()
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.run_until_complete(self.handler.shutdown())
+        self.loop.close()
+        fake_redis.clear()
+
+    async def request(self, method, path, body=b'', query_string=b'', authorization=b'Token test-key'):
+        messages = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': body}
+
+        async def send(message):
+            messages.append(message)
+
+        headers = [(b'host', b'testserver'), (b'content-type', b'application/json')]
+        if authorization:
+            headers.append((b'authorization', authorization))
+        await self.handler({
+            'type': 'http', 'method': method, 'path': path, 'query_string': query_string, 'headers': headers,
+        }, receive, send)
+        return messages[0]['status'], b''.join(message.get('body', b'') for message in messages[1:])
+
+    def json(self, method, path, data=None, query_string=b''):
+        status, body = self.loop.run_until_complete(
+            self.request(method, path, json.dumps(data or {}).encode(), query_string)
+        )
+        return status, json.loads(body.decode())
+
+    def test_spin_answers_like_the_api_view(self):
+        deposit_real_money(self.user, Decimal(10))
+
+        status, response = self.json('POST', '/api/spin', {'games': 3})
+
+        self.assertEqual(status, 200)
+        self.assertEqual(len(response['outcomes']), 3)
+        self.assertEqual(Game.objects.count(), 3)
+        self.assertEqual(self.json('POST', '/api/wallets')[0], 405)
+
+    @unittest.skipIf(connection.vendor == 'sqlite', 'SQLite keeps the connections of in-memory databases open')
+    def test_shutdown_closes_the_connections_of_the_database_threads(self):
+        handler = ASGIHandler()
+
+        def open_connection():
+            connections['default'].ensure_connection()
+            return connections['default']
+
+        async def open_connections():
+            return await asyncio.gather(*[handler.run_in_thread(open_connection) for _ in range(20)])
+
+        thread_connections = set(self.loop.run_until_complete(open_connections()))
+        self.loop.run_until_complete(handler.shutdown())
+
+        self.assertNotIn(connections['default'], thread_connections)
+        self.assertFalse([
+            thread_connection for thread_connection in thread_connections if thread_connection.connection
+        ])
+
+    def test_other_paths_are_served_by_django(self):
+        status, body = self.loop.run_until_complete(self.request('GET', '/login/'))
+
+        self.assertEqual(status, 200)
+        self.assertIn(b'<form', body)
+
+    def test_long_poll_answers_when_a_deposit_changes_the_wallets(self):
+        deposit_real_money(self.user, Decimal(10))
+        state = self.json('GET', '/api/wallets/poll')[1]['state']
+
+        async def poll_and_deposit():
+            poll = asyncio.ensure_future(
+                self.request('GET', '/api/wallets/poll', query_string='since={}'.format(state).encode())
+            )
+            await asyncio.sleep(0.1)
+            self.assertFalse(poll.done())
+            await self.request('POST', '/api/deposit', json.dumps({'amount': '5'}).encode())
+            return await asyncio.wait_for(poll, 1)
+
+        status, body = self.loop.run_until_complete(poll_and_deposit())
+
+        self.assertEqual(json.loads(body.decode())['wallets']['real_money'], '15.00')
+
+    @override_settings(ASGI_WALLETS_CHECK_INTERVAL=0.05)
+    def test_long_poll_notices_changes_made_by_other_processes(self):
+        deposit_real_money(self.user, Decimal(10))
+        state = self.json('GET', '/api/wallets/poll')[1]['state']
+
+        async def poll_and_deposit():
+            poll = asyncio.ensure_future(
+                self.request('GET', '/api/wallets/poll', query_string='since={}'.format(state).encode())
+            )
+            await asyncio.sleep(0.1)
+            # published to another process' broker, so only the check of the wallets can notice it
+            with mock.patch('spin.wallets.get_broker', return_value=InProcessBroker()):
+                deposit_real_money(self.user, Decimal(3))
+            return await asyncio.wait_for(poll, 1)
+
+        status, body = self.loop.run_until_complete(poll_and_deposit())
+
+        self.assertEqual(json.loads(body.decode())['wallets']['real_money'], '13.00')
+
+    @override_settings(ASGI_WALLETS_CHECK_INTERVAL=None)
+    def test_stream_sends_the_wallets_whenever_they_change(self):
+        self.client.force_login(self.user)
+        events = []
+
+        async def stream_and_deposit():
+            requests = iter([{'type': 'http.request', 'body': b''}])
+            disconnect = asyncio.get_event_loop().create_future()
+            messages = asyncio.Queue()
+
+            async def receive():
+                return next(requests, None) or await disconnect
+
+            stream = asyncio.ensure_future(self.handler({
+                'type': 'http', 'method': 'GET', 'path': '/api/wallets/stream', 'query_string': b'',
+                'headers': [(b'cookie', 'sessionid={}'.format(self.client.session.session_key).encode())],
+            }, receive, messages.put))
+
+            self.assertEqual((await messages.get())['status'], 200)
+            events.append(await messages.get())
+            # through the handler, then directly like another thread of the process would
+            await self.request('POST', '/api/deposit', json.dumps({'amount': '5'}).encode())
+            events.append(await asyncio.wait_for(messages.get(), 1))
+            play_game(self.user, Game.WON, Decimal(2))
+            events.append(await asyncio.wait_for(messages.get(), 1))
+
+            disconnect.set_result({'type': 'http.disconnect'})
+            await asyncio.wait_for(stream, 1)
+
+        self.loop.run_until_complete(stream_and_deposit())
+
+        self.assertEqual(
+            [json.loads(event['body'].decode().split('data: ')[1])['wallets']['real_money'] for event in events],
+            ['0.00', '5.00', '7.00'],
+        )
+
+    def test_stream_needs_a_user(self):
+        status, _ = self.loop.run_until_complete(self.request('GET', '/api/wallets/stream', authorization=None))
+
+        self.assertEqual(status, 401)
+
+    @override_settings(ASGI_LONG_POLL_SECONDS=0.1)
+    def test_long_poll_answers_with_the_same_wallets_after_the_timeout(self):
+        state = self.json('GET', '/api/wallets/poll')[1]['state']
+
+        status, response = self.json('GET', '/api/wallets/poll', query_string='since={}'.format(state).encode())
+
+        self.assertEqual((status, response['state']), (200, state))
+
+
+class TestWalletsChangedMessages(TransactionTestCase):
+
+    def setUp(self):
+        create_default_bonus_types()
+        self.user = User.objects.create(username='test-user')
+        self.broker = InProcessBroker()
+        self.received = []
+        self.broker.subscribe(WALLETS_CHANGED_CHANNEL, self.received.append)
+
+    def tearDown(self):
+        fake_redis.clear()
+
+    def test_wallet_changes_are_published_once_they_are_committed(self):
+        with mock.patch('spin.wallets.get_broker', return_value=self.broker):
+            with db_transaction.atomic():
+                deposit_real_money(self.user, Decimal(10))
+                self.assertEqual(self.received, [])
+
+            # creates the bonus wallet
+            give_user_a_bonus(self.user, BonusType.objects.get(event=BonusType.LOGIN), Decimal(3))
+
+        self.assertEqual(self.received, [str(self.user.pk)] * 2)
+
+    def test_rolled_back_changes_are_not_published(self):
+        with mock.patch('spin.wallets.get_broker', return_value=self.broker):
+            with self.assertRaises(ZeroDivisionError), db_transaction.atomic():
+                deposit_real_money(self.user, Decimal(10))
+                1 / 0
+
+        self.assertEqual(self.received, [])
+
+
+class TestRequestMetrics(TestCase):
+
+    def setUp(self):
+        create_default_bonus_types()
+        self.user = User.objects.create(username='test-user')
+        self.client.force_login(self.user)
+
+    def tearDown(self):
+        fake_redis.clear()
+
+    @override_settings(REQUEST_METRICS_SAMPLE_RATE=1)
+    def test_sampled_requests_are_logged_with_their_queries(self):
+        with self.assertLogs('spin.metrics', 'INFO') as logs:
+            self.client.get('/dashboard/')
+
+        self.assertRegex(logs.output[0], r'GET /dashboard/ 200: [\d.]+ ms, [1-9]\d* queries in [\d.]+ ms')
+
+    @override_settings(REQUEST_METRICS_SAMPLE_RATE=1, OUTBOX_EVENTS=False)
+    def test_signal_handlers_are_timed(self):
+        with self.assertLogs('spin.metrics', 'INFO') as logs:
+            self.client.post('/dashboard/', {'amount': '200'})
+
+        self.assertEqual(BonusTransaction.objects.filter(bonus_type__event=BonusType.REAL_MONEY_DEPOSIT).count(), 1)
+        self.assertGreater(float(re.search(r'signal handlers ([\d.]+) ms', logs.output[0]).group(1)), 0)
+
+    @override_settings(REQUEST_METRICS_SAMPLE_RATE=0)
+    def test_nothing_is_logged_without_sampling(self):
+        with mock.patch.object(metrics_logger, 'info') as info:
+            self.client.get('/dashboard/')
+
+        info.assert_not_called()
+
+
+class TestImportFixtures(TestCase):
+
+    def tearDown(self):
+        fake_redis.clear()
+
+    def test_users_are_created_with_their_deposits_and_counters(self):
+        call_command('import_fixtures', users=3, transactions_per_user=4, batch_size=2, stdout=StringIO())
+
+        users = User.objects.filter(username__startswith='user-')
+        self.assertEqual(users.count(), 3)
+        for user in users:
+            self.assertEqual(user.wallets.get().current_balance, Decimal(4))
+            self.assertEqual(DepositTransaction.objects.filter(transaction__wallet__user=user).count(), 4)
+            self.assertEqual(MoneySpentForWagering(user.pk).total, Decimal(0))
+        self.assertTrue(users.first().check_password('PassworD'))
+        self.assertFalse(reconcile_wallets(list(Wallet.objects.values_list('pk', flat=True))))
+
+
+class TestBonusGrantsMigration(TransactionTestCase):
+    """Migration 0012 with the data it exists for, users with several bonus wallets."""
+
+    def migrate(self, migration):
+        executor = MigrationExecutor(connection)
+        executor.migrate([('spin', migration)])
+        return executor.loader.project_state([('spin', migration)]).apps
+
+    def tearDown(self):
+        self.migrate(MigrationExecutor(connection).loader.graph.leaf_nodes('spin')[0][1])
+
+    def test_bonus_wallets_are_folded_into_grants_of_one_wallet(self):
+        apps = self.migrate('0011_outbox_event')
+        Wallet = apps.get_model('spin', 'Wallet')
+        Transaction = apps.get_model('spin', 'Transaction')
+        BonusTransaction = apps.get_model('spin', 'BonusTransaction')
+        bonus_type = apps.get_model('spin', 'BonusType').objects.create(event='login')
+        user = apps.get_model('auth', 'User').objects.create(username='test-user')
+        Wallet.objects.create(user=user, money_type='real_money', current_balance=Money(10))
+        for balance, wagering_requirement in ((Money(5), 10), (Money(3), 20)):
+            wallet = Wallet.objects.create(
+                user=user, money_type='bonus', current_balance=balance, wagering_requirement=wagering_requirement,
+            )
+            transaction = Transaction.objects.create(wallet=wallet, amount=balance)
+            BonusTransaction.objects.create(transaction=transaction, bonus_type=bonus_type)
+
+        apps = self.migrate('0012_bonus_grants')
+
+        bonus_wallet = apps.get_model('spin', 'Wallet').objects.get(user_id=user.pk, money_type='bonus')
+        self.assertEqual(bonus_wallet.current_balance, Decimal(8))
+        self.assertEqual(
+            list(bonus_wallet.bonus_grants.order_by('pk').values_list('balance', 'wagering_requirement')),
+            [(Decimal(5), 10), (Decimal(3), 20)],
+        )
+        self.assertEqual(apps.get_model('spin', 'Transaction').objects.filter(wallet=bonus_wallet).count(), 2)
+
+
+@unittest.skipUnless(connection.vendor == 'postgresql', 'SQLite only lets one connection write at a time')
+@override_settings(WALLET_LOCKING='select_for_update')
+class TestConcurrentWrites(TransactionTestCase):
+
+    def tearDown(self):
+        fake_redis.clear()
+
+    def test_concurrent_deposits_and_games_keep_the_ledger_balanced(self):
+        user = User.objects.create(username='test-user')
+        deposit_real_money(user, Decimal(100))
+        errors = []
+
+        def deposit_and_play():
+            # every thread has its own user object, so its own cached wallets
+            thread_user = User.objects.get(pk=user.pk)
+            try:
+                for _ in range(10):
+                    deposit_real_money(thread_user, Decimal(2))
+                    play_game(thread_user, Game.LOST, Decimal(1))
+            except Exception as error:
+                errors.append(error)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=deposit_and_play) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(get_user_wallets(user).real_money.current_balance, Decimal(100 + 8 * 10))
+        self.assertEqual(reconcile_wallets(list(Wallet.objects.values_list('pk', flat=True))), [])
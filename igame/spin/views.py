@@ -1,14 +1,15 @@
-from decimal import Decimal
-
 from django.contrib import messages
 from django.contrib.auth import login, authenticate
 from django.contrib.auth.forms import UserCreationForm
 from django.shortcuts import render, redirect
 
+from .constants import SPIN_APP_SETTINGS as app_settings
 from .deposit import deposit_real_money
-from .forms import DepositForm
-from .game import play_random_game
-from .models import BalanceTooLowError, Wallet
+from .forms import DepositForm, PlayForm
+from .game import play_random_game, play_random_games
+from .models import BalanceTooLowError, Game, WalletChangedError
+from .money import Money
+from .wallets import get_user_wallets
 
 
 def home(request):
@@ -30,26 +31,50 @@ def dashboard(request):
     if request.method == 'POST':
         form = DepositForm(request.POST)
         if form.is_valid():
-            deposit_amount = Decimal(form.cleaned_data['amount'])
+            deposit_amount = Money(form.cleaned_data['amount'])
 
-            deposit_real_money(request.user, deposit_amount)
-            messages.success(request, 'You just deposited {} into your account'.format(deposit_amount))
+            try:
+                deposit_real_money(request.user, deposit_amount)
+                messages.success(request, 'You just deposited {} into your account'.format(deposit_amount))
+            except WalletChangedError:
+                messages.error(request, 'Your wallets changed while you were depositing, please try again!')
 
     deposit_form = DepositForm()
-    real_money_wallet = Wallet.objects.get(user=request.user, money_type=Wallet.REAL_MONEY)
-    bonus_wallets = Wallet.objects.filter(user=request.user, money_type=Wallet.BONUS).all()
+    wallets = get_user_wallets(request.user)
+    bonus_wallet = wallets.bonus
     return render(
         request,
         'dashboard.html',
-        {'form': deposit_form, 'real_money_wallet': real_money_wallet, 'bonus_wallets': bonus_wallets}
+        {
+            'form': deposit_form,
+            'real_money_wallet': wallets.real_money,
+            'bonus_wallet': bonus_wallet,
+            'bonus_count': bonus_wallet.bonus_grants.filter(balance__gt=0).count() if bonus_wallet else 0,
+        }
     )
 
 
 def play(request):
+    form = PlayForm(request.GET)
+    if not form.is_valid():
+        messages.error(request, 'You can play between 1 and {} games at once!'.format(
+            app_settings['MAX_GAMES_PER_PLAY_REQUEST']
+        ))
+        return redirect('dashboard')
+
+    games = form.cleaned_data['games'] or 1
     try:
-        outcome = play_random_game(request.user)
-        messages.success(request, 'You {}'.format(outcome))
+        if games == 1:
+            outcome = play_random_game(request.user)
+            messages.success(request, 'You {}'.format(outcome))
+        else:
+            outcomes = play_random_games(request.user, games)
+            messages.success(request, 'You played {} games: {} won, {} lost'.format(
+                len(outcomes), outcomes.count(Game.WON), outcomes.count(Game.LOST)
+            ))
     except BalanceTooLowError:
         messages.error(request, 'You do not have enough money in any of your wallets! Deposit some money first!')
+    except WalletChangedError:
+        messages.error(request, 'Your wallets changed while you were playing, please try again!')
 
     return redirect('dashboard')
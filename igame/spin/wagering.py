@@ -1,65 +1,207 @@
-from decimal import Decimal
-
 from django.db import transaction as db_transaction
-from django.db.models import F
+from django.db.models import ExpressionWrapper, F, Sum
+
+from .deduct import negify
+from .game_rules import is_a_bonus_transferable, NO_THRESHOLD, wager_grant, wagering_threshold
+from .models import (
+    ArchivedSpin,
+    BalanceTooLowError,
+    BonusGrant,
+    BonusWageredTransaction,
+    DroppedSpinsTotal,
+    Game,
+    Transaction,
+    Wallet,
+)
+from .money import Money, MoneyField
+from .wallets import (
+    change_grant_balance,
+    change_wallet_balance,
+    debit_wallet,
+    get_user_wallets,
+    invalidates_user_wallets,
+    lock_user_wallets,
+    record_counter_change,
+    retries_wallet_changes,
+)
+from counters import get_counters
 
-from .models import BonusWageredTransaction, Transaction, Wallet
-from redis.fake_redis import fake_redis
 
 class MoneySpentForWagering:
-
-    redis = fake_redis
+    """The money a user spent that still counts towards wagering their bonuses, kept in cents in the counters."""
 
     def __init__(self, user_id):
         self.user_id = user_id
 
+    @property
+    def redis(self):
+        return get_counters()
+
     def set(self, amount):
-        self.redis.set(self.key, amount)
+        self.redis.set(self.key, Money(amount).cents)
 
     def increase(self, amount):
-        self.redis.incr(self.key, amount)
+        self.redis.incr(self.key, Money(amount).cents)
+        record_counter_change(self.key, Money(amount).cents)
 
     def decrease(self, amount):
-        self.redis.decr(self.key, amount)
+        self.redis.decr(self.key, Money(amount).cents)
+        record_counter_change(self.key, -Money(amount).cents)
 
     @property
     def total(self):
-        total = self.redis.get(self.key)
+        cents = self.redis.get(self.key)
 
-        if total is None:
+        if cents is None:
             total = self.calculate_total()
             self.set(total)
+            return total
 
-        return total
+        return Money.from_cents(cents)
 
     @property
     def key(self):
         return 'money_spent:{}'.format(self.user_id)
 
     def calculate_total(self):
-        raise NotImplementedError
+        return calculate_money_spent_totals([self.user_id]).get(self.user_id, Money(0))
+
+
+def set_money_spent_totals(totals):
+    """Sets the money spent for wagering of many users with one write to the counters, `totals` is by user id."""
+    get_counters().set_many(
+        {MoneySpentForWagering(user_id).key: Money(total).cents for user_id, total in totals.items()}
+    )
+
+
+def calculate_money_spent_totals(user_ids):
+    """
+    Rebuilds the money spent for wagering of the given users from the ledger.
+
+    That's the money they lost in games, live, archived or in dropped archive months, minus the wagering requirements
+    of the bonuses that were already transferred to their real money wallets. Returns a dict of user id to total,
+    users who never lost a game are left out.
+    """
+    lost = Transaction.objects.\
+        filter(wallet__user_id__in=user_ids, spingametransaction__game__outcome=Game.LOST).\
+        values_list('wallet__user_id').\
+        annotate(total=Sum('amount'))
+    archived_lost = ArchivedSpin.objects.\
+        filter(wallet__user_id__in=user_ids, outcome=Game.LOST).\
+        values_list('wallet__user_id').\
+        annotate(total=Sum('amount'))
+    wagered = BonusWageredTransaction.objects.\
+        filter(real_money_wallet__user_id__in=user_ids).\
+        values_list('real_money_wallet__user_id').\
+        annotate(total=Sum(ExpressionWrapper(
+            F('amount') * F('bonus_grant__wagering_requirement'), output_field=MoneyField()
+        )))
+
+    totals = {user_id: negify(total) for user_id, total in lost}
+    for user_id, total in archived_lost:
+        totals[user_id] = totals.get(user_id, Money(0)) - total
+    for user_id, total in DroppedSpinsTotal.objects.filter(user_id__in=user_ids).values_list('user_id', 'lost'):
+        totals[user_id] = totals.get(user_id, Money(0)) + total
+    for user_id, total in wagered:
+        totals[user_id] = totals.get(user_id, Money(0)) - total
+
+    return totals
+
+
+def get_wagering_threshold(bonus_wallet):
+    """
+    The money a user has to have spent before any of their bonuses can be wagered, `None` without bonuses.
+
+    Wagering starts at the grant with the lowest balance and stops at the first one whose requirement isn't met, so
+    the threshold is that grant's balance times its wagering requirement. It's kept on the wallet until the wallet's
+    balance changes.
+    """
+    if bonus_wallet is None or bonus_wallet.current_balance <= 0:
+        return None
+
+    if bonus_wallet.wagering_threshold is None:
+        # the index narrows the grants down to the first in wagering order, the one the threshold is of
+        grants = list(
+            BonusGrant.objects.
+            filter(wallet=bonus_wallet, balance__gt=0).
+            order_by('balance', 'pk').
+            values_list('balance', 'wagering_requirement')[:1]
+        )
+        threshold = wagering_threshold(
+            [balance.cents for balance, _ in grants], [requirement for _, requirement in grants]
+        )
+        if threshold == NO_THRESHOLD:
+            return None
+
+        bonus_wallet.wagering_threshold = Money.from_cents(threshold)
+        # if the wallet changed since it was read, the grant may not be the lowest anymore
+        Wallet.objects.\
+            filter(pk=bonus_wallet.pk, version=bonus_wallet.version).\
+            update(wagering_threshold=bonus_wallet.wagering_threshold)
+
+    return bonus_wallet.wagering_threshold
+
+
+@invalidates_user_wallets
+@retries_wallet_changes
+def transfer_eligible_bonuses_to_real_money_wallet(user):
+    """
+    Moves the bonuses whose wagering requirement is met to the user's real money wallet.
 
+    Only the wallets and the money spent counter are read while the money spent is below the wagering threshold,
+    the grants are only walked once it's crossed.
+    """
+    threshold = get_wagering_threshold(get_user_wallets(user).bonus)
+    if threshold is None:
+        return
 
-def transfer_eligible_bonuses_to_real_money_wallet(user):
     money_spent = MoneySpentForWagering(user.pk)
-    real_money_wallet = user.wallets.get(money_type=Wallet.REAL_MONEY)
-
-    with db_transaction.atomic():
-        for bonus_wallet in user.wallets.filter(money_type=Wallet.BONUS, current_balance__gt=Decimal(0)).\
-                order_by('current_balance').all():
-            wallet_cachin_requirement = bonus_wallet.current_balance * bonus_wallet.wagering_requirement
-
-            if money_spent.total < wallet_cachin_requirement:
-                break
-
-            real_money_wallet.current_balance = F('current_balance') + bonus_wallet.current_balance
-            transaction = Transaction.objects.create(amount=bonus_wallet.current_balance, wallet=real_money_wallet)
-            BonusWageredTransaction.objects.create(
-                transaction=transaction,
-                real_money_wallet=real_money_wallet,
-                bonus_wallet=bonus_wallet,
-                amount=bonus_wallet.current_balance
-            )
-            money_spent.decrease(wallet_cachin_requirement)
-
-        real_money_wallet.save()
+    money_spent_total = money_spent.total
+    if not is_a_bonus_transferable(threshold.cents, money_spent_total.cents):
+        return
+
+    transferred_amount = Money(0)
+
+    try:
+        with db_transaction.atomic():
+            lock_user_wallets(user)
+            wallets = get_user_wallets(user)
+            real_money_wallet = wallets.real_money
+            bonus_wallet = wallets.bonus
+            if bonus_wallet is None:
+                return
+            # in wagering order
+            grants = BonusGrant.objects.filter(wallet=bonus_wallet, balance__gt=0).order_by('balance', 'pk')
+
+            money_spent_left = money_spent_total.cents
+            for grant in grants.iterator():
+                transferred, money_spent_left = wager_grant(
+                    grant.balance.cents, grant.wagering_requirement, money_spent_left
+                )
+                if not transferred:
+                    break
+
+                transferred_amount += grant.balance
+                Transaction.objects.create(amount=negify(grant.balance), wallet=bonus_wallet)
+                change_grant_balance(grant, negify(grant.balance))
+                transaction = Transaction.objects.create(amount=grant.balance, wallet=real_money_wallet)
+                BonusWageredTransaction.objects.create(
+                    transaction=transaction,
+                    real_money_wallet=real_money_wallet,
+                    bonus_wallet=bonus_wallet,
+                    bonus_grant=grant,
+                    amount=grant.balance
+                )
+
+            wagered_amount = money_spent_total - Money.from_cents(money_spent_left)
+            # the cached wallets' balances can be stale, so only the differences are written
+            if transferred_amount:
+                debit_wallet(bonus_wallet, transferred_amount)
+                change_wallet_balance(real_money_wallet, transferred_amount)
+    except BalanceTooLowError:
+        # a grant was spent from after it was read, it's transferred the next time wagering runs
+        return
+
+    # the counter isn't rolled back with the database, so it's only changed once the transfers are written
+    if wagered_amount:
+        money_spent.decrease(wagered_amount)
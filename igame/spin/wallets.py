@@ -0,0 +1,263 @@
+from functools import wraps
+import logging
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection, OperationalError, transaction as db_transaction
+from django.db.models import F
+
+from .constants import SPIN_APP_SETTINGS as app_settings
+from .models import BalanceTooLowError, BonusGrant, Wallet, WalletChangedError
+from counters import get_counters
+from pubsub import get_broker
+
+
+SELECT_FOR_UPDATE = 'select_for_update'
+OPTIMISTIC = 'optimistic'
+# messages are the ids of users whose wallets changed
+WALLETS_CHANGED_CHANNEL = 'wallets_changed'
+
+logger = logging.getLogger(__name__)
+
+# the counter changes of the write `retries_when_database_is_locked` is running in this thread
+_counter_changes = threading.local()
+
+
+class UserWallets:
+    """
+    All of a user's wallets, loaded with one query.
+
+    The wallets are ordered the way games pick them: the real money wallet first, then the bonus wallet.
+    """
+
+    def __init__(self, wallets):
+        self.wallets = wallets
+
+    @property
+    def real_money(self):
+        for wallet in self.wallets:
+            if wallet.money_type == Wallet.REAL_MONEY:
+                return wallet
+
+        raise Wallet.DoesNotExist
+
+    @property
+    def bonus(self):
+        """The user's bonus wallet, `None` until the user gets a bonus."""
+        for wallet in self.wallets:
+            if wallet.money_type == Wallet.BONUS:
+                return wallet
+
+    def for_game(self, bet_amount):
+        for wallet in self.wallets:
+            if wallet.current_balance >= bet_amount:
+                return wallet
+
+        raise BalanceTooLowError
+
+
+CACHE_ATTRIBUTE = '_user_wallets_cache'
+
+
+def get_user_wallets(user):
+    """
+    Returns the user's wallets, querying the database only once per user object.
+
+    Views pass `request.user` around, so every function working on the same request shares the wallets. Code
+    that changes wallets must call `invalidate_user_wallets` (or be decorated with `invalidates_user_wallets`).
+    """
+    user_wallets = getattr(user, CACHE_ATTRIBUTE, None)
+
+    if user_wallets is None:
+        user_wallets = UserWallets(list(user_wallets_query(user)))
+        setattr(user, CACHE_ATTRIBUTE, user_wallets)
+
+    return user_wallets
+
+
+def user_wallets_query(user):
+    return Wallet.objects.filter(user_id=user.pk).order_by('-money_type', 'id')
+
+
+def invalidate_user_wallets(user):
+    setattr(user, CACHE_ATTRIBUTE, None)
+
+
+def invalidates_user_wallets(func):
+    """For functions that take the user as their first argument and change the user's wallets."""
+
+    @wraps(func)
+    def wrapper(user, *args, **kwargs):
+        try:
+            return func(user, *args, **kwargs)
+        finally:
+            invalidate_user_wallets(user)
+
+    return wrapper
+
+
+def get_wallet_locking():
+    return getattr(settings, 'WALLET_LOCKING', None)
+
+
+def lock_user_wallets(user):
+    """
+    With `WALLET_LOCKING = 'select_for_update'`, locks the user's wallet rows until the end of the current
+    database transaction and reloads them, so the wallets read afterwards can't change under the caller.
+    """
+    if get_wallet_locking() == SELECT_FOR_UPDATE:
+        setattr(user, CACHE_ATTRIBUTE, UserWallets(list(user_wallets_query(user).select_for_update())))
+
+
+def change_wallet_balance(wallet, amount):
+    """
+    Adds `amount` to the wallet's balance in the database with a single UPDATE.
+
+    A negative `amount` is only taken if the wallet still has that much, whatever the cached balance says, so
+    wallets can't be overdrawn even without locks. `BalanceTooLowError` is raised when it hasn't.
+
+    With `WALLET_LOCKING = 'optimistic'` the update only happens if no one changed the wallet since it was read,
+    otherwise `WalletChangedError` is raised.
+    """
+    wallets = Wallet.objects.filter(pk=wallet.pk)
+    if amount < 0:
+        wallets = wallets.filter(current_balance__gte=-amount)
+    if get_wallet_locking() == OPTIMISTIC:
+        wallets = wallets.filter(version=wallet.version)
+
+    changes = {'current_balance': F('current_balance') + amount.cents, 'version': F('version') + 1}
+    if wallet.money_type == Wallet.BONUS:
+        # the wallet's grants change with it, so its wagering threshold is looked up again
+        changes['wagering_threshold'] = None
+
+    if not wallets.update(**changes):
+        raise WalletChangedError if get_wallet_locking() == OPTIMISTIC else BalanceTooLowError
+
+    publish_wallets_changed(wallet.user_id)
+
+
+def publish_wallets_changed(user_id):
+    """
+    Publishes the user's id on `WALLETS_CHANGED_CHANNEL` once the current database transaction commits, so balance
+    streams and long polls answer. The write is committed by then, so a failure to publish is only logged.
+    """
+
+    def publish():
+        try:
+            get_broker().publish(WALLETS_CHANGED_CHANNEL, str(user_id))
+        except Exception:
+            logger.exception('Could not publish that the wallets of user %s changed', user_id)
+
+    db_transaction.on_commit(publish)
+
+
+def debit_wallet(wallet, amount):
+    change_wallet_balance(wallet, -amount)
+
+
+def get_grant_for_game(bonus_wallet, bet_amount):
+    """Games on the bonus wallet are played with its oldest grant that can afford the bet, or `None`."""
+    return bonus_wallet.bonus_grants.filter(balance__gte=bet_amount).order_by('pk').first()
+
+
+def change_grant_balance(grant, amount):
+    """
+    `change_wallet_balance` for bonus grants, a negative `amount` is only taken if the grant still has that much.
+
+    The grant's wallet has to be changed by the same amount in the same database transaction.
+    """
+    grants = BonusGrant.objects.filter(pk=grant.pk)
+    if amount < 0:
+        grants = grants.filter(balance__gte=-amount)
+
+    if not grants.update(balance=F('balance') + amount.cents):
+        raise BalanceTooLowError
+
+
+def retries_wallet_changes(func):
+    """
+    For functions that take the user as their first argument and change the user's wallets with
+    `change_wallet_balance`. When a wallet changed under them, their writes are rolled back and they run again
+    with freshly loaded wallets.
+    """
+
+    @wraps(func)
+    def wrapper(user, *args, **kwargs):
+        if get_wallet_locking() != OPTIMISTIC:
+            return func(user, *args, **kwargs)
+
+        for _ in range(app_settings['WALLET_UPDATE_ATTEMPTS'] - 1):
+            try:
+                with db_transaction.atomic():
+                    return func(user, *args, **kwargs)
+            except WalletChangedError:
+                invalidate_user_wallets(user)
+
+        return func(user, *args, **kwargs)
+
+    return wrapper
+
+
+def record_counter_change(key, amount):
+    """
+    Called by code that adds `amount` to a counter, the counters aren't rolled back with the database. Inside
+    `call_taking_back_counter_changes` the change is taken back if the call fails.
+    """
+    changes = getattr(_counter_changes, 'changes', None)
+    if changes is not None:
+        changes.append((key, amount))
+
+
+def call_taking_back_counter_changes(func, *args, **kwargs):
+    """
+    Calls `func`, which writes in a database transaction or savepoint of its own, and takes back the counter changes
+    recorded with `record_counter_change` if it raises, as its database writes are rolled back. Calls can be nested:
+    the changes of a call that succeeded are taken back with those of the call around it.
+    """
+    outer_changes = getattr(_counter_changes, 'changes', None)
+    changes = _counter_changes.changes = []
+    try:
+        result = func(*args, **kwargs)
+    except Exception:
+        counters = get_counters()
+        for key, amount in reversed(changes):
+            counters.decr(key, amount)
+        raise
+    finally:
+        _counter_changes.changes = outer_changes
+
+    if outer_changes is not None:
+        outer_changes.extend(changes)
+    return result
+
+
+def retries_when_database_is_locked(func):
+    """
+    For functions that take the user as their first argument and write in a database transaction of their own.
+
+    SQLite lets one connection write at a time. A write fails with "database is locked" when the other one takes
+    longer than `busy_timeout`, and right away when a transaction that read first can't start writing, so it's
+    rolled back and run again after a short, growing wait. The counter changes it recorded with
+    `record_counter_change` are taken back first. Inside a transaction the error is passed on, only the outermost
+    one can be run again.
+    """
+
+    @wraps(func)
+    def wrapper(user, *args, **kwargs):
+        if connection.vendor != 'sqlite' or connection.in_atomic_block:
+            return func(user, *args, **kwargs)
+
+        for attempt in range(app_settings['DATABASE_LOCKED_ATTEMPTS'] - 1):
+            try:
+                return call_taking_back_counter_changes(func, user, *args, **kwargs)
+            except OperationalError as error:
+                if 'database is locked' not in str(error):
+                    raise
+                invalidate_user_wallets(user)
+                time.sleep(random.uniform(0, 0.01 * 2 ** attempt))
+
+        return call_taking_back_counter_changes(func, user, *args, **kwargs)
+
+    return wrapper